@@ -0,0 +1,227 @@
+""" Asyncio serving mode for the read heavy endpoints: profiles, posts, comments, followers and following. The queries
+are the ones the Flask app builds, run through the databases package on an async driver (aiosqlite locally, asyncpg
+on heroku), so a worker keeps serving other requests while one waits on the database. Responses are the same as from
+server.py, which still serves everything else including all writes. Run it next to the sync app with
+
+    gunicorn async_server:web_app --worker-class aiohttp.GunicornWebWorker
+
+and route the GET requests below to it. benchmarks/loadtest.py compares the two modes"""
+import asyncio
+
+from aiohttp import web
+from databases import Database
+from jwt import ExpiredSignatureError
+
+from db_functions import *
+
+
+def async_database_url(uri):
+    """ The databases package only knows the postgresql scheme, heroku hands out postgres:// urls"""
+    if uri.startswith('postgres://'):
+        return 'postgresql://' + uri[len('postgres://'):]
+    return uri
+
+
+database = Database(async_database_url(app.config['SQLALCHEMY_DATABASE_URI']))
+
+
+class Row:
+    """ Attribute access to a row of model, selected directly or through a union, which prefixes the column names
+    with the table name. Stands in for model instances in to_page and the serializers"""
+
+    def __init__(self, model, record):
+        record = dict(record)
+        prefix = model.__tablename__ + '_'
+        for column in model.__table__.columns:
+            setattr(self, column.key, record[column.key] if column.key in record else record[prefix + column.key])
+
+
+async def fetch_rows(model, query):
+    return [Row(model, x) for x in await database.fetch_all(query.statement)]
+
+
+async def fetch_page(model, query, keys, cursor=None, limit=None):
+    """ Async paginate"""
+    return to_page(await fetch_rows(model, keyset(query, keys, cursor, limit)), keys, limit)
+
+
+async def serialize_post_rows(posts, viewer_id=None, likers_limit=None):
+    """ Async serialize_posts, the authors and likers queries run concurrently"""
+    if not posts:
+        return []
+    results = await asyncio.gather(*[database.fetch_all(x.statement)
+                                     for x in post_relations_queries(posts, viewer_id, likers_limit)])
+    return assemble_posts(posts, *results)
+
+
+async def serialize_user_row(user, fields=None):
+    """ Async User.to_dict, the requested relations are fetched concurrently"""
+    header = user_header(user)
+    relations = [x for x in USER_RELATIONS if fields is None or x in fields]
+
+    async def relation(name):
+        query, keys = user_relation(user.user_id, name)
+        if name == 'followed':
+            return (await fetch_page(User, query, keys)).map(lambda x: x.username)
+        return await serialize_post_rows(await fetch_page(Post, query, keys))
+
+    values = dict(zip(relations, await asyncio.gather(*[relation(x) for x in relations])))
+    values.update(header)
+    ret = {x: values[x] for x in USER_FIELDS if fields is None or x in fields}
+    if 'followed' in ret:
+        ret['followed_cursor'] = ret['followed'].next_cursor
+    return ret
+
+
+def json_error(error, message):
+    return error(text=json.dumps({'msg': message}), content_type='application/json')
+
+
+async def current_user_id(request):
+    """ Identity of the access token in the Authorization header, checked like jwt_required does in the sync app"""
+    parts = request.headers.get('Authorization', '').split()
+    if not parts:
+        raise json_error(web.HTTPUnauthorized, 'Missing Authorization Header')
+    if len(parts) != 2 or parts[0] != 'Bearer':
+        raise json_error(web.HTTPUnprocessableEntity, "Bad Authorization header. Expected value 'Bearer <JWT>'")
+    try:
+        with app.app_context():
+            token = decode_token(parts[1])
+    except ExpiredSignatureError:
+        raise json_error(web.HTTPUnauthorized, 'Token has expired')
+    except Exception as e:
+        raise json_error(web.HTTPUnprocessableEntity, str(e))
+    if token.get('type') != 'access':
+        raise json_error(web.HTTPUnprocessableEntity, 'Only access tokens are allowed')
+    if await is_token_revoked_async(token):
+        raise json_error(web.HTTPUnauthorized, 'Token has been revoked')
+    return token['identity']
+
+
+async def is_token_revoked_async(token):
+    """ Async is_token_revoked, sharing its caches and jti filter"""
+    version = cached_token_version(token['identity'])
+    if version is None:
+        version = await database.fetch_val(
+            db.session.query(User.token_version).filter(User.user_id == token['identity']).statement)
+        if version is not None:
+            remember_token_version(token['identity'], version)
+    if token.get('user_claims', {}).get('ver', 0) != version:
+        return True
+    if app.config['TOKEN_REVOCATION'] != 'version':
+        return await is_token_blacklisted_async(token['jti'], token.get('exp'))
+    if not app.config['TOKEN_JTI_FILTER']:
+        return False
+    jtis = cached_jti_filter()
+    if jtis is None:
+        jtis = set_jti_filter(x for (x,) in await database.fetch_all(recent_blacklist_query().statement))
+    if token['jti'] not in jtis:
+        return False
+    return await database.fetch_one(Blacklist.query.filter_by(jti=token['jti']).statement) is not None
+
+
+async def is_token_blacklisted_async(jti, expires=None):
+    """ Async is_token_blacklisted, sharing its caches"""
+    cached = cached_blacklist_status(jti)
+    if cached is not None:
+        return cached
+    if await database.fetch_one(Blacklist.query.filter_by(jti=jti).statement) is not None:
+        return True
+    remember_good_token(jti, expires)
+    return False
+
+
+def page_args(request):
+    limit = request.query.get('limit')
+    try:
+        return request.query.get('cursor'), None if limit is None else int(limit)
+    except ValueError:
+        return request.query.get('cursor'), None
+
+
+def fields_args(request):
+    return parse_fields(request.query.get('fields'), request.query.get('include'))
+
+
+def page_response(page):
+    response = web.json_response(page)
+    if page.next_cursor is not None:
+        response.headers['X-Next-Cursor'] = page.next_cursor
+    return response
+
+
+@web.middleware
+async def bad_request(request, handler):
+    try:
+        return await handler(request)
+    except InvalidCursor:
+        return web.json_response('invalid cursor', status=400)
+    except InvalidFields:
+        return web.json_response('invalid fields', status=400)
+
+
+routes = web.RouteTableDef()
+
+
+@routes.get('/user/following')
+async def get_followed(request):
+    user_id = await current_user_id(request)
+    fields = fields_args(request)
+    page = await fetch_page(User, followed_users_query(user_id).filter(User.user_id != user_id), [User.user_id],
+                            *page_args(request))
+    return page_response(Page(await asyncio.gather(*[serialize_user_row(x, fields) for x in page]),
+                              page.next_cursor))
+
+
+@routes.get('/user/followers')
+async def get_followers(request):
+    user_id = await current_user_id(request)
+    fields = fields_args(request)
+    page = await fetch_page(User, followers_query(user_id).filter(User.user_id != user_id), [User.user_id],
+                            *page_args(request))
+    return page_response(Page(await asyncio.gather(*[serialize_user_row(x, fields) for x in page]),
+                              page.next_cursor))
+
+
+@routes.get('/user/{email}')
+async def user(request):
+    await current_user_id(request)
+    fields = fields_args(request)
+    rows = await fetch_rows(User, User.query.filter_by(email=request.match_info['email']))
+    if not rows:
+        raise web.HTTPNotFound()
+    return web.json_response(await serialize_user_row(rows[0], fields))
+
+
+@routes.get('/post/{post_id}')
+async def get_post(request):
+    rows = await fetch_rows(Post, Post.query.filter_by(post_id=request.match_info['post_id']))
+    if not rows:
+        raise web.HTTPNotFound()
+    likers = request.query.get('likers')
+    likers = min(int(likers), app.config['MAX_PAGE_SIZE']) if likers is not None and likers.isdigit() else None
+    return web.json_response((await serialize_post_rows(rows, likers_limit=likers))[0])
+
+
+@routes.get('/post/{post_id}/comment')
+async def get_comments(request):
+    await current_user_id(request)
+    page = await fetch_page(Comment, Comment.query.filter_by(post_id=request.match_info['post_id']),
+                            [Comment.timestamp, Comment.comment_id], *page_args(request))
+    return page_response(page.map(comment_to_dict))
+
+
+async def connect(web_app):
+    await database.connect()
+    yield
+    await database.disconnect()
+
+
+def create_app():
+    web_app = web.Application(middlewares=[bad_request])
+    web_app.add_routes(routes)
+    web_app.cleanup_ctx.append(connect)
+    return web_app
+
+
+web_app = create_app()
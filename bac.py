@@ -0,0 +1,129 @@
+""" Blood alcohol estimation from a users posts with the Widmark formula. Each drink raises the blood alcohol
+concentration by grams of alcohol / (body weight * Widmark factor), and the body eliminates alcohol at a constant
+rate as long as there is any left. Concentrations are in per mille, volumes of posts in centilitres"""
+from database import *
+from cache import LRUCache
+import numpy as np
+import time
+
+ALCOHOL_DENSITY = 0.789  # grams per millilitre
+WIDMARK_FACTORS = {'male': 0.68, 'female': 0.55}
+DEFAULT_WIDMARK_FACTOR = 0.615
+ELIMINATION_RATE = 0.15  # per mille per hour
+EPOCH = datetime(1970, 1, 1)
+
+# Blood alcohol right after the latest drink of recently active users, as (hours since the epoch, per mille). Lets a
+# new post or a question about now be answered without reading the drink history again. Entries expire after
+# BAC_CACHE_TTL seconds since posts made through other workers do not reach this cache
+bac_states = LRUCache(app.config['BAC_CACHE_SIZE'])
+
+
+def to_hours(timestamps):
+    """ Converts datetimes to hours since the epoch"""
+    return (np.array(timestamps, dtype='datetime64[us]') - np.datetime64(EPOCH, 'us')) / np.timedelta64(1, 'h')
+
+
+def hours_since_epoch(timestamp):
+    """ Scalar to_hours, without the overhead of numpy for a single value"""
+    return (timestamp - EPOCH).total_seconds() / 3600
+
+
+def drink_increments(volume, alcohol_percentage, weight, gender):
+    """ Rise in blood alcohol caused by a drink, or by each drink for arrays of volumes and alcohol percentages"""
+    grams = volume * 10 * alcohol_percentage / 100 * ALCOHOL_DENSITY
+    return grams / (weight * WIDMARK_FACTORS.get(gender, DEFAULT_WIDMARK_FACTOR))
+
+
+def bac_after_drinks(hours, increments, groups=None):
+    """ Blood alcohol right after each drink. hours have to be sorted, within each group when groups gives the group
+    of every drink, e.g. one group per user with the drinks of a group next to each other.
+
+    The level just before drink i follows the Lindley recursion
+    L_i = max(0, L_(i-1) + d_(i-1) - rate * (t_i - t_(i-1))), whose closed form S_i - min(S_0..S_i) over the partial
+    sums S of the steps is computed with cumsum and minimum.accumulate"""
+    hours = np.asarray(hours, dtype=float)
+    increments = np.asarray(increments, dtype=float)
+    if len(hours) == 0:
+        return increments
+    steps = np.empty_like(hours)
+    steps[0] = 0
+    steps[1:] = increments[:-1] - ELIMINATION_RATE * np.diff(hours)
+    if groups is None:
+        starts = np.zeros(1, dtype=int)
+        group_index = np.zeros(len(hours), dtype=int)
+    else:
+        groups = np.asarray(groups)
+        starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+        group_index = np.cumsum(np.r_[True, groups[1:] != groups[:-1]]) - 1
+    steps[starts] = 0
+    sums = np.cumsum(steps)
+    sums -= sums[starts][group_index]
+    # Shifts every group below all earlier ones, so a running minimum over everything never reaches back into an
+    # earlier group
+    offset = sums.max() - sums.min() + 1
+    running_min = np.minimum.accumulate(sums - group_index * offset) + group_index * offset
+    return sums - running_min + increments
+
+
+def bac_at(hours, levels, at):
+    """ Blood alcohol at the times in at, given drink times and levels from bac_after_drinks of a single user"""
+    at = np.asarray(at, dtype=float)
+    last = np.searchsorted(hours, at, side='right') - 1
+    if len(hours) == 0:
+        return np.zeros_like(at)
+    since = at - np.asarray(hours)[np.maximum(last, 0)]
+    bac = np.maximum(0, np.asarray(levels)[np.maximum(last, 0)] - ELIMINATION_RATE * since)
+    return np.where(last < 0, 0, bac)
+
+
+def user_drinks(user, since, until):
+    """ Drink times in hours and blood alcohol increments of the posts by user from BAC_HISTORY_HOURS before since up
+    to until. Older drinks have long since been eliminated"""
+    since = since - timedelta(hours=app.config['BAC_HISTORY_HOURS'])
+    rows = db.session.query(Post.timestamp, Post.volume, Post.alcohol_percentage).filter(
+        Post.author_id == user.user_id, Post.timestamp > since, Post.timestamp <= until).order_by(Post.timestamp).all()
+    if not rows:
+        return np.zeros(0), np.zeros(0)
+    timestamps, volumes, percentages = zip(*rows)
+    return to_hours(timestamps), drink_increments(np.array(volumes, dtype=float), np.array(percentages, dtype=float),
+                                                  user.weight, user.gender)
+
+
+def bac_series(user, start, end, step=timedelta(minutes=10)):
+    """ Estimated blood alcohol of user from start to end in steps, as a list of (datetime, per mille)"""
+    hours, increments = user_drinks(user, start, end)
+    times = np.arange(hours_since_epoch(start), hours_since_epoch(end) + 1e-9, step.total_seconds() / 3600)
+    levels = bac_at(hours, bac_after_drinks(hours, increments), times)
+    return [(EPOCH + timedelta(hours=float(t)), float(x)) for t, x in zip(times, levels)]
+
+
+def estimate_bac(user, at=None):
+    """ Estimated blood alcohol of user at the datetime at, by default now"""
+    now = at is None
+    if now:
+        at = datetime.utcnow()
+    at_hours = hours_since_epoch(at)
+    state = bac_states.get(user.user_id)
+    if state is not None and state[0] <= at_hours:
+        return max(0.0, state[1] - ELIMINATION_RATE * (at_hours - state[0]))
+    hours, increments = user_drinks(user, at, at)
+    levels = bac_after_drinks(hours, increments)
+    if now and len(hours):
+        bac_states.set(user.user_id, (float(hours[-1]), float(levels[-1])),
+                       time.time() + app.config['BAC_CACHE_TTL'])
+    return float(bac_at(hours, levels, [at_hours])[0])
+
+
+def update_bac_state(user, post):
+    """ Adds a new post to the cached blood alcohol of its author in constant time. A post that is older than the
+    latest known drink drops the cached state instead, which is then recomputed from the history on the next read"""
+    state = bac_states.get(user.user_id)
+    if state is None:
+        return
+    hours = hours_since_epoch(post.timestamp)
+    if hours < state[0]:
+        bac_states.delete(user.user_id)
+        return
+    increment = drink_increments(post.volume, post.alcohol_percentage, user.weight, user.gender)
+    bac_states.set(user.user_id, (hours, max(0.0, state[1] - ELIMINATION_RATE * (hours - state[0])) + increment),
+                   time.time() + app.config['BAC_CACHE_TTL'])
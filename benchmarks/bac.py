@@ -0,0 +1,64 @@
+""" Benchmarks the blood alcohol engine over many users.
+
+    python -m benchmarks.bac --users 100000
+
+Synthetic drink histories are generated in memory, so this measures the computation only. Compares the grouped
+computation over every user at once with one call per user and with the constant time update made per new post"""
+import argparse
+import json
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+
+import numpy as np
+
+import bac
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--max-drinks', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    bac.app.config['BAC_CACHE_SIZE'] = args.users
+    bac.bac_states.maxsize = args.users
+
+    rng = np.random.RandomState(args.seed)
+    drinks = rng.randint(1, args.max_drinks + 1, size=args.users)
+    groups = np.repeat(np.arange(args.users), drinks)
+    gaps = rng.exponential(0.75, size=len(groups))
+    starts = np.r_[0, np.cumsum(drinks)[:-1]]
+    gaps[starts] = rng.uniform(0, 24 * 365, size=args.users)
+    hours = np.cumsum(gaps)
+    hours -= np.repeat(hours[starts], drinks) - np.repeat(gaps[starts], drinks)
+    weights = rng.randint(50, 110, size=args.users)
+    increments = bac.drink_increments(np.full(len(groups), 33.0), np.full(len(groups), 5.3),
+                                      np.repeat(weights, drinks), 'male')
+
+    results = {'users': args.users, 'drinks': int(len(groups))}
+
+    start = time.perf_counter()
+    levels = bac.bac_after_drinks(hours, increments, groups)
+    results['grouped_seconds'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for first, count in zip(starts, drinks):
+        bac.bac_after_drinks(hours[first:first + count], increments[first:first + count])
+    results['per_user_seconds'] = time.perf_counter() - start
+
+    last = starts + drinks - 1
+    for user, (t, level) in enumerate(zip(hours[last].tolist(), levels[last].tolist())):
+        bac.bac_states.set(user, (t, level))
+    users = [SimpleNamespace(user_id=x, weight=int(w), gender='male') for x, w in enumerate(weights)]
+    post = SimpleNamespace(timestamp=bac.EPOCH + timedelta(hours=float(hours.max()) + 1), volume=33.0,
+                           alcohol_percentage=5.3)
+    start = time.perf_counter()
+    for user in users:
+        bac.update_bac_state(user, post)
+    results['incremental_update_seconds'] = time.perf_counter() - start
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
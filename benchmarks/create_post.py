@@ -0,0 +1,49 @@
+""" Benchmarks create_post throughput with each id generator.
+
+    python -m benchmarks.create_post --posts 5000
+
+Every generator gets its own scratch SQLite database with one author and a few followers, so that the timeline
+fan-out is part of the measured work as it is in production"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from database import app, db
+
+
+def run(generator, posts, followers):
+    from db_functions import create_user, create_post, follow_user
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    app.config['ID_GENERATOR'] = generator
+    try:
+        db.create_all()
+        author = create_user('author', 'ABCdef123', 'author@student.liu.se', 70, 'male')
+        for i in range(followers):
+            follow_user(create_user('follower%d' % i, 'ABCdef123', 'follower%d@student.liu.se' % i, 70, 'male'),
+                        author)
+        start = time.perf_counter()
+        for _ in range(posts):
+            create_post('Gränges', 33, 5.3, author.user_id)
+        elapsed = time.perf_counter() - start
+        return {'posts': posts, 'seconds': elapsed, 'posts_per_second': posts / elapsed}
+    finally:
+        db.session.remove()
+        db.get_engine(app).dispose()
+        os.unlink(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--posts', type=int, default=5000)
+    parser.add_argument('--followers', type=int, default=10)
+    args = parser.parse_args()
+    from db_functions import ID_GENERATORS
+    print(json.dumps({x: run(x, args.posts, args.followers) for x in sorted(ID_GENERATORS)}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
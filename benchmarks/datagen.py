@@ -0,0 +1,93 @@
+""" Synthetic data for the benchmarks, made with the db_functions creation helpers so that timelines, counters and
+rollups are maintained exactly as in production.
+
+    python -m benchmarks.datagen --users 200 --posts 2000 app.db
+
+Follower counts follow a power law: most users have a handful of followers and a few have very many, like on the
+real service. Posting, liking and commenting activity is spread the same way"""
+import argparse
+import json
+import os
+import random
+import tempfile
+from contextlib import contextmanager
+
+from database import app, db, follow_count, Post
+
+PASSWORD = 'ABCdef123'
+DRINKS = [('Gränges', 33, 5.3), ('Norrlands Guld', 50, 5.3), ('Explorer', 50, 7.5), ('Rosé', 15, 12.0),
+          ('Absolut', 4, 40.0), ('Cider', 33, 4.5)]
+
+
+@contextmanager
+def scratch_database(path=None):
+    """ Points the app at an empty SQLite database, a temporary one that is removed afterwards unless path is given"""
+    temporary = path is None
+    if temporary:
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.abspath(path)
+    try:
+        db.create_all()
+        yield path
+    finally:
+        db.session.remove()
+        db.get_engine(app).dispose()
+        if temporary:
+            os.unlink(path)
+
+
+def power_law_weights(n, alpha, rng):
+    """ Popularity of n users, Pareto distributed with shape alpha"""
+    return [rng.paretovariate(alpha) for _ in range(n)]
+
+
+def generate(users=200, posts=2000, likes=5000, comments=1000, alpha=1.2, seed=0):
+    """ Fills the database with users, follows, posts, likes and comments. Returns the users, most popular first"""
+    from db_functions import create_user, create_post, create_comment, follow_user
+    rng = random.Random(seed)
+    people = [create_user('user%d' % i, PASSWORD, 'user%d@student.liu.se' % i, rng.randint(50, 110),
+                          rng.choice(['male', 'female'])) for i in range(users)]
+    popularity = power_law_weights(users, alpha, rng)
+    people = [x for _, x in sorted(zip(popularity, people), key=lambda x: -x[0])]
+    popularity.sort(reverse=True)
+    scale = (users - 1) / popularity[0]
+    for user, weight in zip(people, popularity):
+        others = [x for x in people if x is not user]
+        for follower in rng.sample(others, min(len(others), max(1, int(weight * scale)))):
+            follow_user(follower, user)
+
+    activity = power_law_weights(users, alpha, rng)
+    post_ids = []
+    for author in rng.choices(people, weights=activity, k=posts):
+        name, volume, alcohol_percentage = rng.choice(DRINKS)
+        post_ids.append(create_post(name, volume, alcohol_percentage, author.user_id).post_id)
+
+    for i, user in enumerate(rng.choices(people, weights=activity, k=likes)):
+        user.like_post(Post.query.get(rng.choice(post_ids)))
+        if i % 1000 == 999:
+            db.session.commit()
+    db.session.commit()
+    for user in rng.choices(people, weights=activity, k=comments):
+        create_comment('Skål!', user.user_id, rng.choice(post_ids))
+    return people
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('database', help='SQLite file to fill')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--posts', type=int, default=2000)
+    parser.add_argument('--likes', type=int, default=5000)
+    parser.add_argument('--comments', type=int, default=1000)
+    parser.add_argument('--alpha', type=float, default=1.2)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    with scratch_database(args.database):
+        people = generate(args.users, args.posts, args.likes, args.comments, args.alpha, args.seed)
+        print(json.dumps({'users': len(people), 'posts': args.posts, 'likes': args.likes, 'comments': args.comments,
+                          'max_followers': follow_count(people[0].user_id, 'followers')}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
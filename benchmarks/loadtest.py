@@ -0,0 +1,83 @@
+""" Load test comparing the sync Flask app with the asyncio serving mode on the read endpoints.
+
+    gunicorn server:app -b :8000 -w 4
+    gunicorn async_server:web_app -b :8001 -w 4 --worker-class aiohttp.GunicornWebWorker
+    python -m benchmarks.loadtest http://localhost:8000 http://localhost:8001 --email bananer@student.liu.se \\
+        --password ABCdef123 --post <post_id>
+
+Logs in through the first url, then sends the same mix of profile, post, comments and followers requests to every
+url from many concurrent clients and prints requests per second and latency percentiles per url as JSON"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+
+import aiohttp
+import numpy as np
+
+
+async def login(session, url, email, password):
+    async with session.post(url + '/user/login', json={'email': email, 'password': password}) as rv:
+        rv.raise_for_status()
+        return (await rv.json())['token']
+
+
+async def run(session, url, paths, headers, requests, concurrency):
+    """ Sends requests GETs cycling through paths from concurrency clients, returns the latencies and error count"""
+    paths = itertools.islice(itertools.cycle(paths), requests)
+    latencies, errors = [], 0
+
+    async def client():
+        nonlocal errors
+        for path in paths:
+            start = time.perf_counter()
+            try:
+                async with session.get(url + path, headers=headers) as rv:
+                    await rv.read()
+                    if rv.status != 200:
+                        errors += 1
+            except aiohttp.ClientError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return latencies, errors, time.perf_counter() - start
+
+
+async def main_async(args):
+    paths = ['/user/' + args.email, '/user/followers', '/user/following']
+    if args.post:
+        paths += ['/post/' + args.post, '/post/%s/comment' % args.post]
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        headers = {'Authorization': 'Bearer ' + await login(session, args.urls[0], args.email, args.password)}
+        results = {}
+        for url in args.urls:
+            await run(session, url, paths, headers, args.warmup, args.concurrency)
+            latencies, errors, elapsed = await run(session, url, paths, headers, args.requests, args.concurrency)
+            latencies = np.array(latencies) * 1000
+            results[url] = {'requests': len(latencies),
+                            'errors': errors,
+                            'requests_per_second': len(latencies) / elapsed,
+                            'p50_ms': float(np.percentile(latencies, 50)),
+                            'p99_ms': float(np.percentile(latencies, 99))}
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('urls', nargs='+')
+    parser.add_argument('--email', required=True)
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--post', help='post_id to request, with its comments')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--warmup', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=50)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.get_event_loop().run_until_complete(main_async(args)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
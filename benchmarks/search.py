@@ -0,0 +1,73 @@
+""" Benchmarks user search before and after the trigram index.
+
+    python -m benchmarks.search --users 1000000
+
+Fills a scratch SQLite database with synthetic users and times the old leading wildcard LIKE scan against
+db_search_user for a few queries"""
+import argparse
+import json
+import os
+import random
+import string
+import tempfile
+import timeit
+
+from database import app, db, User
+from werkzeug.security import generate_password_hash
+
+SYLLABLES = ['ka', 'lo', 'ber', 'til', 'sven', 'ne', 'ma', 'ri', 'an', 'ders', 'jo', 'han', 'li', 'sa', 'ek']
+
+
+def fill_users(n, batch_size=10000):
+    password_hash = generate_password_hash('ABCdef123')
+    usernames = set()
+    while len(usernames) < n:
+        usernames.add(''.join(random.choice(SYLLABLES) for _ in range(random.randint(2, 4))) +
+                      ''.join(random.choice(string.digits) for _ in range(3)))
+    rows = []
+    for i, username in enumerate(usernames):
+        rows.append({'user_id': '%016d' % i, 'username': username, 'password_hash': password_hash, 'weight': 70,
+                     'gender': 'male', 'email': '%d@student.liu.se' % i, 'bio': None, 'fanout_on_read': False})
+        if len(rows) == batch_size:
+            db.session.execute(User.__table__.insert(), rows)
+            rows = []
+    if rows:
+        db.session.execute(User.__table__.insert(), rows)
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--queries', nargs='+', default=['ber', 'sven', 'anders', 'kalo1', 'xyz'])
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    from db_functions import db_search_user
+    try:
+        db.create_all()
+        fill_users(args.users)
+        results = {'users': args.users, 'queries': {}}
+        for seq in args.queries:
+            def before():
+                return [x.to_dict(('user_id', 'username', 'avatar'))
+                        for x in User.query.filter(User.username.contains(seq)).all()]
+
+            def after():
+                return db_search_user(seq)
+
+            results['queries'][seq] = {
+                'matches_before': len(before()),
+                'before_ms': min(timeit.repeat(before, number=1, repeat=args.repeat)) * 1000,
+                'after_ms': min(timeit.repeat(after, number=1, repeat=args.repeat)) * 1000}
+        print(json.dumps(results, indent=2))
+    finally:
+        db.session.remove()
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+""" Benchmark of the response encodings, see encoding.py.
+
+    python -m benchmarks.serialization --users 200 --posts 2000 --output serialization.json
+
+Serializes the payloads of the heaviest read routes, full profiles, timelines and follower lists of the most popular
+users of a seeded synthetic dataset (see benchmarks.datagen), and times encoding them with every available JSON backend
+and MessagePack, alone and followed by every available compression. Reports milliseconds and bytes per payload"""
+import argparse
+import json
+
+import encoding
+from benchmarks.datagen import generate, scratch_database
+from benchmarks.suite import commit, timed
+from database import db, Post, paginate
+from server import app
+
+
+def payloads(people, count):
+    """ The responses of profile, followed_posts and followers for the count most popular users"""
+    from db_functions import get_user_followers
+    ret = {'profile': [], 'followed_posts': [], 'followers': []}
+    for user in people[:count]:
+        ret['profile'].append(user.to_dict())
+        ret['followed_posts'].append([x.to_dict() for x in paginate(user.followed_posts(),
+                                                                    [Post.timestamp, Post.post_id])])
+        ret['followers'].append(get_user_followers(user.user_id, fields=('user_id', 'username', 'avatar')))
+    return ret
+
+
+def encoders():
+    ret = {'stdlib': encoding.stdlib_dumps}
+    if encoding.orjson is not None:
+        ret['orjson'] = encoding.orjson_dumps
+    if encoding.msgpack is not None:
+        ret['msgpack'] = encoding.dumps_msgpack
+    return ret
+
+
+def measure(values, number, repeat):
+    """ Encode and compression time and size of values, per value"""
+    ret = {}
+    for name, encode in encoders().items():
+        encoded = [encode(x) for x in values]
+        result = timed(lambda: [encode(x) for x in values], number, repeat)
+        result = {'encode_ms': result['best_ms'] / len(values), 'bytes': sum(map(len, encoded)) / len(values)}
+        for compression, compress in encoding.COMPRESSORS.items():
+            compressed = [compress(x) for x in encoded]
+            result[compression] = {'compress_ms': timed(lambda: [compress(x) for x in encoded], number,
+                                                        repeat)['best_ms'] / len(values),
+                                   'bytes': sum(map(len, compressed)) / len(values)}
+        ret[name] = result
+    return ret
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--posts', type=int, default=2000)
+    parser.add_argument('--likes', type=int, default=5000)
+    parser.add_argument('--comments', type=int, default=1000)
+    parser.add_argument('--profiles', type=int, default=20, help='most popular users to serialize')
+    parser.add_argument('--number', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='also write the results to this file')
+    args = parser.parse_args()
+    with app.app_context(), scratch_database():
+        people = generate(args.users, args.posts, args.likes, args.comments, seed=args.seed)
+        routes = payloads(people, args.profiles)
+        db.session.rollback()
+    results = {'commit': commit(),
+               'dataset': {'users': args.users, 'posts': args.posts, 'likes': args.likes, 'comments': args.comments,
+                           'seed': args.seed, 'profiles': args.profiles},
+               'config': {'gzip_level': app.config['GZIP_LEVEL'], 'brotli_quality': app.config['BROTLI_QUALITY']},
+               'routes': {name: measure(values, args.number, args.repeat) for name, values in routes.items()}}
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+""" Benchmark suite of the API, for tracking performance between commits.
+
+    python -m benchmarks.suite --users 200 --posts 2000 --output results.json
+
+Generates a synthetic dataset (see benchmarks.datagen) in a scratch SQLite database, times the hot helpers and then
+drives a mix of read and write requests through the Flask test client. Everything is seeded, so two runs on the same
+machine differ only in the code under test. The JSON result carries the commit it was measured on"""
+import argparse
+import json
+import platform
+import random
+import statistics
+import subprocess
+import time
+import timeit
+
+from benchmarks.datagen import PASSWORD, generate, scratch_database
+from database import db, follow_count, is_following, paginate, Post
+from server import app
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def timed(f, number, repeat):
+    """ Milliseconds per call of f, best and median of repeat runs of number calls"""
+    runs = [x / number * 1000 for x in timeit.repeat(f, number=number, repeat=repeat)]
+    return {'best_ms': min(runs), 'median_ms': statistics.median(runs)}
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    return {'requests': len(latencies),
+            'p50_ms': latencies[len(latencies) // 2] * 1000,
+            'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000}
+
+
+def micro_benchmarks(people, repeat):
+    from db_functions import db_search_user, generate_id, is_post_id
+    popular, follower = people[0], max(people, key=lambda x: follow_count(x.user_id, 'followed'))
+    post = Post.query.first()
+    benchmarks = {'user_to_dict': (lambda: popular.to_dict(), 10),
+                  'post_to_dict': (lambda: post.to_dict(), 100),
+                  'followed_posts': (lambda: paginate(follower.followed_posts(), [Post.timestamp, Post.post_id]), 10),
+                  'db_search_user': (lambda: db_search_user('user1'), 10),
+                  'is_following': (lambda: is_following(follower.user_id, popular.user_id), 1000),
+                  'generate_id': (lambda: generate_id(is_post_id), 1000)}
+    ret = {}
+    for name, (f, number) in benchmarks.items():
+        ret[name] = timed(f, number, repeat)
+        db.session.rollback()
+    return ret
+
+
+def load(people, requests, clients, seed):
+    """ Sends a seeded mix of requests from clients logged in users through the test client. Reports latency and the
+    query count from the Server-Timing header per endpoint, and the overall throughput"""
+    rng = random.Random(seed)
+    client = app.test_client()
+    post_ids = [x for (x,) in db.session.query(Post.post_id)]
+    # every request ends the session, so only plain values are kept
+    emails = [x.email for x in people]
+    sessions = []
+    for email in rng.sample(emails, min(clients, len(emails))):
+        rv = client.post('/user/login', json={'email': email, 'password': PASSWORD})
+        sessions.append((email, {'Authorization': 'Bearer ' + rv.get_json()['token']}))
+    mix = [('profile', 'GET', lambda email: '/user/%s?fields=user_id,username,avatar,bio' % emails[0]),
+           ('full_profile', 'GET', lambda email: '/user/' + rng.choice(emails)),
+           ('followed_posts', 'GET', lambda email: '/user/%s/followed_posts' % email),
+           ('post', 'GET', lambda email: '/post/' + rng.choice(post_ids)),
+           ('comments', 'GET', lambda email: '/post/%s/comment' % rng.choice(post_ids)),
+           ('followers', 'GET', lambda email: '/user/followers?fields=user_id,username'),
+           ('search', 'GET', lambda email: '/user/search/user1'),
+           ('like', 'GET', lambda email: '/post/%s/like' % rng.choice(post_ids)),
+           ('create_post', 'POST', lambda email: '/post')]
+    weights = [20, 5, 25, 15, 10, 5, 5, 10, 5]
+    latencies, queries, errors = {}, {}, 0
+    start = time.perf_counter()
+    for _ in range(requests):
+        name, method, path = rng.choices(mix, weights=weights)[0]
+        email, headers = rng.choice(sessions)
+        request_start = time.perf_counter()
+        if method == 'POST':
+            rv = client.post(path(email), headers=headers,
+                             json={'drink_name': 'Gränges', 'volume': 33, 'alcohol_percentage': 5.3})
+        else:
+            rv = client.get(path(email), headers=headers)
+        latencies.setdefault(name, []).append(time.perf_counter() - request_start)
+        if rv.status_code >= 400:
+            errors += 1
+        timing = rv.headers.get('Server-Timing')
+        if timing:
+            queries.setdefault(name, []).append(int(timing.split('desc="')[1].split()[0]))
+    elapsed = time.perf_counter() - start
+    endpoints = {}
+    for name, values in latencies.items():
+        endpoints[name] = percentiles(values)
+        if name in queries:
+            endpoints[name]['queries'] = max(queries[name])
+    return {'requests': requests, 'errors': errors, 'requests_per_second': requests / elapsed,
+            'endpoints': endpoints}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--posts', type=int, default=2000)
+    parser.add_argument('--likes', type=int, default=5000)
+    parser.add_argument('--comments', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='also write the results to this file')
+    args = parser.parse_args()
+    app.config['QUERY_PROFILING'] = True
+    with scratch_database():
+        start = time.perf_counter()
+        people = generate(args.users, args.posts, args.likes, args.comments, seed=args.seed)
+        results = {'commit': commit(),
+                   'python': platform.python_version(),
+                   'dataset': {'users': args.users, 'posts': args.posts, 'likes': args.likes,
+                               'comments': args.comments, 'seed': args.seed,
+                               'generate_seconds': time.perf_counter() - start},
+                   'micro': micro_benchmarks(people, args.repeat),
+                   'load': load(people, args.requests, args.clients, args.seed)}
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+""" Bulk import and export of users, posts and follows as NDJSON or CSV. Rows are streamed and written in batches of
+one executemany per table and one transaction per batch, so memory use does not grow with the size of the file"""
+from db_functions import *
+import csv
+from itertools import islice
+
+
+def _optional(convert):
+    return lambda x: None if x is None or x == '' else convert(x)
+
+
+def _timestamp(value):
+    return value if isinstance(value, datetime) else parse_datetime(value)
+
+
+# Columns of each kind of row and how to read them from CSV, where every value is a string
+COLUMNS = {
+    'users': [('user_id', str), ('username', str), ('password_hash', str), ('weight', int), ('gender', str),
+              ('email', str), ('bio', _optional(str))],
+    'posts': [('post_id', str), ('timestamp', _timestamp), ('drink_name', _optional(str)), ('volume', float),
+              ('alcohol_percentage', float), ('author_id', str)],
+    'follows': [('follower_id', str), ('followed_id', str)]}
+
+
+def read_rows(fp, fmt):
+    """ Yields the rows of an NDJSON or CSV file as dicts"""
+    if fmt == 'csv':
+        yield from csv.DictReader(fp)
+    else:
+        for line in fp:
+            if line.strip():
+                yield json.loads(line)
+
+
+def write_rows(rows, fp, fmt, kind):
+    """ Writes dicts as NDJSON or CSV, one row at a time"""
+    if fmt == 'csv':
+        writer = csv.DictWriter(fp, [name for name, _ in COLUMNS[kind]])
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        for row in rows:
+            fp.write(json.dumps(row) + '\n')
+
+
+def batches(rows, batch_size):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+class BadRow(ValueError):
+    pass
+
+
+def _convert(row, kind, number):
+    """ Reads row, the number'th of the file counting from 1, or raises BadRow telling which row is wrong"""
+    try:
+        return {name: _optional(convert)(row.get(name)) for name, convert in COLUMNS[kind]}
+    except (TypeError, ValueError) as e:
+        raise BadRow('%s row %d: %s' % (kind, number, e))
+
+
+def import_users(rows, batch_size=1000):
+    """ Inserts users and their self follows. Rows carry either a password_hash or a plain password, which is hashed,
+    and get a generated user_id if they have none. Returns the number of imported users"""
+    count = 0
+    for batch in batches(rows, batch_size):
+        users = [_convert(row, 'users', count + i) for i, row in enumerate(batch, 1)]
+        for i, (user, row) in enumerate(zip(users, batch), 1):
+            if user['password_hash'] is None and not row.get('password'):
+                raise BadRow('users row %d: neither password nor password_hash' % (count + i))
+        unhashed = [(user, row['password']) for user, row in zip(users, batch) if user['password_hash'] is None]
+        for (user, _), password_hash in zip(unhashed, hash_passwords([x for _, x in unhashed])):
+            user['password_hash'] = password_hash
+        for user in users:
+            user['user_id'] = user['user_id'] or generate_id()
+            user['fanout_on_read'] = False
+            user['token_version'] = 0
+        db.session.execute(User.__table__.insert(), users)
+        db.session.execute(followers.insert(), [{'follower_id': x['user_id'], 'followed_id': x['user_id']}
+                                                for x in users])
+        db.session.commit()
+        count += len(users)
+    return count
+
+
+def import_posts(rows, batch_size=1000):
+    """ Inserts posts and fans each batch out into the timelines of the followers of their authors. Returns the number
+    of imported posts"""
+    count = 0
+    for batch in batches(rows, batch_size):
+        posts = []
+        for i, row in enumerate(batch, 1):
+            post = _convert(row, 'posts', count + i)
+            post['post_id'] = post['post_id'] or generate_id()
+            post['timestamp'] = post['timestamp'] or datetime.utcnow()
+            post['like_count'] = 0
+            post['comment_count'] = 0
+            posts.append(post)
+        db.session.execute(Post.__table__.insert(), posts)
+        fan_out_posts([x['post_id'] for x in posts])
+        add_to_rollups([(x['author_id'], x['timestamp'], x['volume'], x['alcohol_percentage']) for x in posts])
+        db.session.commit()
+        count += len(posts)
+    bac_states.clear()
+    return count
+
+
+def import_follows(rows, batch_size=1000, rebuild_timelines=True):
+    """ Inserts follow edges. Timelines are rebuilt once at the end rather than per edge, pass
+    rebuild_timelines=False when posts are imported afterwards anyway. Returns the number of imported edges"""
+    count = 0
+    for batch in batches(rows, batch_size):
+        db.session.execute(followers.insert(), [_convert(row, 'follows', count + i) for i, row in enumerate(batch, 1)])
+        db.session.commit()
+        count += len(batch)
+    follower_graph.clear()
+    if rebuild_timelines:
+        backfill_timeline()
+    return count
+
+
+IMPORTERS = {'users': import_users, 'posts': import_posts, 'follows': import_follows}
+
+
+def export_rows(kind, batch_size=1000):
+    """ Yields every user, post or follow edge as a dict, streamed from the database batch_size rows at a time"""
+    names = [name for name, _ in COLUMNS[kind]]
+    table = {'users': User.__table__, 'posts': Post.__table__, 'follows': followers}[kind]
+    query = db.session.query(*[table.c[x] for x in names]).order_by(*table.primary_key.columns)
+    for row in query.yield_per(batch_size):
+        row = dict(zip(names, row))
+        if 'timestamp' in row:
+            row['timestamp'] = row['timestamp'].isoformat()
+        yield row
@@ -0,0 +1,273 @@
+import hashlib
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:  # only needed when CACHE_URL points at a redis server
+    redis = None
+
+
+class LRUCache:
+    """ Bounded in-process cache. Least recently used entries are evicted once maxsize is reached, and entries can
+    carry an absolute expiry time in seconds since the epoch"""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires_at=None):
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def incr(self, key, expires_at=None):
+        """ Adds one to the count stored at key and returns it. A missing or expired count starts over at one and
+        expires at expires_at"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (entry[1] is not None and entry[1] <= time.time()):
+                entry = (0, expires_at)
+            self._entries[key] = (entry[0] + 1, entry[1])
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            return entry[0] + 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class BloomFilter:
+    """ Set of strings in a fixed number of bits. Membership tests can give false positives, never false negatives"""
+
+    def __init__(self, bits=2 ** 20, hashes=7):
+        self.bits = bits
+        self.hashes = hashes
+        self._array = bytearray((bits + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:16], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, key):
+        for x in self._positions(key):
+            self._array[x >> 3] |= 1 << (x & 7)
+
+    def __contains__(self, key):
+        return all(self._array[x >> 3] & (1 << (x & 7)) for x in self._positions(key))
+
+
+class FollowerGraph:
+    """ Follow edges between users. Every user id is interned as a number, and the entry of a user holds the users
+    they follow and the users following them as arrays of numbers sorted by user id, a few bytes per edge. Like
+    LRUCache entries can carry an absolute expiry time, and also a token telling which version of the user they were
+    loaded for"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._numbers = {}
+        self._user_ids = []
+        self._entries = {}
+
+    def _number(self, user_id):
+        number = self._numbers.get(user_id)
+        if number is None:
+            number = self._numbers[user_id] = len(self._user_ids)
+            self._user_ids.append(user_id)
+        return number
+
+    def _array(self, user_ids):
+        return array('L', [self._number(x) for x in sorted(set(user_ids))])
+
+    def _search(self, numbers, user_id):
+        """ Index of the first number in numbers whose user id does not sort before user_id"""
+        lo, hi = 0, len(numbers)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._user_ids[numbers[mid]] < user_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def set(self, user_id, followed_ids, follower_ids, token=None, expires_at=None):
+        with self._lock:
+            self._entries[self._number(user_id)] = [self._array(followed_ids), self._array(follower_ids), token,
+                                                    expires_at]
+
+    def load(self, edges, expires_at=None):
+        """ Replaces the whole graph with (follower_id, followed_id) edges. Every user in an edge gets an entry, a user
+        following themselves only that"""
+        followed, follower = {}, {}
+        for follower_id, followed_id in edges:
+            if follower_id == followed_id:
+                followed.setdefault(follower_id, [])
+                continue
+            followed.setdefault(follower_id, []).append(followed_id)
+            follower.setdefault(followed_id, []).append(follower_id)
+        with self._lock:
+            self._entries = {}
+            for user_id in sorted(set(followed) | set(follower)):
+                self._entries[self._number(user_id)] = [self._array(followed.get(user_id, ())),
+                                                        self._array(follower.get(user_id, ())), None, expires_at]
+
+    def _entry(self, user_id):
+        number = self._numbers.get(user_id)
+        return None if number is None else self._entries.get(number)
+
+    def is_current(self, user_id, token=None):
+        """ Whether the entry of user_id is loaded, unexpired and of version token"""
+        with self._lock:
+            entry = self._entry(user_id)
+            return entry is not None and entry[2] == token and (entry[3] is None or entry[3] > time.time())
+
+    def set_token(self, user_id, token):
+        with self._lock:
+            entry = self._entry(user_id)
+            if entry is not None:
+                entry[2] = token
+
+    def discard(self, user_id):
+        with self._lock:
+            number = self._numbers.get(user_id)
+            self._entries.pop(number, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def add_edge(self, follower_id, followed_id):
+        """ Adds an edge to the entries of both users that are loaded"""
+        with self._lock:
+            follower, followed = self._number(follower_id), self._number(followed_id)
+            for number, side, other, other_id in [(follower, 0, followed, followed_id),
+                                                  (followed, 1, follower, follower_id)]:
+                entry = self._entries.get(number)
+                if entry is not None:
+                    i = self._search(entry[side], other_id)
+                    if i == len(entry[side]) or entry[side][i] != other:
+                        entry[side].insert(i, other)
+
+    def remove_edge(self, follower_id, followed_id):
+        """ Removes an edge from the entries of both users that are loaded"""
+        with self._lock:
+            follower, followed = self._number(follower_id), self._number(followed_id)
+            for number, side, other, other_id in [(follower, 0, followed, followed_id),
+                                                  (followed, 1, follower, follower_id)]:
+                entry = self._entries.get(number)
+                if entry is not None:
+                    i = self._search(entry[side], other_id)
+                    if i < len(entry[side]) and entry[side][i] == other:
+                        del entry[side][i]
+
+    def follows(self, follower_id, followed_id):
+        """ Whether follower_id follows followed_id, from the entry of follower_id"""
+        with self._lock:
+            numbers = self._entry(follower_id)[0]
+            other = self._numbers.get(followed_id)
+            if other is None:
+                return False
+            i = self._search(numbers, followed_id)
+            return i < len(numbers) and numbers[i] == other
+
+    def count(self, user_id, relation):
+        """ Number of users followed by user_id, or following user_id with relation 'followers'"""
+        with self._lock:
+            return len(self._entry(user_id)[relation == 'followers'])
+
+    def user_ids(self, user_id, relation):
+        """ The users followed by user_id, or following user_id with relation 'followers'"""
+        with self._lock:
+            return [self._user_ids[x] for x in self._entry(user_id)[relation == 'followers']]
+
+    def mutual(self, user_id):
+        """ The users that user_id follows and is followed by"""
+        with self._lock:
+            followed, follower = self._entry(user_id)[:2]
+            return sorted(self._user_ids[x] for x in set(followed).intersection(follower))
+
+    def page(self, user_id, relation, before=None, limit=50):
+        """ The limit largest user ids of user_ids that sort before before, largest first"""
+        with self._lock:
+            numbers = self._entry(user_id)[relation == 'followers']
+            end = len(numbers) if before is None else self._search(numbers, before)
+            return [self._user_ids[numbers[i]] for i in range(end - 1, max(end - limit, 0) - 1, -1)]
+
+
+class MemoryBackend:
+    """ Shared cache backend living in this process. Stands in for redis in tests and single worker deployments"""
+
+    def __init__(self):
+        self._cache = LRUCache(maxsize=100000)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value, ttl=None):
+        self._cache.set(key, value, None if ttl is None else time.time() + ttl)
+
+    def incr(self, key, ttl=None):
+        return self._cache.incr(key, None if ttl is None else time.time() + ttl)
+
+    def delete(self, key):
+        self._cache.delete(key)
+
+
+class RedisBackend:
+    """ Shared cache backend seen by every worker, values are stored as strings"""
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError('CACHE_URL %s needs the redis package' % url)
+        self._redis = redis.StrictRedis.from_url(url, decode_responses=True)
+
+    def get(self, key):
+        return self._redis.get(key)
+
+    def set(self, key, value, ttl=None):
+        self._redis.set(key, value, ex=None if ttl is None else max(1, int(ttl)))
+
+    def incr(self, key, ttl=None):
+        count = self._redis.incr(key)
+        if count == 1 and ttl is not None:
+            self._redis.expire(key, max(1, int(ttl)))
+        return count
+
+    def delete(self, key):
+        self._redis.delete(key)
+
+
+def connect_backend(url):
+    """ Returns the shared backend for url, 'memory://' or 'redis://...', or None if url is empty"""
+    if not url:
+        return None
+    if url.startswith('memory://'):
+        return MemoryBackend()
+    return RedisBackend(url)
@@ -1,10 +1,24 @@
-from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask, has_app_context
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
 import os
 from flask_jwt import *
 from flask_jwt_extended import *
-from werkzeug.security import generate_password_hash
 from hashlib import md5
+from werkzeug.security import generate_password_hash
+import base64
+import binascii
+import json
+from cache import connect_backend, FollowerGraph, LRUCache
+from contextlib import contextmanager
+from functools import wraps
+import random
+import sqlite3
+from sqlalchemy import DDL, event, exc, orm
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+import threading
+import time
+from sqlalchemy.dialects import postgresql
 
 
 app = Flask(__name__)
@@ -13,28 +27,300 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 if 'NAMESPACE' in os.environ and os.environ['NAMESPACE'] == 'heroku':
     db_uri = os.environ['DATABASE_URL']
     debug_flag = False
+    proxy_count = 1
 else:  # when running locally with sqlite
     db_path = os.path.join(os.path.dirname(__file__), 'app.db')
     db_uri = 'sqlite:///{}'.format(db_path)
     debug_flag = True
+    proxy_count = 0
 
 app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
 
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'bananer i pyjamas')
 app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(minutes=60)
 app.config['JWT_BLACKLIST_ENABLED'] = True
+# Authors with more followers than this are no longer fanned out on write, their posts are merged in on read instead
+app.config['TIMELINE_FANOUT_LIMIT'] = int(os.environ.get('TIMELINE_FANOUT_LIMIT', 1000))
+app.config['BAC_HISTORY_HOURS'] = 48
+app.config['BAC_CACHE_SIZE'] = 100000
+app.config['BAC_SERIES_MAX_POINTS'] = 1000
+app.config['BAC_CACHE_TTL'] = 60
+app.config['ID_GENERATOR'] = os.environ.get('ID_GENERATOR', 'time')
+app.config['PAGE_SIZE'] = 50
+# Shared cache seen by all workers, 'memory://' or a redis url. Without it every worker only has its own caches
+app.config['CACHE_URL'] = os.environ.get('CACHE_URL')
+app.config['BLACKLIST_CACHE_SIZE'] = 100000
+# How long a worker trusts its own memory of a token not being blacklisted when there is no shared cache
+app.config['BLACKLIST_CACHE_TTL'] = 60
+app.config['BLACKLIST_PRUNE_INTERVAL'] = 3600
+# How single tokens are revoked. 'blacklist' looks up every unknown jti in the Blacklist table. 'version' only checks
+# the token_version claim against the users cached version, and with TOKEN_JTI_FILTER a Bloom filter of recently
+# blacklisted jtis that is rebuilt every BLACKLIST_CACHE_TTL seconds. Without the filter a logout revokes every token
+# of the user, as /user/logout/all always does
+app.config['TOKEN_REVOCATION'] = os.environ.get('TOKEN_REVOCATION', 'blacklist')
+app.config['TOKEN_JTI_FILTER'] = os.environ.get('TOKEN_JTI_FILTER', '1') == '1'
+app.config['TOKEN_FILTER_BITS'] = 2 ** 20
+app.config['TOKEN_VERSION_CACHE_SIZE'] = 100000
+# User deletion works through the rows of a user DELETE_BATCH_SIZE at a time, committing and sleeping
+# DELETE_BATCH_PAUSE seconds after every batch so concurrent requests are not held up by long transactions. Users with
+# more than DELETE_BACKGROUND_THRESHOLD likes, comments, posts, follows and timeline entries are deleted on a
+# background thread, see remove_user
+app.config['DELETE_BATCH_SIZE'] = 500
+app.config['DELETE_BATCH_PAUSE'] = 0.0
+app.config['DELETE_BACKGROUND_THRESHOLD'] = 2000
+# Password hashing processes per worker, see passwords.py
+app.config['HASH_WORKERS'] = int(os.environ.get('HASH_WORKERS', 2))
+app.config['HASH_QUEUE_SIZE'] = int(os.environ.get('HASH_QUEUE_SIZE', 32))
+app.config['HASH_TIMEOUT'] = 10
+# Failed logins allowed per account from one client address, and per client address, within LOGIN_WINDOW seconds.
+# After that logins are refused without looking at the password until the window has passed. Failures from one
+# address do not lock the owner of the account out on another
+app.config['LOGIN_WINDOW'] = 300
+app.config['LOGIN_MAX_ACCOUNT_FAILURES'] = 5
+app.config['LOGIN_MAX_IP_FAILURES'] = 50
+# Proxies in front of the app that append to X-Forwarded-For, the heroku router. The client address is taken from that
+# header instead of the address of the last proxy
+app.config['PROXY_COUNT'] = int(os.environ.get('PROXY_COUNT', proxy_count))
+# Serialized /post responses. Changes made through this worker drop them at once, changes through other workers when
+# a shared cache is configured, and anything else after POST_CACHE_TTL seconds
+app.config['POST_CACHE_SIZE'] = 10000
+app.config['POST_CACHE_TTL'] = 60
+# Most drinks logged by one POST /posts/batch
+app.config['POST_BATCH_SIZE'] = 50
+app.config['MAX_PAGE_SIZE'] = 200
+# Follow checks, counts and follower lists are answered from a graph of the follow edges held by every worker. Users
+# are reloaded from the database FOLLOWER_GRAPH_TTL seconds after they were loaded, or right after a change through
+# another worker when there is a shared cache. Without one a worker would not see follows made through the others for
+# up to FOLLOWER_GRAPH_TTL seconds, so the graph is only on by default when CACHE_URL is set
+app.config['FOLLOWER_GRAPH'] = os.environ.get('FOLLOWER_GRAPH', '1' if app.config['CACHE_URL'] else '0') == '1'
+app.config['FOLLOWER_GRAPH_TTL'] = 300
+# Response encoding, see encoding.py. JSON_BACKEND is 'orjson' or 'stdlib', unset picks orjson when it is installed
+app.config['JSON_BACKEND'] = os.environ.get('JSON_BACKEND')
+app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+app.config['GZIP_LEVEL'] = 6
+app.config['BROTLI_QUALITY'] = 4
+# Rows fetched per round trip by list endpoints streamed with ?stream=json or ?stream=ndjson, which return the whole
+# list instead of a page
+app.config['STREAM_BATCH_SIZE'] = 100
+# Connection pool of each worker process. A deployment opens up to workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW)
+# connections, which has to stay below the connection limit of the database. With DB_PGBOUNCER set connections are
+# opened per checkout and left to PgBouncer (in transaction pooling mode) to pool
+app.config['SQLALCHEMY_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))
+app.config['SQLALCHEMY_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+app.config['SQLALCHEMY_POOL_TIMEOUT'] = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+app.config['SQLALCHEMY_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+app.config['DB_POOL_PRE_PING'] = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+app.config['DB_PGBOUNCER'] = os.environ.get('DB_PGBOUNCER', '0') == '1'
+# Read replicas, comma separated database urls. The getters marked read_replica read from a random one of them, unless
+# the session has written or the user wrote within REPLICA_STICKY_SECONDS, which should cover the replication lag
+app.config['SQLALCHEMY_BINDS'] = {'replica%d' % i: x for i, x in
+                                  enumerate(x for x in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if x)}
+app.config['REPLICA_BINDS'] = sorted(app.config['SQLALCHEMY_BINDS'])
+app.config['REPLICA_STICKY_SECONDS'] = float(os.environ.get('REPLICA_STICKY_SECONDS', 10))
+app.config['REPLICA_STICKY_CACHE_SIZE'] = 100000
+# Query counts, database time and the query budgets of requests, see profiling.py
+app.config['QUERY_PROFILING'] = os.environ.get('QUERY_PROFILING', '0') == '1'
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 100))
+# /internal/stats answers only requests with this token in the X-Stats-Token header, and is off when it is unset
+app.config['STATS_TOKEN'] = os.environ.get('STATS_TOKEN')
 jwt = JWTManager(app)
 
 # TODO: Fix DeprecationWarning: The verify parameter is deprecated. Please use options instead.
 #  'Please use options instead.', DeprecationWarning
 
 
-db = SQLAlchemy(app)
+class PoolStats:
+    """ Counters of the connection pools of this process. Waits are the time spent getting a connection out of the
+    pool, including opening a new one"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.connects = 0
+            self.timeouts = 0
+            self.wait_seconds = 0.0
+            self.max_wait_seconds = 0.0
+
+    def record_checkout(self, wait, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+
+    def record_connect(self):
+        with self._lock:
+            self.connects += 1
+
+
+pool_stats = PoolStats()
+
+
+class InstrumentedPool:
+    """ Mixin recording checkouts and connects of a pool class in pool_stats"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            pool_stats.record_checkout(time.perf_counter() - start, timed_out=True)
+            raise
+        pool_stats.record_checkout(time.perf_counter() - start)
+        return connection
+
+    def _create_connection(self):
+        pool_stats.record_connect()
+        return super()._create_connection()
+
+
+_instrumented_pools = {}
+
+
+def instrumented(poolclass):
+    if poolclass not in _instrumented_pools:
+        _instrumented_pools[poolclass] = type('Instrumented' + poolclass.__name__, (InstrumentedPool, poolclass), {})
+    return _instrumented_pools[poolclass]
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy taking pre-ping and PgBouncer mode from the config, with instrumented pools and sessions that
+    can read from replicas"""
+
+    def apply_driver_hacks(self, app, info, options):
+        pool_options = ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle')
+        if info.drivername.startswith('sqlite') or app.config['DB_PGBOUNCER']:
+            for x in pool_options:
+                options.pop(x, None)
+        super().apply_driver_hacks(app, info, options)
+        if info.drivername.startswith('sqlite'):
+            # a SQLite file is opened per checkout, in memory databases keep their single connection
+            options['poolclass'] = instrumented(options.get('poolclass', NullPool))
+        elif app.config['DB_PGBOUNCER']:
+            options['poolclass'] = instrumented(NullPool)
+        else:
+            options['poolclass'] = instrumented(QueuePool)
+            options['pool_pre_ping'] = app.config['DB_POOL_PRE_PING']
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+_replica_reads = threading.local()
+
+
+@contextmanager
+def replica_reads():
+    """ Lets the reads within go to a replica"""
+    _replica_reads.depth = getattr(_replica_reads, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _replica_reads.depth -= 1
+
+
+@contextmanager
+def primary_reads():
+    """ Sends the reads within to the primary, also inside replica_reads"""
+    depth, _replica_reads.depth = getattr(_replica_reads, 'depth', 0), 0
+    try:
+        yield
+    finally:
+        _replica_reads.depth = depth
+
+
+def read_replica(f):
+    """ Decorator for functions that only read, and can do so from a replica"""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        with replica_reads():
+            return f(*args, **kwargs)
+    return wrapper
+
+
+sticky_writers = LRUCache(app.config['REPLICA_STICKY_CACHE_SIZE'])
+
+
+def current_writer():
+    return get_jwt_identity() if has_app_context() else None
+
+
+def mark_writer(user_id):
+    """ Sends the reads of user_id to the primary for REPLICA_STICKY_SECONDS, in every worker if there is a shared
+    cache"""
+    if not app.config['REPLICA_BINDS']:
+        return
+    seconds = app.config['REPLICA_STICKY_SECONDS']
+    sticky_writers.set(user_id, True, time.time() + seconds)
+    shared = get_shared_cache()
+    if shared is not None:
+        shared.set('sticky:' + user_id, b'1', max(1, int(seconds + 0.5)))
+
+
+def is_sticky_writer(user_id):
+    if sticky_writers.get(user_id):
+        return True
+    shared = get_shared_cache()
+    return shared is not None and shared.get('sticky:' + user_id) is not None
+
+
+class RoutingSession(SignallingSession):
+    """ Session reading from a replica within replica_reads. Writes, and every read after a write or by a user who
+    recently wrote, go to the primary"""
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info['wrote'] = True
+        elif (getattr(_replica_reads, 'depth', 0) and self.app.config['REPLICA_BINDS']
+              and not self.info.get('wrote') and not self._replica_pinned()):
+            return db.get_engine(self.app, bind=random.choice(self.app.config['REPLICA_BINDS']))
+        return super().get_bind(mapper, clause)
+
+    def _replica_pinned(self):
+        user_id = current_writer()
+        return user_id is not None and is_sticky_writer(user_id)
+
+
+db = PooledSQLAlchemy(app)
+
+
+@event.listens_for(db.session, 'after_commit')
+def remember_writer(session):
+    # the session itself stays on the primary until it is removed at the end of the request
+    user_id = current_writer()
+    if session.info.get('wrote') and user_id is not None:
+        mark_writer(user_id)
+
+
+def pool_status():
+    """ Configuration, state and counters of the connection pool of this worker"""
+    pool = db.engine.pool
+    ret = {'pid': os.getpid(),
+           'pool': type(pool).__name__,
+           'checkouts': pool_stats.checkouts,
+           'connects': pool_stats.connects,
+           'timeouts': pool_stats.timeouts,
+           'wait_seconds': pool_stats.wait_seconds,
+           'max_wait_seconds': pool_stats.max_wait_seconds}
+    if isinstance(pool, QueuePool):
+        ret.update({'size': pool.size(),
+                    'max_overflow': pool._max_overflow,
+                    'checked_out': pool.checkedout(),
+                    'checked_in': pool.checkedin(),
+                    'overflow': pool.overflow()})
+    return ret
 
 
 followers = db.Table('followers',
                      db.Column('follower_id', db.String(16), db.ForeignKey('user.user_id'), primary_key=True),
-                     db.Column('followed_id', db.String(16), db.ForeignKey('user.user_id'), primary_key=True))
+                     db.Column('followed_id', db.String(16), db.ForeignKey('user.user_id'), primary_key=True),
+                     db.Index('ix_followers_followed_id_follower_id', 'followed_id', 'follower_id'))
 
 liked_posts = db.Table('liked_posts',
                        db.Column('user_id', db.String(16), db.ForeignKey('user.user_id'), primary_key=True),
@@ -45,6 +331,184 @@ comments = db.Table('comments',
                     db.Column('post_id', db.String(16), db.ForeignKey('post.post_id'), primary_key=True),
                     db.Column('comment_id', db.String(16), db.ForeignKey('comment.comment_id'), primary_key=True))
 
+# Materialized home timelines, one row per (reader, post). Written by create_post, read by User.followed_posts
+timeline = db.Table('timeline',
+                    db.Column('user_id', db.String(16), db.ForeignKey('user.user_id'), primary_key=True),
+                    db.Column('post_id', db.String(16), db.ForeignKey('post.post_id'), primary_key=True),
+                    db.Column('author_id', db.String(16), db.ForeignKey('user.user_id'), nullable=False),
+                    db.Column('timestamp', db.DateTime, nullable=False),
+                    db.Index('ix_timeline_user_id_timestamp_post_id', 'user_id', 'timestamp', 'post_id'))
+
+
+# Standard drinks per user and hour, day and week. Maintained by create_post, read by leaderboards.py
+consumption = db.Table('consumption',
+                       db.Column('user_id', db.String(16), db.ForeignKey('user.user_id'), primary_key=True),
+                       db.Column('period', db.String(8), primary_key=True),
+                       db.Column('bucket', db.DateTime, primary_key=True),
+                       db.Column('units', db.Float, nullable=False),
+                       db.Index('ix_consumption_period_bucket_units', 'period', 'bucket', 'units'))
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class Page(list):
+    """ One page of a keyset paginated list. next_cursor is None on the last page"""
+
+    def __init__(self, items=(), next_cursor=None):
+        super().__init__(items)
+        self.next_cursor = next_cursor
+
+    def map(self, f):
+        return Page((f(x) for x in self), self.next_cursor)
+
+
+def encode_cursor(values):
+    """ Packs the sort key of the last row on a page into an opaque string"""
+    values = [x.isoformat() if isinstance(x, datetime) else x for x in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, keys):
+    """ Unpacks a cursor made by encode_cursor into values comparable with the columns in keys"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        if not isinstance(values, list) or len(values) != len(keys):
+            raise InvalidCursor(cursor)
+        return [parse_datetime(value) if isinstance(key.type, db.DateTime) else value
+                for key, value in zip(keys, values)]
+    except (binascii.Error, UnicodeError, TypeError, ValueError):
+        raise InvalidCursor(cursor)
+
+
+def parse_datetime(value):
+    if '.' in value:
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+
+
+def _after(keys, values, descending):
+    """ Builds the keyset condition (k1, k2, ...) < (v1, v2, ...), or > when ascending"""
+    key, value = keys[0], values[0]
+    beyond = key < value if descending else key > value
+    if len(keys) == 1:
+        return beyond
+    return db.or_(beyond, db.and_(key == value, _after(keys[1:], values[1:], descending)))
+
+
+def page_limit(limit):
+    """ Clamps a requested page size to between 1 and MAX_PAGE_SIZE, PAGE_SIZE if none was requested"""
+    return max(1, min(limit or app.config['PAGE_SIZE'], app.config['MAX_PAGE_SIZE']))
+
+
+def keyset(query, keys, cursor=None, limit=None, descending=True):
+    """ Orders query by the columns in keys, the last of which has to be unique, and limits it to the page after
+    cursor. The query fetches one row more than the page size to tell whether there is a next page, see to_page"""
+    if cursor is not None:
+        query = query.filter(_after(keys, decode_cursor(cursor, keys), descending))
+    query = query.order_by(None).order_by(*[x.desc() if descending else x.asc() for x in keys])
+    return query.limit(page_limit(limit) + 1)
+
+
+def to_page(rows, keys, limit=None):
+    """ Turns the rows fetched by a keyset query into a Page"""
+    limit = page_limit(limit)
+    if len(rows) <= limit:
+        return Page(rows)
+    return Page(rows[:limit], encode_cursor([getattr(rows[limit - 1], x.key) for x in keys]))
+
+
+def paginate(query, keys, cursor=None, limit=None, descending=True):
+    """ Returns one Page of query ordered by the columns in keys, the last of which has to be unique. cursor is the
+    next_cursor of the previous page, limit is clamped to MAX_PAGE_SIZE"""
+    return to_page(keyset(query, keys, cursor, limit, descending).all(), keys, limit)
+
+
+# Fields of User.to_dict, the scalar header fields are cheap while each relation costs its own queries
+USER_HEADER_FIELDS = ('user_id', 'username', 'weight', 'gender', 'email', 'bio', 'avatar')
+USER_RELATIONS = ('posts', 'followed_posts', 'liked_posts', 'followed')
+# Shape of a user search result, search is typeahead and only needs enough to render a row
+SEARCH_FIELDS = ('user_id', 'username', 'avatar')
+USER_FIELDS = ('user_id', 'username', 'weight', 'gender', 'email', 'bio', 'posts', 'followed_posts', 'liked_posts',
+               'avatar', 'followed')
+
+
+class InvalidFields(ValueError):
+    pass
+
+
+def parse_fields(fields, include):
+    """ Parses a sparse fieldset of User.to_dict. fields='a,b' picks exactly those fields while include='a,b' adds
+    relations to the scalar header fields. Returns None when all fields are wanted"""
+    if fields is None and include is None:
+        return None
+    if fields is not None:
+        fields = set(fields.split(','))
+    else:
+        fields = set(USER_HEADER_FIELDS)
+    if include is not None:
+        fields.update(include.split(','))
+    if not fields <= set(USER_FIELDS):
+        raise InvalidFields(fields - set(USER_FIELDS))
+    return fields
+
+
+def avatar_url(email, size=80):
+    """ Returns the Gravatar link to the avatar of email. size argument determines the size of the avatar in pixels"""
+    return 'http://www.gravatar.com/avatar/%s?d=mp&s=%d' % (md5(email.encode('utf-8')).hexdigest(), size)
+
+
+def user_header(user):
+    """ The scalar fields of User.to_dict, for a User or any row with the same attributes"""
+    return {'user_id': user.user_id,
+            'username': user.username,
+            'weight': user.weight,
+            'gender': user.gender,
+            'email': user.email,
+            'bio': user.bio,
+            'avatar': avatar_url(user.email)}
+
+
+def user_relation(user_id, relation):
+    """ The query behind a relation of User.to_dict and the keys it is paginated on"""
+    if relation == 'followed':
+        return followed_users_query(user_id).filter(User.user_id != user_id), [User.user_id]
+    query = {'posts': user_posts_query,
+             'followed_posts': followed_posts_query,
+             'liked_posts': liked_posts_query}[relation](user_id)
+    return query, [Post.timestamp, Post.post_id]
+
+
+def user_posts_query(user_id):
+    return Post.query.filter(Post.author_id == user_id)
+
+
+def followed_posts_query(user_id):
+    """ Returns the home timeline of user. Most posts are read from the materialized timeline, posts by followed
+    authors with too many followers to fan out on write are joined in from the followers table """
+    materialized = Post.query.join(timeline, (timeline.c.post_id == Post.post_id)).filter(
+        timeline.c.user_id == user_id)
+    fanout_on_read = Post.query.join(followers, (followers.c.followed_id == Post.author_id)).join(
+        User, (User.user_id == Post.author_id)).filter(
+        followers.c.follower_id == user_id, User.fanout_on_read.is_(True))
+    return materialized.union(fanout_on_read).order_by(Post.timestamp.desc())
+
+
+def liked_posts_query(user_id):
+    return Post.query.join(liked_posts, (liked_posts.c.post_id == Post.post_id)).filter(
+        liked_posts.c.user_id == user_id).order_by(Post.timestamp.desc())
+
+
+def followed_users_query(user_id):
+    return User.query.join(followers, (followers.c.followed_id == User.user_id)).filter(
+        followers.c.follower_id == user_id)
+
+
+def followers_query(user_id):
+    return User.query.join(followers, (followers.c.follower_id == User.user_id)).filter(
+        followers.c.followed_id == user_id)
+
 
 class User(db.Model):
     user_id = db.Column(db.String(16), primary_key=True)
@@ -54,6 +518,11 @@ class User(db.Model):
     gender = db.Column(db.String(16), nullable=False)
     email = db.Column(db.String(128), nullable=False, unique=True)
     bio = db.Column(db.String(280))
+    fanout_on_read = db.Column(db.Boolean, nullable=False, default=False)
+    # Carried in the claims of every token, bumping it revokes all tokens of the user
+    token_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Set once deletion has started, the row itself goes last. See purge_user
+    deleted_at = db.Column(db.DateTime, index=True)
 
     posts = db.relationship('Post', backref='author', lazy='dynamic')
 
@@ -67,61 +536,104 @@ class User(db.Model):
                                backref=db.backref('followers', lazy='dynamic'),
                                lazy='dynamic')
 
-    def __init__(self, user_id, username, password, weight, gender, email, age, bio):
+    def __init__(self, user_id, username, password=None, weight=None, gender=None, email=None, age=None, bio=None,
+                 password_hash=None):
+        """ Takes the password or, to keep slow hashing off the request path, its hash from passwords.hash_password"""
         self.user_id = user_id
         self.username = username
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hash if password_hash is not None else generate_password_hash(password)
+        self.token_version = 0
         self.weight = weight
         self.gender = gender
         self.email = email
         self.bio = bio
 
     def like_post(self, post):
-        if not self.has_liked_post(post):
-            self.liked.append(post)
-            db.session.add(self)
+        if insert_ignore(liked_posts, {'user_id': self.user_id, 'post_id': post.post_id}):
+            Post.query.filter_by(post_id=post.post_id).update(
+                bump_post_version(post.post_id, {Post.like_count: Post.like_count + 1}), synchronize_session=False)
+            db.session.expire(post, ['like_count', 'version', 'modified'])
 
     def unlike_post(self, post):
-        if self.has_liked_post(post):
-            self.liked.remove(post)
-            db.session.add(self)
+        deleted = db.session.execute(liked_posts.delete().where(
+            db.and_(liked_posts.c.user_id == self.user_id, liked_posts.c.post_id == post.post_id)))
+        if deleted.rowcount == 1:
+            Post.query.filter_by(post_id=post.post_id).update(
+                bump_post_version(post.post_id, {Post.like_count: Post.like_count - 1}), synchronize_session=False)
+            db.session.expire(post, ['like_count', 'version', 'modified'])
 
     def has_liked_post(self, post):
-        return post in self.liked
+        return db.session.query(db.exists().where(
+            db.and_(liked_posts.c.user_id == self.user_id, liked_posts.c.post_id == post.post_id))).scalar()
 
     def avatar(self, size=80):
         """ Returns the Gravatar link to the users avatar. size argument determines the size of the avatar in pixels """
-        return 'http://www.gravatar.com/avatar/%s?d=mp&s=%d' % (md5(self.email.encode('utf-8')).hexdigest(), size)
+        return avatar_url(self.email, size)
 
+    # follows are decided by the rows of the primary, the follower graph may be behind and is only read from
     def follow(self, user):
-        if not self.is_following(user):
-            self.followed.append(user)
+        if insert_ignore(followers, {'follower_id': self.user_id, 'followed_id': user.user_id}):
+            record_follow_change(self.user_id, user.user_id, True)
             return self
 
     def unfollow(self, user):
-        if self.is_following(user):
-            self.followed.remove(user)
+        deleted = db.session.execute(followers.delete().where(
+            db.and_(followers.c.follower_id == self.user_id, followers.c.followed_id == user.user_id)))
+        if deleted.rowcount == 1:
+            record_follow_change(self.user_id, user.user_id, False)
             return self
 
     def is_following(self, user):
-        return self.followed.filter(followers.c.followed_id == user.user_id).count() > 0
+        return is_following(self.user_id, user.user_id)
 
     def followed_posts(self):
-        return Post.query.join(followers, (followers.c.followed_id == Post.author_id)).filter(
-            followers.c.follower_id == self.user_id).order_by(Post.timestamp.desc())
+        return followed_posts_query(self.user_id)
+
+    def liked_posts(self):
+        return liked_posts_query(self.user_id)
+
+    @read_replica
+    def to_dict(self, fields=None):
+        """ Serializes the user. fields is an optional subset of USER_FIELDS, relations that are left out are never
+        queried"""
+        return serialize_users([self], fields)[0]
+
+
+# Substring search index over usernames. On SQLite an FTS5 trigram table kept in sync by triggers, on Postgres a
+# pg_trgm GIN index that serves ILIKE '%...%'. Prefixes too short for trigrams use the index on lower(username). See
+# search_users_query. FTS5 has the trigram tokenizer from SQLite 3.34, older versions search with a plain LIKE
+sqlite_trigram = sqlite3.sqlite_version_info >= (3, 34)
+sqlite_trigram_ddl = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS user_search USING fts5("
+    "username, content='user', content_rowid='rowid', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS user_search_insert AFTER INSERT ON user BEGIN "
+    "INSERT INTO user_search(rowid, username) VALUES (new.rowid, new.username); END",
+    "CREATE TRIGGER IF NOT EXISTS user_search_delete AFTER DELETE ON user BEGIN "
+    "INSERT INTO user_search(user_search, rowid, username) VALUES ('delete', old.rowid, old.username); END",
+    "CREATE TRIGGER IF NOT EXISTS user_search_update AFTER UPDATE OF username ON user BEGIN "
+    "INSERT INTO user_search(user_search, rowid, username) VALUES ('delete', old.rowid, old.username); "
+    "INSERT INTO user_search(rowid, username) VALUES (new.rowid, new.username); END"]
+user_search_ddl = {
+    'sqlite': (sqlite_trigram_ddl if sqlite_trigram else []) + [
+        'CREATE INDEX IF NOT EXISTS ix_user_username_lower ON user (lower(username))'],
+    'postgresql': [
+        'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+        'CREATE INDEX IF NOT EXISTS ix_user_username_trgm ON "user" USING gin (username gin_trgm_ops)',
+        'CREATE INDEX IF NOT EXISTS ix_user_username_lower ON "user" (lower(username))']}
+for dialect, statements in user_search_ddl.items():
+    for statement in statements:
+        event.listen(User.__table__, 'after_create', DDL(statement).execute_if(dialect=dialect))
+event.listen(User.__table__, 'before_drop', DDL('DROP TABLE IF EXISTS user_search').execute_if(dialect='sqlite'))
 
-    def to_dict(self):
-        return {'user_id': self.user_id,
-                'username': self.username,
-                'weight': self.weight,
-                'gender': self.gender,
-                'email': self.email,
-                'bio': self.bio,
-                'posts': [x.to_dict() for x in self.posts],
-                'followed_posts': [x.to_dict() for x in self.followed_posts()],
-                'liked_posts': [x.to_dict() for x in self.liked],
-                'avatar': self.avatar(),
-                'followed': [x.username for x in self.followed if x != self]}
+
+def reindex_user_search():
+    """ Creates the search index if it is missing, e.g. on a database created before it existed, and rebuilds it"""
+    dialect = db.engine.dialect.name
+    for statement in user_search_ddl.get(dialect, []):
+        db.session.execute(statement)
+    if dialect == 'sqlite' and sqlite_trigram:
+        db.session.execute("INSERT INTO user_search(user_search) VALUES ('rebuild')")
+    db.session.commit()
 
 
 class Post(db.Model):
@@ -131,8 +643,16 @@ class Post(db.Model):
     volume = db.Column(db.Float, nullable=False)
     alcohol_percentage = db.Column(db.Float, nullable=False)
     author_id = db.Column(db.String(16), db.ForeignKey('user.user_id'))
+    # Denormalized counts of liked_posts and Comment rows, see reconcile_post_counters
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Bumped whenever the serialization of the post changes, see bump_post_version. Gives the ETag of the post
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    modified = db.Column(db.DateTime)
     comments = db.relationship('Comment', backref='post', lazy='dynamic')
 
+    __table_args__ = (db.Index('ix_post_author_id_timestamp_post_id', 'author_id', 'timestamp', 'post_id'),)
+
     def __init__(self, post_id, drink_name, volume, alcohol_percentage, author_id):
         self.post_id = post_id
         self.timestamp = datetime.utcnow()
@@ -140,15 +660,311 @@ class Post(db.Model):
         self.volume = volume
         self.alcohol_percentage = alcohol_percentage
         self.author_id = author_id
+        self.like_count = 0
+        self.comment_count = 0
+        self.version = 0
+        self.modified = self.timestamp
 
-    def to_dict(self):
-        return {'post_id': self.post_id,
-                'timestamp': self.timestamp.isoformat(),
-                'drink_name': self.drink_name,
-                'volume': self.volume,
-                'alcohol_percentage': self.alcohol_percentage,
-                'likes': [x.username for x in self.likes],
-                'author': User.query.get(self.author_id).username}
+    def to_dict(self, likers_limit=None):
+        return serialize_posts([self], likers_limit=likers_limit)[0]
+
+
+def post_to_dict(post, author, likes):
+    """ Serializes a Post, or any row with the same attributes, given its author and likes"""
+    return {'post_id': post.post_id,
+            'timestamp': post.timestamp.isoformat(),
+            'drink_name': post.drink_name,
+            'volume': post.volume,
+            'alcohol_percentage': post.alcohol_percentage,
+            'likes': likes,
+            'like_count': post.like_count,
+            'comment_count': post.comment_count,
+            'author': author}
+
+
+def post_relations_queries(posts, viewer_id=None, likers_limit=None):
+    """ The queries serialize_posts needs: authors, likers and, with a viewer_id, the posts the viewer has liked"""
+    post_ids = [x.post_id for x in posts]
+    authors = db.session.query(User.user_id, User.username).filter(User.user_id.in_({x.author_id for x in posts}))
+    likers = db.session.query(liked_posts.c.post_id, User.username).join(
+        User, (User.user_id == liked_posts.c.user_id)).filter(liked_posts.c.post_id.in_(post_ids))
+    if likers_limit is not None:
+        likers = likers.add_columns(db.func.row_number().over(
+            partition_by=liked_posts.c.post_id, order_by=User.username).label('n')).from_self(
+            liked_posts.c.post_id, User.username).filter(db.literal_column('n') <= likers_limit)
+    queries = [authors, likers]
+    if viewer_id is not None:
+        queries.append(db.session.query(liked_posts.c.post_id).filter(
+            liked_posts.c.user_id == viewer_id, liked_posts.c.post_id.in_(post_ids)))
+    return queries
+
+
+def assemble_posts(posts, authors, likers, viewer_likes=None):
+    """ Serializes posts from the results of the post_relations_queries"""
+    authors = dict(authors)
+    likes = {x.post_id: [] for x in posts}
+    for post_id, username in likers:
+        likes[post_id].append(username)
+    ret = [post_to_dict(x, authors.get(x.author_id), likes[x.post_id]) for x in posts]
+    if viewer_likes is not None:
+        liked = {x for (x,) in viewer_likes}
+        for x in ret:
+            x['liked'] = x['post_id'] in liked
+    return ret
+
+
+def serialize_posts(posts, viewer_id=None, likers_limit=None):
+    """ Serializes a list of posts in a constant number of queries, the authors and likes of all posts are fetched at
+    once instead of once per post. With a viewer_id every post also tells whether the viewer has liked it. With a
+    likers_limit only that many usernames are listed in likes, like_count still has the total"""
+    posts = list(posts)
+    if not posts:
+        return []
+    return assemble_posts(posts, *[x.all() for x in post_relations_queries(posts, viewer_id, likers_limit)])
+
+
+def relation_rows(relation, user_ids):
+    """ Selects (owner, post_id, timestamp) of the posts in relation of every user in user_ids, the rows behind
+    user_relation for many users at once"""
+    if relation == 'posts':
+        return db.select([Post.author_id.label('owner'), Post.post_id, Post.timestamp]).where(
+            Post.author_id.in_(user_ids))
+    if relation == 'liked_posts':
+        return db.select([liked_posts.c.user_id.label('owner'), Post.post_id, Post.timestamp]).select_from(
+            liked_posts.join(Post, liked_posts.c.post_id == Post.post_id)).where(liked_posts.c.user_id.in_(user_ids))
+    materialized = db.select([timeline.c.user_id.label('owner'), timeline.c.post_id, timeline.c.timestamp]).where(
+        timeline.c.user_id.in_(user_ids))
+    fanout_on_read = db.select([followers.c.follower_id.label('owner'), Post.post_id, Post.timestamp]).select_from(
+        followers.join(Post, followers.c.followed_id == Post.author_id).join(User, User.user_id == Post.author_id)
+    ).where(db.and_(followers.c.follower_id.in_(user_ids), User.fanout_on_read.is_(True)))
+    return db.union(materialized, fanout_on_read)
+
+
+def first_posts(relation, user_ids, limit):
+    """ The first page of relation of every user in user_ids, in one query ranking the rows per user"""
+    rows = relation_rows(relation, user_ids).alias('rows')
+    rank = db.func.row_number().over(partition_by=rows.c.owner, order_by=[rows.c.timestamp.desc(),
+                                                                          rows.c.post_id.desc()])
+    ranked = db.select([rows.c.owner, rows.c.post_id, rank.label('rank')]).alias('ranked')
+    ret = {x: [] for x in user_ids}
+    for owner, post in db.session.query(ranked.c.owner, Post).join(Post, Post.post_id == ranked.c.post_id).filter(
+            ranked.c.rank <= limit).order_by(ranked.c.owner, ranked.c.rank):
+        ret[owner].append(post)
+    return ret
+
+
+def first_followed(user_ids, limit):
+    """ Usernames on the first page of the followed users of every user in user_ids, each with the cursor of the next
+    page like follow_page gives it, None if there is none"""
+    if app.config['FOLLOWER_GRAPH']:
+        load_follows(*user_ids)
+        pages = {x: follower_graph.page(x, 'followed', limit=limit + 1) for x in user_ids}
+    else:
+        rank = db.func.row_number().over(partition_by=followers.c.follower_id,
+                                         order_by=followers.c.followed_id.desc())
+        ranked = db.select([followers.c.follower_id, followers.c.followed_id, rank.label('rank')]).where(db.and_(
+            followers.c.follower_id.in_(user_ids), followers.c.follower_id != followers.c.followed_id)).alias('ranked')
+        pages = {x: [] for x in user_ids}
+        for user_id, followed_id in db.session.query(ranked.c.follower_id, ranked.c.followed_id).filter(
+                ranked.c.rank <= limit + 1).order_by(ranked.c.follower_id, ranked.c.rank):
+            pages[user_id].append(followed_id)
+    cursors = {x: encode_cursor([page[limit - 1]]) if len(page) > limit else None for x, page in pages.items()}
+    pages = {x: page[:limit] for x, page in pages.items()}
+    wanted = {x for page in pages.values() for x in page}
+    names = dict(db.session.query(User.user_id, User.username).filter(User.user_id.in_(wanted))) if wanted else {}
+    return {user_id: ([names[x] for x in page if x in names], cursors[user_id]) for user_id, page in pages.items()}
+
+
+def serialize_users(users, fields=None):
+    """ User.to_dict of a list of users in a constant number of queries. Each relation is fetched for all users at
+    once, and the posts of all relations are serialized together"""
+    users = list(users)
+    user_ids = [x.user_id for x in users]
+    relations = [x for x in USER_RELATIONS if fields is None or x in fields]
+    limit = page_limit(None)
+    pages = {x: first_posts(x, user_ids, limit) for x in relations if x != 'followed'} if users else {}
+    posts = {x.post_id: x for page in pages.values() for user_posts in page.values() for x in user_posts}
+    serialized = dict(zip(posts, serialize_posts(posts.values())))
+    if 'followed' in relations and users:
+        pages['followed'] = first_followed(user_ids, limit)
+    ret = []
+    for user in users:
+        header = user_header(user)
+        values = {}
+        for x in USER_FIELDS:
+            if fields is not None and x not in fields:
+                continue
+            if x in header:
+                values[x] = header[x]
+            elif x == 'followed':
+                # the rest is paged through on /user/<email>/followed
+                values[x], values['followed_cursor'] = pages[x][user.user_id]
+            else:
+                values[x] = [serialized[post.post_id] for post in pages[x][user.user_id]]
+        ret.append(values)
+    return ret
+
+
+def bump_post_version(post_id, values):
+    """ Adds a version bump to the values of an UPDATE that changes the serialization of a post. Cached responses of
+    the post are dropped once the transaction commits"""
+    return bump_posts_version([post_id], values)
+
+
+def bump_posts_version(post_ids, values):
+    """ bump_post_version for an UPDATE of several posts"""
+    db.session.info.setdefault('changed_posts', set()).update(post_ids)
+    values.update({Post.version: Post.version + 1, Post.modified: datetime.utcnow()})
+    return values
+
+
+def insert_ignore(table, values):
+    """ Inserts a row into table unless its key is already taken, which is safe against concurrent inserts of the
+    same row. Returns True if the row was inserted"""
+    if db.engine.dialect.name == 'postgresql':
+        statement = postgresql.insert(table).values(values).on_conflict_do_nothing()
+    else:
+        statement = table.insert().prefix_with('OR IGNORE').values(values)
+    return db.session.execute(statement).rowcount == 1
+
+
+def reconcile_post_counters():
+    """ Recounts like_count and comment_count of every post whose counters have drifted from the liked_posts and
+    comment tables. Returns the number of corrected posts"""
+    like_count = db.select([db.func.count()]).where(liked_posts.c.post_id == Post.post_id).as_scalar()
+    comment_count = db.select([db.func.count()]).where(Comment.post_id == Post.post_id).as_scalar()
+    drifted = db.or_(Post.like_count != like_count, Post.comment_count != comment_count)
+    post_ids = [x for (x,) in db.session.query(Post.post_id).filter(drifted)]
+    if not post_ids:
+        return 0
+    corrected = Post.query.filter(Post.post_id.in_(post_ids), drifted).update(
+        bump_posts_version(post_ids, {Post.like_count: like_count, Post.comment_count: comment_count}),
+        synchronize_session=False)
+    db.session.commit()
+    return corrected
+
+
+def liked_post_ids(user_id, post_ids):
+    """ Returns the subset of post_ids that user has liked, in a single indexed lookup"""
+    if not post_ids:
+        return set()
+    return {x for (x,) in db.session.query(liked_posts.c.post_id).filter(
+        liked_posts.c.user_id == user_id, liked_posts.c.post_id.in_(post_ids))}
+
+
+follower_graph = FollowerGraph()
+
+
+def load_follows(*user_ids):
+    """ Makes sure the entries of user_ids in follower_graph are current. Entries that are missing, have expired or
+    were changed through another worker are loaded together from the primary"""
+    shared = get_shared_cache()
+    tokens = {x: None if shared is None else shared.get('graph_version:' + x) for x in user_ids}
+    stale = [x for x, token in tokens.items() if not follower_graph.is_current(x, token)]
+    if not stale:
+        return
+    followed, follower = {x: [] for x in stale}, {x: [] for x in stale}
+    with primary_reads():
+        for follower_id, followed_id in db.session.query(followers.c.follower_id, followers.c.followed_id).filter(
+                followers.c.follower_id.in_(stale), followers.c.followed_id != followers.c.follower_id):
+            followed[follower_id].append(followed_id)
+        for follower_id, followed_id in db.session.query(followers.c.follower_id, followers.c.followed_id).filter(
+                followers.c.followed_id.in_(stale), followers.c.followed_id != followers.c.follower_id):
+            follower[followed_id].append(follower_id)
+    expires_at = time.time() + app.config['FOLLOWER_GRAPH_TTL']
+    for user_id in stale:
+        follower_graph.set(user_id, followed[user_id], follower[user_id], tokens[user_id], expires_at)
+
+
+def rebuild_follower_graph():
+    """ Loads every follow edge into follower_graph at once, so that a new worker answers from memory right away"""
+    with primary_reads():
+        follower_graph.load(db.session.query(followers.c.follower_id, followers.c.followed_id).yield_per(10000),
+                            time.time() + app.config['FOLLOWER_GRAPH_TTL'])
+
+
+def record_follow_change(follower_id, followed_id, added):
+    """ Notes a follow or unfollow of the current transaction, follower_graph is updated once it commits"""
+    if follower_id != followed_id:
+        db.session.info.setdefault('changed_follows', []).append((follower_id, followed_id, added))
+
+
+@event.listens_for(db.session, 'after_commit')
+def update_follower_graph(session):
+    changes = session.info.pop('changed_follows', ())
+    for follower_id, followed_id, added in changes:
+        if added:
+            follower_graph.add_edge(follower_id, followed_id)
+        else:
+            follower_graph.remove_edge(follower_id, followed_id)
+    shared = get_shared_cache()
+    if shared is not None:
+        for user_id in {x for change in changes for x in change[:2]}:
+            token = '%s.%d' % (time.time(), random.getrandbits(32))
+            shared.set('graph_version:' + user_id, token, app.config['FOLLOWER_GRAPH_TTL'])
+            follower_graph.set_token(user_id, token)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_follow_changes(session):
+    # entries loaded during the transaction may hold its changes
+    for follower_id, followed_id, _ in session.info.pop('changed_follows', ()):
+        follower_graph.discard(follower_id)
+        follower_graph.discard(followed_id)
+
+
+def is_following(follower_id, followed_id):
+    if follower_id == followed_id or not app.config['FOLLOWER_GRAPH']:
+        return db.session.query(db.exists().where(
+            db.and_(followers.c.follower_id == follower_id, followers.c.followed_id == followed_id))).scalar()
+    load_follows(follower_id)
+    return follower_graph.follows(follower_id, followed_id)
+
+
+def follow_count(user_id, relation):
+    """ Number of users followed by user_id, or following user_id with relation 'followers'. Self follows do not
+    count"""
+    if not app.config['FOLLOWER_GRAPH']:
+        query = followers_query if relation == 'followers' else followed_users_query
+        return query(user_id).filter(User.user_id != user_id).count()
+    load_follows(user_id)
+    return follower_graph.count(user_id, relation)
+
+
+def mutual_follows(user_id):
+    """ Ids of the users that user_id follows and is followed by"""
+    if not app.config['FOLLOWER_GRAPH']:
+        return sorted(x.user_id for x in followed_users_query(user_id).filter(
+            User.user_id != user_id, User.user_id.in_(db.session.query(followers.c.follower_id).filter(
+                followers.c.followed_id == user_id))))
+    load_follows(user_id)
+    return follower_graph.mutual(user_id)
+
+
+def followed_user_ids(user_id, user_ids):
+    """ Returns the subset of user_ids that user follows, in a single indexed lookup"""
+    if not user_ids:
+        return set()
+    if app.config['FOLLOWER_GRAPH']:
+        return {x for x in user_ids if is_following(user_id, x)}
+    return {x for (x,) in db.session.query(followers.c.followed_id).filter(
+        followers.c.follower_id == user_id, followers.c.followed_id.in_(user_ids))}
+
+
+def follow_page(user_id, relation, cursor=None, limit=None):
+    """ A page of the users following user_id with relation 'followers', or else followed by user_id, ordered like
+    paginate on User.user_id. From follower_graph only the users on the page are read"""
+    if not app.config['FOLLOWER_GRAPH']:
+        query = followers_query if relation == 'followers' else followed_users_query
+        return paginate(query(user_id).filter(User.user_id != user_id), [User.user_id], cursor, limit)
+    before = None if cursor is None else decode_cursor(cursor, [User.user_id])[0]
+    limit = page_limit(limit)
+    load_follows(user_id)
+    user_ids = follower_graph.page(user_id, relation, before, limit + 1)
+    next_cursor = encode_cursor([user_ids[limit - 1]]) if len(user_ids) > limit else None
+    user_ids = user_ids[:limit]
+    users = {x.user_id: x for x in User.query.filter(User.user_id.in_(user_ids))} if user_ids else {}
+    return Page([users[x] for x in user_ids if x in users], next_cursor)
 
 
 class Comment(db.Model):
@@ -158,6 +974,8 @@ class Comment(db.Model):
     author_id = db.Column(db.String(16), db.ForeignKey('user.user_id'))
     post_id = db.Column(db.String(16), db.ForeignKey('post.post_id'))
 
+    __table_args__ = (db.Index('ix_comment_post_id_timestamp_comment_id', 'post_id', 'timestamp', 'comment_id'),)
+
     def __init__(self, comment_id, body, author_id, post_id):
         self.comment_id = comment_id
         self.body = body
@@ -166,16 +984,33 @@ class Comment(db.Model):
         self.post_id = post_id
 
     def to_dict(self):
-        return {'comment_id': self.comment_id,
-                'body': self.body,
-                'timestamp': self.timestamp.isoformat(),
-                'author_id': self.author_id,
-                'post_id': self.post_id}
+        return comment_to_dict(self)
+
+
+def comment_to_dict(comment):
+    """ Serializes a Comment, or any row with the same attributes"""
+    return {'comment_id': comment.comment_id,
+            'body': comment.body,
+            'timestamp': comment.timestamp.isoformat(),
+            'author_id': comment.author_id,
+            'post_id': comment.post_id}
 
 
 class Blacklist(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     jti = db.Column(db.String(200), nullable=False, unique=True)
+    expires = db.Column(db.DateTime, index=True)
+
+
+_shared_caches = {}
+
+
+def get_shared_cache():
+    """ Returns the backend configured by CACHE_URL, or None if there is none"""
+    url = app.config['CACHE_URL']
+    if url not in _shared_caches:
+        _shared_caches[url] = connect_backend(url)
+    return _shared_caches[url]
 
 
 def init_new_db():
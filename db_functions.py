@@ -1,19 +1,40 @@
 from database import *
+import itertools
 import random
 import string
-from werkzeug.security import check_password_hash
+from cache import BloomFilter, LRUCache, MemoryBackend
+from passwords import HashingBusy, hash_password, hash_passwords, verify_password
+from bac import bac_states, update_bac_state
+from leaderboards import add_to_rollups
+import threading
+import time
+
+# Tokens known not to be blacklisted, saves a database lookup on every authenticated request
+good_tokens = LRUCache(app.config['BLACKLIST_CACHE_SIZE'])
+_last_prune = 0.0
+# token_version of recently seen users, trusted for BLACKLIST_CACHE_TTL seconds
+token_versions = LRUCache(app.config['TOKEN_VERSION_CACHE_SIZE'])
+# Bloom filter of the jtis blacklisted before it was built, and when it was built. See jti_filter
+_jti_filter = (None, 0.0)
+# Failed login counts when there is no shared cache to keep them
+_login_failures = MemoryBackend()
+# Serialized posts by post_id, each a dict from likers limit to (shared version token, (etag, last modified, post))
+post_responses = LRUCache(app.config['POST_CACHE_SIZE'])
 
 
 def create_user(username, password, email, weight, gender, user_id=None, age=None, bio=None):
     """Creates a user with username, password, email, weight, and gender, and generates an ID"""
     if user_id is None:
         user_id = generate_id(is_user_id)
-    new_user = User(username=username, password=password, weight=weight, gender=gender,
+    new_user = User(username=username, password_hash=hash_password(password), weight=weight, gender=gender,
                     user_id=user_id, email=email, age=age, bio=bio)
     db.session.add(new_user)
+    db.session.flush()
+    new_user.follow(new_user)
     db.session.commit()
-    db.session.add(new_user.follow(new_user))
-    db.session.commit()
+    mark_writer(user_id)
+    # nobody can follow a new user yet
+    follower_graph.set(user_id, (), (), expires_at=time.time() + app.config['FOLLOWER_GRAPH_TTL'])
     return new_user
 
 
@@ -26,25 +47,82 @@ def create_post(drink_name, volume, alcohol_percentage, author_id, post_id=None)
     new_post = Post(post_id=post_id, drink_name=drink_name, volume=volume,
                     alcohol_percentage=alcohol_percentage, author_id=author_id)
     db.session.add(new_post)
+    db.session.flush()
+    fan_out_post(new_post)
+    add_to_rollups([(author_id, new_post.timestamp, volume, alcohol_percentage)])
     db.session.commit()
+    update_bac_state(get_user_id(author_id), new_post)
     return new_post
 
 
+def create_posts(drinks, author_id):
+    """ Creates a post per (drink_name, volume, alcohol_percentage) in drinks, in one transaction. Ids are generated
+    up front, and timelines, rollups and the blood alcohol of the author are updated once for the whole batch. Returns
+    the posts in the order of drinks"""
+    post_ids = generate_ids(len(drinks), Post.post_id)
+    new_posts = [Post(post_id=post_id, drink_name=drink_name, volume=volume, alcohol_percentage=alcohol_percentage,
+                      author_id=author_id)
+                 for post_id, (drink_name, volume, alcohol_percentage) in zip(post_ids, drinks)]
+    db.session.add_all(new_posts)
+    db.session.flush()
+    fan_out_posts(post_ids)
+    add_to_rollups([(author_id, x.timestamp, x.volume, x.alcohol_percentage) for x in new_posts])
+    db.session.commit()
+    # reloads the expired posts with one query instead of one per post
+    Post.query.filter(Post.post_id.in_(post_ids)).all()
+    author = get_user_id(author_id)
+    for post in new_posts:
+        update_bac_state(author, post)
+    return new_posts
+
+
+def fan_out_post(post):
+    """ Writes post into the timeline of every follower of its author. Authors that turn out to have more followers
+    than TIMELINE_FANOUT_LIMIT are switched over to fan-out-on-read for their coming posts"""
+    author = get_user_id(post.author_id)
+    if author.fanout_on_read:
+        return
+    followers_of_author = db.select([followers.c.follower_id, db.literal(post.post_id), db.literal(post.author_id),
+                                     db.literal(post.timestamp)]).where(followers.c.followed_id == post.author_id)
+    result = db.session.execute(timeline.insert().from_select(
+        ['user_id', 'post_id', 'author_id', 'timestamp'], followers_of_author))
+    if result.rowcount > app.config['TIMELINE_FANOUT_LIMIT']:
+        author.fanout_on_read = True
+        db.session.add(author)
+
+
 def create_comment(body, author_id, post_id, comment_id=None):
     """ Creates a comment with body text, and generates a comment_id"""
     if comment_id is None:
         comment_id = generate_id(is_comment_id)
     new_comment = Comment(comment_id=comment_id, body=body, author_id=author_id, post_id=post_id)
     db.session.add(new_comment)
+    Post.query.filter_by(post_id=post_id).update(
+        bump_post_version(post_id, {Post.comment_count: Post.comment_count + 1}), synchronize_session=False)
     db.session.commit()
     return new_comment
 
 
+def fan_out_posts(post_ids):
+    """ Writes a batch of posts into the timelines of the followers of their authors with one statement. Authors of
+    the batch that have more than TIMELINE_FANOUT_LIMIT followers are switched over to fan-out-on-read"""
+    fan_out = db.select([followers.c.follower_id, Post.post_id, Post.author_id, Post.timestamp]).select_from(
+        followers.join(Post, followers.c.followed_id == Post.author_id).join(User, Post.author_id == User.user_id)
+    ).where(db.and_(Post.post_id.in_(post_ids), User.fanout_on_read.is_(False)))
+    db.session.execute(timeline.insert().from_select(['user_id', 'post_id', 'author_id', 'timestamp'], fan_out))
+    authors = db.select([Post.author_id]).where(Post.post_id.in_(post_ids))
+    heavy_authors = db.select([followers.c.followed_id]).where(followers.c.followed_id.in_(authors)).group_by(
+        followers.c.followed_id).having(db.func.count() > app.config['TIMELINE_FANOUT_LIMIT'])
+    User.query.filter(User.user_id.in_(heavy_authors)).update({User.fanout_on_read: True}, synchronize_session=False)
+
+
 def follow_user(follower, followee):
     u = follower.follow(followee)
     if u is None:
         return None
     db.session.add(u)
+    if not followee.fanout_on_read:
+        backfill_timeline_from(follower.user_id, followee.user_id)
     db.session.commit()
     return follower
 
@@ -54,52 +132,468 @@ def unfollow_user(follower, followee):
     if u is None:
         return None
     db.session.add(u)
+    db.session.execute(timeline.delete().where(
+        db.and_(timeline.c.user_id == follower.user_id, timeline.c.author_id == followee.user_id)))
     db.session.commit()
     return follower
 
 
-def remove_user(user):
-    """ Deletes specified user from the database"""
-    db.session.delete(user)
+def backfill_timeline_from(user_id, author_id):
+    """ Copies all posts by author_id into the timeline of user_id"""
+    posts_by_author = db.select([db.literal(user_id), Post.post_id, Post.author_id, Post.timestamp]).where(
+        Post.author_id == author_id)
+    db.session.execute(timeline.insert().from_select(
+        ['user_id', 'post_id', 'author_id', 'timestamp'], posts_by_author))
+
+
+def backfill_timeline(user_id=None):
+    """ Rebuilds the materialized timeline of user_id from the followers table, or of every user if user_id is None.
+    A full rebuild also reevaluates which authors are fanned out on read"""
+    if user_id is None:
+        follower_count = db.select([db.func.count()]).where(followers.c.followed_id == User.user_id).as_scalar()
+        User.query.update({User.fanout_on_read: follower_count > app.config['TIMELINE_FANOUT_LIMIT']},
+                          synchronize_session=False)
+        db.session.execute(timeline.delete())
+    else:
+        db.session.execute(timeline.delete().where(timeline.c.user_id == user_id))
+    followed_posts = db.select([followers.c.follower_id, Post.post_id, Post.author_id, Post.timestamp]).select_from(
+        followers.join(Post, followers.c.followed_id == Post.author_id).join(User, Post.author_id == User.user_id)
+    ).where(User.fanout_on_read.is_(False))
+    if user_id is not None:
+        followed_posts = followed_posts.where(followers.c.follower_id == user_id)
+    db.session.execute(timeline.insert().from_select(
+        ['user_id', 'post_id', 'author_id', 'timestamp'], followed_posts))
     db.session.commit()
 
 
-def generate_id(test_for_id):
-    """ Creates a new id and avoids duplicate id:s"""
-    new_id = ''.join(random.choice(string.ascii_lowercase + string.digits) for _ in range(16))
-    while test_for_id(new_id):
-        new_id = ''.join(random.choice(string.ascii_lowercase + string.digits) for _ in range(16))
+def check_timeline(user_id):
+    """ Compares the materialized timeline of user_id against the followers table. Returns a tuple of the post ids
+    missing from the timeline and the post ids that should not be in it. Rows left from authors that have since moved
+    to fan out on read are harmless, the read merges their posts in anyway, and are not counted"""
+    expected = db.session.query(Post.post_id).join(followers, (followers.c.followed_id == Post.author_id)).join(
+        User, (User.user_id == Post.author_id)).filter(
+        followers.c.follower_id == user_id, User.fanout_on_read.is_(False))
+    actual = db.session.query(timeline.c.post_id).join(User, (User.user_id == timeline.c.author_id)).filter(
+        timeline.c.user_id == user_id, User.fanout_on_read.is_(False))
+    expected = {x for (x,) in expected}
+    actual = {x for (x,) in actual}
+    return expected - actual, actual - expected
+
+
+def count_user_rows(user_id, limit):
+    """ Rows purge_user deletes for user_id besides the user itself, counted up to limit"""
+    one = db.literal_column('1')
+    rows = db.union_all(db.select([one]).where(liked_posts.c.user_id == user_id),
+                        db.select([one]).where(Comment.author_id == user_id),
+                        db.select([one]).where(Post.author_id == user_id),
+                        db.select([one]).where(followers.c.follower_id == user_id),
+                        db.select([one]).where(followers.c.followed_id == user_id),
+                        db.select([one]).where(timeline.c.user_id == user_id)).limit(limit).alias()
+    return db.session.query(db.func.count()).select_from(rows).scalar()
+
+
+def remove_user_query_budget():
+    """ Most queries /user/delete sends. Users above DELETE_BACKGROUND_THRESHOLD rows are purged in the background, so
+    the request deletes at most that many rows, in at most 6 queries per DELETE_BATCH_SIZE rows"""
+    # each of the 6 loops of purge_user may end on a partly full batch and sends one more query to find nothing left,
+    # and the loops are run a second time that finds nothing
+    batches = -(-app.config['DELETE_BACKGROUND_THRESHOLD'] // app.config['DELETE_BATCH_SIZE']) + 6
+    return 8 + 6 * batches + 6 + 6
+
+
+def remove_user(user, background=None):
+    """ Deletes user with their posts, comments, likes and follows. The user is locked out at once, the rows are
+    deleted in batches by purge_user, on a background thread if background is set or, by default, if the user has
+    more than DELETE_BACKGROUND_THRESHOLD rows to delete. Returns True if the user is gone, False if the deletion
+    continues in the background. Deletions interrupted by a restart are finished by the users-purge command"""
+    user_id = user.user_id
+    User.query.filter_by(user_id=user_id).update({User.deleted_at: datetime.utcnow()}, synchronize_session=False)
+    revoke_user_tokens(user_id)
+    if background is None:
+        threshold = app.config['DELETE_BACKGROUND_THRESHOLD']
+        background = count_user_rows(user_id, threshold + 1) > threshold
+    if background:
+        threading.Thread(target=_purge_user_in_background, args=(user_id,), daemon=True).start()
+        return False
+    purge_user(user_id)
+    return True
+
+
+def _purge_user_in_background(user_id):
+    with app.app_context():
+        try:
+            purge_user(user_id)
+        finally:
+            db.session.remove()
+
+
+def purge_user(user_id):
+    """ Deletes every row of a user in set based statements over batches of DELETE_BATCH_SIZE keys, one transaction
+    per batch. Counters of other users posts are kept in step. Returns the number of deleted rows per table"""
+    deleted = {}
+
+    def batches(query):
+        while True:
+            rows = query.limit(app.config['DELETE_BATCH_SIZE']).all()
+            if not rows:
+                return
+            yield rows
+            db.session.commit()
+            if app.config['DELETE_BATCH_PAUSE']:
+                time.sleep(app.config['DELETE_BATCH_PAUSE'])
+
+    def delete(table, *where):
+        deleted[table.name] = deleted.get(table.name, 0) + db.session.execute(
+            table.delete().where(db.and_(*where))).rowcount
+
+    def delete_rows():
+        for rows in batches(db.session.query(liked_posts.c.post_id).filter(liked_posts.c.user_id == user_id)):
+            post_ids = [x for (x,) in rows]
+            delete(liked_posts, liked_posts.c.user_id == user_id, liked_posts.c.post_id.in_(post_ids))
+            Post.query.filter(Post.post_id.in_(post_ids)).update(
+                bump_posts_version(post_ids, {Post.like_count: Post.like_count - 1}), synchronize_session=False)
+
+        user_comments = db.session.query(Comment.comment_id, Comment.post_id).filter(Comment.author_id == user_id)
+        for rows in batches(user_comments):
+            comment_ids = [x.comment_id for x in rows]
+            post_ids = {x.post_id for x in rows}
+            removed = db.select([db.func.count()]).where(
+                db.and_(Comment.post_id == Post.post_id, Comment.comment_id.in_(comment_ids))).as_scalar()
+            Post.query.filter(Post.post_id.in_(post_ids)).update(
+                bump_posts_version(post_ids, {Post.comment_count: Post.comment_count - removed}),
+                synchronize_session=False)
+            delete(comments, comments.c.comment_id.in_(comment_ids))
+            delete(Comment.__table__, Comment.comment_id.in_(comment_ids))
+
+        for rows in batches(db.session.query(Post.post_id).filter(Post.author_id == user_id)):
+            post_ids = [x for (x,) in rows]
+            delete(liked_posts, liked_posts.c.post_id.in_(post_ids))
+            delete(comments, comments.c.post_id.in_(post_ids))
+            delete(Comment.__table__, Comment.post_id.in_(post_ids))
+            delete(timeline, timeline.c.post_id.in_(post_ids))
+            delete(Post.__table__, Post.post_id.in_(post_ids))
+            db.session.info.setdefault('changed_posts', set()).update(post_ids)
+
+        for column, other in [(followers.c.follower_id, followers.c.followed_id),
+                              (followers.c.followed_id, followers.c.follower_id)]:
+            for rows in batches(db.session.query(other).filter(column == user_id)):
+                other_ids = [x for (x,) in rows]
+                delete(followers, column == user_id, other.in_(other_ids))
+                for x in other_ids:
+                    edge = (user_id, x) if column is followers.c.follower_id else (x, user_id)
+                    record_follow_change(*edge, False)
+        for rows in batches(db.session.query(timeline.c.post_id).filter(timeline.c.user_id == user_id)):
+            delete(timeline, timeline.c.user_id == user_id, timeline.c.post_id.in_([x for (x,) in rows]))
+
+    delete_rows()
+    # once more, for rows added by requests that were already past their checks when the loops above went by
+    delete_rows()
+    delete(consumption, consumption.c.user_id == user_id)
+    delete(User.__table__, User.user_id == user_id)
+    db.session.commit()
+    bac_states.delete(user_id)
+    return deleted
+
+
+def purge_deleted_users():
+    """ Finishes every deletion that was started but not completed. Returns the ids of the purged users"""
+    user_ids = [x for (x,) in db.session.query(User.user_id).filter(User.deleted_at.isnot(None))]
+    for user_id in user_ids:
+        purge_user(user_id)
+    return user_ids
+
+
+ID_ALPHABET = string.digits + string.ascii_lowercase
+_system_random = random.SystemRandom()
+
+
+def time_ordered_id():
+    """ 16 character id made of the time in milliseconds as 9 base 36 digits followed by 7 random digits. New ids sort
+    after old ones, so primary key inserts append to the index, and 36**7 random suffixes per millisecond make
+    collisions negligible without asking the database"""
+    millis = int(time.time() * 1000)
+    prefix = []
+    for _ in range(9):
+        millis, digit = divmod(millis, 36)
+        prefix.append(ID_ALPHABET[digit])
+    return ''.join(reversed(prefix)) + ''.join(_system_random.choice(ID_ALPHABET) for _ in range(7))
+
+
+def random_id():
+    """ 16 random characters, the original id format"""
+    return ''.join(random.choice(string.ascii_lowercase + string.digits) for _ in range(16))
+
+
+# Id generators selectable with ID_GENERATOR. Both make 16 character ids, so old random ids and new ids can share a
+# table and a database can switch generator without a migration
+ID_GENERATORS = {'time': time_ordered_id, 'random': random_id}
+
+
+def generate_id(test_for_id=None):
+    """ Creates a new id with the generator chosen by ID_GENERATOR. Random ids are checked against test_for_id to
+    avoid duplicates, time ordered ids need no round trip to the database"""
+    generator = ID_GENERATORS[app.config['ID_GENERATOR']]
+    new_id = generator()
+    if generator is random_id and test_for_id is not None:
+        while test_for_id(new_id):
+            new_id = generator()
     return new_id
 
 
-def db_search_user(seq):
-    """ Returns a list of all users whose usernames contains the sequence seq"""
-    ret = User.query.filter(User.username.contains(seq)).all()
-    return [x.to_dict() for x in ret]
+def generate_ids(n, column):
+    """ Creates n new ids at once. Random ids are checked against column with one query per round instead of one per
+    id"""
+    generator = ID_GENERATORS[app.config['ID_GENERATOR']]
+    new_ids = [generator() for _ in range(n)]
+    if generator is not random_id:
+        return new_ids
+    while True:
+        taken = {x for (x,) in db.session.query(column).filter(column.in_(new_ids))}
+        clashes = [i for i, x in enumerate(new_ids) if x in taken or x in new_ids[:i]]
+        if not clashes:
+            return new_ids
+        for i in clashes:
+            new_ids[i] = generator()
+
+
+def search_users_query(seq):
+    """ Users whose usernames contains the sequence seq. Exact matches are ranked first, then prefix matches, then
+    shorter usernames. Substrings are looked up in the trigram index, sequences too short to make up a trigram only
+    match as prefixes"""
+    dialect = db.engine.dialect.name
+    query = User.query.filter(User.deleted_at.is_(None))
+    username = db.func.lower(User.username)
+    if len(seq) < 3:
+        # case insensitive like the trigram lookups, over the index on lower(username)
+        query = query.filter(username >= seq.lower(), username < seq.lower() + '\U0010ffff')
+    elif dialect == 'sqlite' and sqlite_trigram:
+        query = query.filter(db.text('"user".rowid IN (SELECT rowid FROM user_search WHERE user_search MATCH :match)'
+                                     ).bindparams(match='"%s"' % seq.replace('"', '""')))
+    elif dialect == 'postgresql':
+        query = query.filter(User.username.ilike('%' + _escape_like(seq) + '%', escape='\\'))
+    else:
+        query = query.filter(User.username.contains(seq, autoescape=True))
+    rank = db.case([(username == seq.lower(), 0),
+                    (username.like(_escape_like(seq.lower()) + '%', escape='\\'), 1)], else_=2)
+    return query.order_by(rank, db.func.length(User.username), User.username)
+
+
+@read_replica
+def db_search_user(seq, limit=None, fields=SEARCH_FIELDS):
+    """ Returns the best matches of search_users_query"""
+    return Page(serialize_users(search_users_query(seq).limit(page_limit(limit)), fields))
+
+
+def stream_users(query, fields=None):
+    """ Yields the users of query serialized. Rows come through a server-side cursor STREAM_BATCH_SIZE at a time and
+    are serialized together, so memory use does not grow with the number of users and queries only with the batches"""
+    size = app.config['STREAM_BATCH_SIZE']
+    rows = iter(query.execution_options(stream_results=True).yield_per(size))
+    while True:
+        # not held across the yield, the consumer may write in between
+        with replica_reads():
+            users = list(itertools.islice(rows, size))
+            if not users:
+                return
+            items = serialize_users(users, fields)
+        yield from items
+
+
+def _escape_like(seq):
+    return seq.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
 
 
 def check_password(email, password):
     """ Checks if password matches with the saved password hash"""
     user = get_user_email(email)
-    return check_password_hash(user.password_hash, password)
+    return verify_password(user.password_hash, password)
+
+
+def authenticate(email, password, ip=None):
+    """ Returns the user with email if password is theirs, otherwise None. Failures count towards the login throttle
+    of the account and of the client address ip"""
+    # from the primary, a password or account that just changed must count
+    user = User.query.filter_by(email=email).first()
+    if user is None or user.deleted_at is not None or not verify_password(user.password_hash, password):
+        failures = get_shared_cache() or _login_failures
+        failures.incr(_account_failures_key(email, ip), app.config['LOGIN_WINDOW'])
+        if ip is not None:
+            failures.incr('login_failures:ip:' + ip, app.config['LOGIN_WINDOW'])
+        return None
+    (get_shared_cache() or _login_failures).delete(_account_failures_key(email, ip))
+    return user
+
+
+def _account_failures_key(email, ip):
+    # per client address too, otherwise anyone could lock the owner out of their account with a few wrong passwords
+    return 'login_failures:account:%s:%s' % (email.lower(), ip or '')
+
+
+def is_login_throttled(email, ip=None):
+    """ Checks if logins to the account with email from the client address ip, or any logins from ip, have failed too
+    often lately"""
+    failures = get_shared_cache() or _login_failures
+    if int(failures.get(_account_failures_key(email, ip)) or 0) >= app.config['LOGIN_MAX_ACCOUNT_FAILURES']:
+        return True
+    return ip is not None and int(failures.get('login_failures:ip:' + ip) or 0) >= app.config['LOGIN_MAX_IP_FAILURES']
 
 
 def create_token(email):
     """ Creates access token for user"""
-    user = get_user_email(email)
+    return create_user_token(User.query.filter_by(email=email).first())
+
+
+def create_user_token(user):
+    """ Creates an access token carrying the current token_version of user"""
+    remember_token_version(user.user_id, user.token_version)
     return create_access_token(user.user_id)
 
 
-def blacklist_token(jti):
-    """ Adds token to blacklist"""
-    db.session.add(Blacklist(jti=jti))
+def blacklist_token(jti, expires=None):
+    """ Adds token to blacklist. expires is the expiry time of the token as seconds since the epoch, once it has passed
+    the row is pruned since the token is rejected anyway"""
+    if expires is not None:
+        expires = datetime.utcfromtimestamp(expires)
+    db.session.add(Blacklist(jti=jti, expires=expires))
+    db.session.commit()
+    good_tokens.delete(jti)
+    shared = get_shared_cache()
+    if shared is not None:
+        ttl = None if expires is None else (expires - datetime.utcnow()).total_seconds()
+        shared.set('blacklist:' + jti, '1', ttl)
+    if _jti_filter[0] is not None:
+        _jti_filter[0].add(jti)
+    if time.time() - _last_prune > app.config['BLACKLIST_PRUNE_INTERVAL']:
+        prune_blacklist()
+
+
+def revoke_token(token):
+    """ Revokes a decoded token. In version mode without the jti filter a single token can not be told apart, so every
+    token of the user is revoked"""
+    if app.config['TOKEN_REVOCATION'] == 'version' and not app.config['TOKEN_JTI_FILTER']:
+        revoke_user_tokens(token['identity'])
+    else:
+        blacklist_token(token['jti'], token.get('exp'))
+
+
+def revoke_user_tokens(user_id):
+    """ Revokes every token issued to user so far, in a single write"""
+    User.query.filter_by(user_id=user_id).update({User.token_version: User.token_version + 1},
+                                                 synchronize_session=False)
+    db.session.commit()
+    version = db.session.query(User.token_version).filter(User.user_id == user_id).scalar()
+    remember_token_version(user_id, version)
+
+
+def get_token_version(user_id):
+    """ Current token_version of user, None if there is no such user"""
+    version = cached_token_version(user_id)
+    if version is None:
+        version = db.session.query(User.token_version).filter(User.user_id == user_id).scalar()
+        if version is not None:
+            remember_token_version(user_id, version)
+    return version
+
+
+def cached_token_version(user_id):
+    version = token_versions.get(user_id)
+    shared = get_shared_cache()
+    if version is None and shared is not None:
+        version = shared.get('token_version:' + user_id)
+    return None if version is None else int(version)
+
+
+def remember_token_version(user_id, version):
+    ttl = app.config['BLACKLIST_CACHE_TTL']
+    token_versions.set(user_id, version, time.time() + ttl)
+    shared = get_shared_cache()
+    if shared is not None:
+        shared.set('token_version:' + user_id, str(version), ttl)
+
+
+def jti_filter():
+    """ Bloom filter of the blacklisted jtis that have not expired yet. Rebuilt every BLACKLIST_CACHE_TTL seconds, so
+    tokens blacklisted through other workers are caught within that time like with good_tokens"""
+    jtis = cached_jti_filter()
+    if jtis is None:
+        jtis = set_jti_filter(x for (x,) in recent_blacklist_query())
+    return jtis
+
+
+def cached_jti_filter():
+    """ The jti filter if it is recent enough, otherwise None"""
+    jtis, built = _jti_filter
+    if jtis is None or time.time() - built > app.config['BLACKLIST_CACHE_TTL']:
+        return None
+    return jtis
+
+
+def recent_blacklist_query():
+    return db.session.query(Blacklist.jti).filter(
+        db.or_(Blacklist.expires > datetime.utcnow(), Blacklist.expires.is_(None)))
+
+
+def set_jti_filter(jtis):
+    global _jti_filter
+    jti_set = BloomFilter(app.config['TOKEN_FILTER_BITS'])
+    for jti in jtis:
+        jti_set.add(jti)
+    _jti_filter = (jti_set, time.time())
+    return jti_set
+
+
+def prune_blacklist():
+    """ Deletes blacklisted tokens that have expired. Returns the number of deleted rows"""
+    global _last_prune
+    _last_prune = time.time()
+    deleted = Blacklist.query.filter(Blacklist.expires < datetime.utcnow()).delete(synchronize_session=False)
     db.session.commit()
+    return deleted
 
 
 # Is-tester
 
-def is_token_blacklisted(jti):
-    return Blacklist.query.filter_by(jti=jti).first() is not None
+def is_token_revoked(token):
+    """ Checks a decoded token against the token_version of its user, then its jti against the blacklist or, in version
+    mode, the jti filter. Only jtis the filter reports are looked up in the Blacklist table"""
+    if token.get('user_claims', {}).get('ver', 0) != get_token_version(token['identity']):
+        return True
+    if app.config['TOKEN_REVOCATION'] != 'version':
+        return is_token_blacklisted(token['jti'], token.get('exp'))
+    if not app.config['TOKEN_JTI_FILTER'] or token['jti'] not in jti_filter():
+        return False
+    return Blacklist.query.filter_by(jti=token['jti']).first() is not None
+
+
+def is_token_blacklisted(jti, expires=None):
+    """ Checks if token is blacklisted. Tokens found not to be are remembered until they expire, for at most
+    BLACKLIST_CACHE_TTL seconds unless a shared cache tells every worker about new blacklistings"""
+    cached = cached_blacklist_status(jti)
+    if cached is not None:
+        return cached
+    if Blacklist.query.filter_by(jti=jti).first() is not None:
+        return True
+    remember_good_token(jti, expires)
+    return False
+
+
+def cached_blacklist_status(jti):
+    """ True or False if the caches know whether the token is blacklisted, None if the database has to be asked"""
+    shared = get_shared_cache()
+    if shared is not None and shared.get('blacklist:' + jti) is not None:
+        return True
+    if good_tokens.get(jti):
+        return False
+    return None
+
+
+def remember_good_token(jti, expires=None):
+    remember_until = expires
+    if get_shared_cache() is None:
+        remember_until = time.time() + app.config['BLACKLIST_CACHE_TTL']
+        if expires is not None:
+            remember_until = min(remember_until, expires)
+    good_tokens.set(jti, True, remember_until)
 
 
 def is_user_username(username):
@@ -149,36 +643,55 @@ def is_secure_password(password):
 # Getters
 
 
+@read_replica
 def get_user_id(user_id):
-    """Finds user with ID user_id"""
-    return User.query.get(user_id)
+    """Finds user with ID user_id, users that are being deleted are not found"""
+    user = User.query.get(user_id)
+    return user if user is not None and user.deleted_at is None else None
 
 
+@read_replica
 def get_user_username(username):
     """Search for user by username"""
-    return User.query.filter_by(username=username).first()
+    return User.query.filter_by(username=username, deleted_at=None).first()
 
 
+@read_replica
 def get_user_email(email):
     """Search for user by email"""
-    return User.query.filter_by(email=email).first()
+    return User.query.filter_by(email=email, deleted_at=None).first()
 
 
-def get_user_followers(user_id):
-    """ Returns all followers of user"""
-    user = get_user_id(user_id)
-    return [x.to_dict() for x in user.followers if not x == user]
+@read_replica
+def get_user_followers(user_id, cursor=None, limit=None, fields=None):
+    """ Returns a page of the followers of user"""
+    page = follow_page(user_id, 'followers', cursor, limit)
+    return Page(serialize_users(page, fields), page.next_cursor)
 
 
-def get_user_followed(user_id):
-    """ Returns all users followed by user"""
-    user = get_user_id(user_id)
-    return [x.to_dict() for x in user.followed if not x == user]
+@read_replica
+def get_user_followed(user_id, cursor=None, limit=None, fields=None):
+    """ Returns a page of the users followed by user"""
+    page = follow_page(user_id, 'followed', cursor, limit)
+    return Page(serialize_users(page, fields), page.next_cursor)
+
+
+def stream_user_followers(user_id, fields=None):
+    """ Yields every follower of user, in the order of the pages of get_user_followers"""
+    query = followers_query(user_id).filter(User.user_id != user_id).order_by(User.user_id.desc())
+    return stream_users(query, fields)
+
+
+def stream_user_followed(user_id, fields=None):
+    """ Yields every user followed by user, in the order of the pages of get_user_followed"""
+    query = followed_users_query(user_id).filter(User.user_id != user_id).order_by(User.user_id.desc())
+    return stream_users(query, fields)
 
 
 def get_post(post_id):
-    """ Search for post by post_id"""
-    return Post.query.get(post_id=post_id)
+    """ Search for post by post_id, posts of users that are being deleted are not found"""
+    return Post.query.join(User, (User.user_id == Post.author_id)).filter(
+        Post.post_id == post_id, User.deleted_at.is_(None)).first()
 
 
 def get_posts_by_author_id(user_id):
@@ -186,10 +699,65 @@ def get_posts_by_author_id(user_id):
     return Post.query.filter_by(author=user_id).all()
 
 
-def get_post_comments(post_id):
-    """ Gets all comments on post with post_id"""
-    ret = [x.to_dict() for x in Comment.query.filter_by(post_id=post_id).all()]
-    return ret
+def get_post_response(post_id, likers_limit=None):
+    """ Returns the ETag, last modification time and serialization of a post, or None if there is no such post. The
+    default shape, with every liker, is served from post_responses while the post is unchanged. Other likers_limit
+    values are serialized on every request so that they cannot fill the cache"""
+    shared = get_shared_cache()
+    token = None if shared is None else shared.get('post_version:' + post_id)
+    if likers_limit is None:
+        cached = post_responses.get(post_id)
+        if cached is not None and cached[0] == token:
+            return cached[1]
+    post = Post.query.get(post_id)
+    if post is None:
+        return None
+    etag = '%s.%d' % (post.post_id, post.version)
+    if likers_limit is not None:
+        etag += '.%d' % likers_limit
+    response = (etag, post.modified or post.timestamp, post.to_dict(likers_limit))
+    if likers_limit is None:
+        post_responses.set(post_id, (token, response), time.time() + app.config['POST_CACHE_TTL'])
+    return response
+
+
+def invalidate_post(post_id):
+    """ Drops the cached responses of a post in this worker, and in every other worker when there is a shared cache"""
+    post_responses.delete(post_id)
+    shared = get_shared_cache()
+    if shared is not None:
+        shared.set('post_version:' + post_id, '%s.%d' % (time.time(), random.getrandbits(32)),
+                   app.config['POST_CACHE_TTL'])
+
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_changed_posts(session):
+    for post_id in session.info.pop('changed_posts', ()):
+        invalidate_post(post_id)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_changed_posts(session):
+    session.info.pop('changed_posts', None)
+
+
+@read_replica
+def get_post_comments(post_id, cursor=None, limit=None):
+    """ Gets a page of the comments on post with post_id, newest first"""
+    ret = paginate(Comment.query.filter_by(post_id=post_id), [Comment.timestamp, Comment.comment_id], cursor, limit)
+    return ret.map(lambda x: x.to_dict())
+
+
+@read_replica
+def get_user_posts(user_id, relation, cursor=None, limit=None, viewer_id=None):
+    """ Gets a page of the posts, followed_posts or liked_posts of user, newest first. With a viewer_id each post tells
+    whether the viewer has liked it"""
+    user = get_user_id(user_id)
+    query = {'posts': user.posts,
+             'followed_posts': user.followed_posts(),
+             'liked_posts': user.liked_posts()}[relation]
+    ret = paginate(query, [Post.timestamp, Post.post_id], cursor, limit)
+    return Page(serialize_posts(ret, viewer_id), ret.next_cursor)
 
 # Setters
 
@@ -208,4 +776,5 @@ def set_user_weight(user_id, weight):
     user.weight = weight
     db.session.add(user)
     db.session.commit()
+    bac_states.delete(user_id)
 
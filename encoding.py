@@ -0,0 +1,104 @@
+""" Encoding of API responses. Bodies are encoded as JSON by the JSON_BACKEND, orjson when it is installed, or as
+MessagePack for clients that ask for application/msgpack. Bodies of at least COMPRESS_MIN_SIZE bytes are compressed
+with brotli or gzip when the client accepts it. orjson, msgpack and brotli are all optional"""
+import gzip
+
+from flask import json, request, Response
+
+from database import app
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def _default(value):
+    # numpy scalars and whatever else the Flask encoder knows
+    if hasattr(value, 'item'):
+        return value.item()
+    return app.json_encoder().default(value)
+
+
+def stdlib_dumps(value):
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+def orjson_dumps(value):
+    options = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+    if app.config['JSON_SORT_KEYS']:
+        options |= orjson.OPT_SORT_KEYS
+    return orjson.dumps(value, default=_default, option=options)
+
+
+JSON_BACKENDS = {'stdlib': stdlib_dumps, 'orjson': orjson_dumps}
+
+
+def dumps_json(value):
+    """ Encodes value as UTF-8 JSON with the configured backend"""
+    backend = app.config['JSON_BACKEND'] or ('orjson' if orjson is not None else 'stdlib')
+    return JSON_BACKENDS[backend](value)
+
+
+def dumps_msgpack(value):
+    return msgpack.packb(value, use_bin_type=True, default=_default)
+
+
+ENCODERS = {'application/json': dumps_json}
+if msgpack is not None:
+    ENCODERS['application/msgpack'] = dumps_msgpack
+
+
+def respond(value, status=200):
+    """ Responds with value in the format the client prefers, JSON unless it asks for another one in ENCODERS"""
+    mimetype = request.accept_mimetypes.best_match(list(ENCODERS)) or 'application/json'
+    response = Response(ENCODERS[mimetype](value), status, mimetype=mimetype)
+    response.vary.add('Accept')
+    return response
+
+
+def _gzip(data):
+    return gzip.compress(data, app.config['GZIP_LEVEL'])
+
+
+def _brotli(data):
+    return brotli.compress(data, quality=app.config['BROTLI_QUALITY'])
+
+
+# in order of preference when the client accepts several equally
+COMPRESSORS = {'br': _brotli} if brotli is not None else {}
+COMPRESSORS['gzip'] = _gzip
+COMPRESSIBLE = {'application/json', 'application/msgpack', 'application/x-ndjson', 'text/html', 'text/plain'}
+
+
+def compress_response(response):
+    """ Compresses the body of a response with the best encoding the client accepts, if it is large enough to pay
+    off. A strong ETag gets the encoding appended, as the compressed body is not byte for byte the same. Streamed
+    responses are left alone"""
+    if (response.direct_passthrough or response.is_streamed or response.mimetype not in COMPRESSIBLE
+            or 'Content-Encoding' in response.headers or not 200 <= response.status_code < 300):
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.content_length is not None and response.content_length < app.config['COMPRESS_MIN_SIZE']:
+        return response
+    name = request.accept_encodings.best_match(list(COMPRESSORS))
+    if name is not None:
+        response.set_data(COMPRESSORS[name](response.get_data()))
+        response.headers['Content-Encoding'] = name
+        etag, weak = response.get_etag()
+        if etag is not None and not weak:
+            response.set_etag('%s-%s' % (etag, name))
+            response.make_conditional(request)
+    return response
+
+
+def init_encoding(app):
+    app.after_request(compress_response)
@@ -0,0 +1,85 @@
+""" Consumption rollups and leaderboards. Every post adds its standard drinks to per user totals for the hour, day and
+week it was posted in, so leaderboards read a few presorted rows instead of scanning posts"""
+from database import *
+from bac import ALCOHOL_DENSITY
+
+PERIODS = ('hour', 'day', 'week')
+STANDARD_DRINK = 12  # grams of alcohol in a Swedish standard glass
+
+
+def drink_units(volume, alcohol_percentage):
+    """ Standard drinks in a post, volume in centilitres"""
+    return volume * 10 * alcohol_percentage / 100 * ALCOHOL_DENSITY / STANDARD_DRINK
+
+
+def bucket_start(timestamp, period):
+    """ Start of the hour, day or week (from Monday) that timestamp falls in"""
+    if period == 'hour':
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    day = timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == 'day':
+        return day
+    return day - timedelta(days=day.weekday())
+
+
+def rollup_totals(posts):
+    """ Sums the units of (author_id, timestamp, volume, alcohol_percentage) rows per user, period and bucket"""
+    totals = {}
+    for author_id, timestamp, volume, alcohol_percentage in posts:
+        units = drink_units(volume, alcohol_percentage)
+        for period in PERIODS:
+            key = (author_id, period, bucket_start(timestamp, period))
+            totals[key] = totals.get(key, 0) + units
+    return totals
+
+
+def add_to_rollups(posts):
+    """ Adds (author_id, timestamp, volume, alcohol_percentage) rows to the rollups in the current transaction. Each
+    bucket is incremented atomically, so concurrent posts by the same user do not lose updates"""
+    for (user_id, period, bucket), units in rollup_totals(posts).items():
+        key = db.and_(consumption.c.user_id == user_id, consumption.c.period == period,
+                      consumption.c.bucket == bucket)
+        increment = consumption.update().where(key).values(units=consumption.c.units + units)
+        if db.session.execute(increment).rowcount == 0 and not insert_ignore(
+                consumption, {'user_id': user_id, 'period': period, 'bucket': bucket, 'units': units}):
+            db.session.execute(increment)
+
+
+def rebuild_rollups(batch_size=1000):
+    """ Recomputes every rollup from the posts. Posts are streamed one author at a time so memory stays bounded"""
+    db.session.execute(consumption.delete())
+    rows, author_posts, author = [], [], None
+    query = db.session.query(Post.author_id, Post.timestamp, Post.volume, Post.alcohol_percentage).order_by(
+        Post.author_id)
+    for post in query.yield_per(batch_size):
+        if post[0] != author:
+            rows += _rollup_rows(author_posts)
+            author_posts, author = [], post[0]
+        author_posts.append(post)
+        if len(rows) >= batch_size:
+            db.session.execute(consumption.insert(), rows)
+            rows = []
+    rows += _rollup_rows(author_posts)
+    if rows:
+        db.session.execute(consumption.insert(), rows)
+    db.session.commit()
+
+
+def _rollup_rows(posts):
+    return [{'user_id': user_id, 'period': period, 'bucket': bucket, 'units': units}
+            for (user_id, period, bucket), units in rollup_totals(posts).items()]
+
+
+def leaderboard(period, at=None, follower_id=None, limit=None):
+    """ Users with the most standard drinks in the period containing at, by default now. With a follower_id only that
+    user and the users they follow are ranked"""
+    bucket = bucket_start(at or datetime.utcnow(), period)
+    query = db.session.query(consumption.c.user_id, User.username, consumption.c.units).join(
+        User, (User.user_id == consumption.c.user_id)).filter(
+        consumption.c.period == period, consumption.c.bucket == bucket, User.deleted_at.is_(None))
+    if follower_id is not None:
+        query = query.join(followers, (followers.c.followed_id == consumption.c.user_id)).filter(
+            followers.c.follower_id == follower_id)
+    query = query.order_by(consumption.c.units.desc(), consumption.c.user_id).limit(page_limit(limit))
+    return [{'rank': rank, 'user_id': user_id, 'username': username, 'units': units}
+            for rank, (user_id, username, units) in enumerate(query, 1)]
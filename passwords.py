@@ -0,0 +1,74 @@
+""" Password hashing off the request path. The key derivation functions are slow on purpose, so they run in a bounded
+pool of HASH_WORKERS processes per web worker. At most HASH_QUEUE_SIZE hashes are queued or running, a request that
+finds the queue full gets HashingBusy at once instead of piling up. One that waits longer than HASH_TIMEOUT seconds
+gets HashingBusy too and its hash is dropped if it has not started, a started one keeps its place until it is done.
+HASH_WORKERS=0 hashes inline"""
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from database import app
+
+
+class HashingBusy(Exception):
+    pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(app.config['HASH_QUEUE_SIZE'])
+
+
+def _get_pool():
+    # created on first use, so that every forked web worker gets its own processes
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(app.config['HASH_WORKERS'])
+        return _pool
+
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        _pool = None
+
+
+def _run(f, *args):
+    if not app.config['HASH_WORKERS']:
+        return f(*args)
+    if not _slots.acquire(blocking=False):
+        raise HashingBusy()
+    try:
+        future = _get_pool().submit(f, *args)
+    except BrokenProcessPool:
+        _slots.release()
+        _reset_pool()
+        raise HashingBusy()
+    # the slot is held until the hash is done or dropped, not just until the request gives up waiting for it
+    future.add_done_callback(lambda _: _slots.release())
+    try:
+        return future.result(timeout=app.config['HASH_TIMEOUT'])
+    except TimeoutError:
+        future.cancel()
+        raise HashingBusy()
+    except BrokenProcessPool:
+        _reset_pool()
+        raise HashingBusy()
+
+
+def hash_password(password):
+    return _run(generate_password_hash, password)
+
+
+def verify_password(password_hash, password):
+    return _run(check_password_hash, password_hash, password)
+
+
+def hash_passwords(passwords):
+    """ Hashes many passwords at once on every process of the pool, for imports"""
+    if not app.config['HASH_WORKERS']:
+        return [generate_password_hash(x) for x in passwords]
+    return list(_get_pool().map(generate_password_hash, passwords, chunksize=16))
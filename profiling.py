@@ -0,0 +1,77 @@
+""" Opt-in query profiling of requests, turned on by QUERY_PROFILING. Counts the queries and database time of every
+request and reports them in a Server-Timing header, logs queries slower than SLOW_QUERY_MS with their route, and
+checks the query budget declared on the endpoint with query_budget. An exceeded budget fails the request when the
+app is testing and is logged otherwise"""
+import logging
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('profiling')
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def query_budget(queries):
+    """ Declares the most queries a request to the decorated endpoint may send, a number or a function returning one
+    for budgets that follow the configuration"""
+    def decorator(f):
+        f.query_budget = queries
+        return f
+    return decorator
+
+
+def _profile():
+    if has_request_context():
+        return g.get('query_profile')
+    return None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _profile() is not None:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _profile()
+    if profile is None or not conn.info.get('query_start'):
+        return
+    duration = time.perf_counter() - conn.info['query_start'].pop()
+    profile['queries'] += 1
+    profile['seconds'] += duration
+    if duration * 1000 >= profile['slow_ms']:
+        logger.warning('slow query %.1f ms in %s %s: %s', duration * 1000, request.method, request.endpoint,
+                       statement)
+
+
+def init_profiling(app):
+    """ Hooks the profiling into app and every SQLAlchemy engine, it stays inactive unless QUERY_PROFILING is set"""
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    @app.before_request
+    def start_profile():
+        if app.config['QUERY_PROFILING']:
+            g.query_profile = {'queries': 0, 'seconds': 0.0, 'slow_ms': app.config['SLOW_QUERY_MS']}
+
+    @app.after_request
+    def end_profile(response):
+        profile = g.pop('query_profile', None)
+        if profile is None:
+            return response
+        response.headers.add('Server-Timing', 'db;dur=%.1f;desc="%d queries"' % (profile['seconds'] * 1000,
+                                                                                 profile['queries']))
+        budget = getattr(app.view_functions.get(request.endpoint), 'query_budget', None)
+        if callable(budget):
+            budget = budget()
+        if budget is not None and profile['queries'] > budget:
+            message = '%s %s sent %d queries, its budget is %d' % (request.method, request.endpoint,
+                                                                   profile['queries'], budget)
+            if app.testing:
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        return response
@@ -1,55 +1,281 @@
 from db_functions import *
-from flask import abort, redirect, url_for, flash, make_response
+from db_functions import get_post as db_get_post  # get_post is the name of the route
+from bulk import BadRow, IMPORTERS, read_rows, write_rows, export_rows
+from bac import estimate_bac, bac_series
+from leaderboards import leaderboard, rebuild_rollups
+from profiling import init_profiling, query_budget
+from encoding import dumps_json, init_encoding, respond
+from flask import abort, redirect, url_for, flash, Response, stream_with_context
+from werkzeug.contrib.fixers import ProxyFix
+import click
+import hmac
+
+
+init_profiling(app)
+init_encoding(app)
+if app.config['PROXY_COUNT']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, num_proxies=app.config['PROXY_COUNT'])
 
 
 @app.before_first_request
 def create_db():
     init_db()
+    if app.config['FOLLOWER_GRAPH']:
+        rebuild_follower_graph()
 
 
 @jwt.token_in_blacklist_loader
 def check_if_token_in_blacklist(decrypted_token):
-    jti = decrypted_token['jti']
-    return is_token_blacklisted(jti)
+    return is_token_revoked(decrypted_token)
+
+
+@jwt.user_claims_loader
+def add_token_version(identity):
+    return {'ver': get_token_version(identity)}
+
+
+@app.errorhandler(InvalidCursor)
+def invalid_cursor(error):
+    return respond('invalid cursor', 400)
+
+
+@app.errorhandler(HashingBusy)
+def hashing_busy(error):
+    response = respond('busy, try again', 503)
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+@app.errorhandler(InvalidFields)
+def invalid_fields(error):
+    return respond('invalid fields', 400)
+
+
+def page_args():
+    """ Reads the cursor and limit query parameters of a paginated list endpoint"""
+    return request.args.get('cursor'), request.args.get('limit', type=int)
+
+
+def page_response(page):
+    """ Responds with a page as a list, and the cursor of the following page in the X-Next-Cursor header"""
+    response = respond(page)
+    if page.next_cursor is not None:
+        response.headers['X-Next-Cursor'] = page.next_cursor
+    return response
+
+
+STREAM_FORMATS = {'json': 'application/json', 'ndjson': 'application/x-ndjson'}
+
+
+def stream_arg():
+    """ Reads the stream query parameter of a list endpoint, None for the usual paginated response"""
+    fmt = request.args.get('stream')
+    if fmt is not None and fmt not in STREAM_FORMATS:
+        abort(400)
+    return fmt
+
+
+def stream_response(items, fmt):
+    """ Responds with every item of a generator, encoded one at a time as a JSON list or as NDJSON. Only the item being
+    encoded is held in memory. The queries run while the response is sent, after the query budget of the view"""
+    def encode():
+        if fmt == 'ndjson':
+            for item in items:
+                yield dumps_json(item) + b'\n'
+            return
+        separator = b'['
+        for item in items:
+            yield separator + dumps_json(item)
+            separator = b','
+        yield b'[]' if separator == b'[' else b']'
+    return Response(stream_with_context(encode()), mimetype=STREAM_FORMATS[fmt])
+
+
+def likers_arg():
+    """ Reads the likers query parameter of a post endpoint, the number of liker usernames to list"""
+    likers = request.args.get('likers', type=int)
+    if likers is not None and likers < 0:
+        abort(400)
+    return None if likers is None else min(likers, app.config['MAX_PAGE_SIZE'])
+
+
+def fields_args():
+    """ Reads the sparse fieldset of a user endpoint, see parse_fields"""
+    return parse_fields(request.args.get('fields'), request.args.get('include'))
 
 
 @app.route('/', methods=['GET'])
+@query_budget(0)
 def index():
-    return make_response(jsonify("hello world"))
+    return respond("hello world")
+
+
+@app.route('/internal/stats', methods=['GET'])
+@query_budget(0)
+def internal_stats():
+    token = app.config['STATS_TOKEN']
+    if not token or not hmac.compare_digest(request.headers.get('X-Stats-Token', ''), token):
+        abort(404)
+    return respond({'pool': pool_status()})
 
 
 @app.route('/user/<email>', methods=['GET'])
+@query_budget(12)
 @jwt_required
 def user(email):
-    return make_response(jsonify(get_user_email(email).to_dict()))
+    user = get_user_email(email)
+    if user is None:
+        abort(404)
+    return respond(user.to_dict(fields_args()))
 
 
 @app.route('/user/search/<string:query>')
+@query_budget(3)
 @jwt_required
 def search_user(query):
-    return make_response(jsonify(db_search_user(query)))
+    fields = fields_args()
+    fields = SEARCH_FIELDS if fields is None else fields
+    fmt = stream_arg()
+    if fmt is not None:
+        return stream_response(stream_users(search_users_query(query), fields), fmt)
+    return page_response(db_search_user(query, request.args.get('limit', type=int), fields))
+
+
+@app.route('/user/<email>/<any(posts, followed_posts, liked_posts):relation>', methods=['GET'])
+@query_budget(6)
+@jwt_required
+def user_posts(email, relation):
+    user = get_user_email(email)
+    if user is None:
+        abort(404)
+    return page_response(get_user_posts(user.user_id, relation, *page_args(), viewer_id=get_jwt_identity()))
+
+
+@app.route('/user/<email>/followed', methods=['GET'])
+@query_budget(12)
+@jwt_required
+def user_followed(email):
+    user = get_user_email(email)
+    if user is None:
+        abort(404)
+    return page_response(get_user_followed(user.user_id, *page_args(), fields=fields_args()))
+
+
+def datetime_arg(name, default=None):
+    """ Reads an ISO 8601 UTC time from the query string"""
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        return parse_datetime(value)
+    except ValueError:
+        abort(400)
+
+
+@app.route('/user/<user_id>/bac', methods=['GET'])
+@query_budget(3)
+@jwt_required
+def user_bac(user_id):
+    user = get_user_id(user_id)
+    if user is None:
+        abort(404)
+    at = datetime_arg('at')
+    bac = estimate_bac(user, at)
+    if at is None:
+        at = datetime.utcnow()
+    return respond({'user_id': user_id, 'at': at.isoformat(), 'bac': bac})
+
+
+@app.route('/user/<user_id>/bac/series', methods=['GET'])
+@query_budget(3)
+@jwt_required
+def user_bac_series(user_id):
+    user = get_user_id(user_id)
+    if user is None:
+        abort(404)
+    end = datetime_arg('end', datetime.utcnow())
+    start = datetime_arg('start', end - timedelta(hours=12))
+    step = timedelta(minutes=request.args.get('step', 10, type=int))
+    if step <= timedelta(0) or start > end or (end - start) / step > app.config['BAC_SERIES_MAX_POINTS']:
+        abort(400)
+    series = bac_series(user, start, end, step)
+    return respond([{'at': at.isoformat(), 'bac': bac} for at, bac in series])
+
+
+@app.route('/leaderboard/<any(hour, day, week):period>', methods=['GET'])
+@query_budget(2)
+@jwt_required
+def campus_leaderboard(period):
+    return respond(leaderboard(period, datetime_arg('at'), limit=request.args.get('limit', type=int)))
+
+
+@app.route('/leaderboard/<any(hour, day, week):period>/following', methods=['GET'])
+@query_budget(2)
+@jwt_required
+def following_leaderboard(period):
+    return respond(leaderboard(period, datetime_arg('at'), get_jwt_identity(), request.args.get('limit', type=int)))
 
 
 @app.route('/post', methods=['POST'])
+@query_budget(15)
 @jwt_required
 def post():
     author_id = get_jwt_identity()
     drink_name = request.json['drink_name']
     volume = request.json['volume']
     alcohol_percentage = request.json['alcohol_percentage']
-    return make_response(jsonify(create_post(drink_name, volume, alcohol_percentage, author_id).to_dict()))
+    return respond(create_post(drink_name, volume, alcohol_percentage, author_id).to_dict())
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def is_drink(drink_name, volume, alcohol_percentage):
+    return (isinstance(drink_name, str) and len(drink_name) <= Post.__table__.c.drink_name.type.length
+            and is_number(volume) and is_number(alcohol_percentage))
+
+
+@app.route('/posts/batch', methods=['POST'])
+@query_budget(16)
+@jwt_required
+def post_batch():
+    if not isinstance(request.json, dict):
+        abort(400)
+    posts = request.json.get('posts')
+    if not isinstance(posts, list) or not 0 < len(posts) <= app.config['POST_BATCH_SIZE']:
+        abort(400)
+    try:
+        drinks = [(x['drink_name'], x['volume'], x['alcohol_percentage']) for x in posts]
+    except (KeyError, TypeError):
+        abort(400)
+    if not all(is_drink(*x) for x in drinks):
+        abort(400)
+    return respond(serialize_posts(create_posts(drinks, get_jwt_identity())))
 
 
 @app.route('/post/<post_id>')
+@query_budget(3)
 def get_post(post_id):
-    post = Post.query.filter_by(post_id=post_id).first_or_404()
-    return make_response(jsonify(post.to_dict()))
+    cached = get_post_response(post_id, likers_arg())
+    if cached is None:
+        abort(404)
+    etag, last_modified, post = cached
+    response = respond(post)
+    # the JSON and MessagePack bodies differ, so they are told apart like compressed ones are
+    response.set_etag('%s-%s' % (etag, response.mimetype.split('/')[1]))
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 
 @app.route('/post/<post_id>/<action>')
+@query_budget(8)
 @jwt_required
 def like_action(post_id, action):
-    post = Post.query.filter_by(post_id=post_id).first_or_404()
+    post = db_get_post(post_id)
+    if post is None:
+        abort(404)
     current_user = get_user_id(get_jwt_identity())
     if action == 'like':
         current_user.like_post(post)
@@ -57,23 +283,28 @@ def like_action(post_id, action):
     if action == 'unlike':
         current_user.unlike_post(post)
         db.session.commit()
-    return make_response(jsonify(post.to_dict()))
+    return respond(post.to_dict(likers_arg()))
 
 
 @app.route('/post/<post_id>/comment', methods=['POST'])
+@query_budget(4)
 @jwt_required
 def post_comment(post_id):
     body = request.json['body']
-    return make_response(jsonify(create_comment(body, get_jwt_identity(), post_id).to_dict()))
+    if db_get_post(post_id) is None:
+        abort(404)
+    return respond(create_comment(body, get_jwt_identity(), post_id).to_dict())
 
 
 @app.route('/post/<post_id>/comment', methods=['GET'])
+@query_budget(2)
 @jwt_required
 def get_comments(post_id):
-    return make_response(jsonify(get_post_comments(post_id)))
+    return page_response(get_post_comments(post_id, *page_args()))
 
 
 @app.route('/user/register', methods=['POST'])
+@query_budget(10)
 def register():
     username = request.json['username']
     password = request.json['password']
@@ -87,39 +318,52 @@ def register():
     elif is_user_email(email) or not is_valid_email(email):
         abort(400)
     else:
-        return make_response(jsonify(create_user(username, password, email, weight, gender).to_dict()))
+        return respond(create_user(username, password, email, weight, gender).to_dict())
 
 
 @app.route('/user/delete', methods=['POST'])
+@query_budget(remove_user_query_budget)
 @jwt_required
 def delete():
     user = get_user_id(get_jwt_identity())
-    remove_user(user)
-    if get_user_id(get_jwt_identity()) is None:
-        return make_response(jsonify(200))
+    if remove_user(user):
+        return respond(200)
+    return respond(202, 202)
 
 
 @app.route('/user/login', methods=['POST'])
+@query_budget(1)
 def login():
     email = request.json['email']
     password = request.json['password']
-    if is_user_email(email):
-        if check_password(email, password):
-            return make_response(jsonify({'token': create_token(email)}))
-        else:
-            abort(400)
-    else:
+    if is_login_throttled(email, request.remote_addr):
+        response = respond('too many failed logins', 429)
+        response.headers['Retry-After'] = str(app.config['LOGIN_WINDOW'])
+        return response
+    user = authenticate(email, password, request.remote_addr)
+    if user is None:
         abort(400)
+    return respond({'token': create_user_token(user)})
 
 
 @app.route('/user/logout', methods=['POST'])
+@query_budget(3)
 @jwt_required
 def logout():
-    blacklist_token(get_raw_jwt()['jti'])
-    return make_response(jsonify(200))
+    revoke_token(get_raw_jwt())
+    return respond(200)
+
+
+@app.route('/user/logout/all', methods=['POST'])
+@query_budget(4)
+@jwt_required
+def logout_everywhere():
+    revoke_user_tokens(get_jwt_identity())
+    return respond(200)
 
 
 @app.route('/user/follow/<followee_id>', methods=['POST'])
+@query_budget(12)
 @jwt_required
 def follow(followee_id):
     follower = get_user_id(get_jwt_identity())
@@ -136,10 +380,11 @@ def follow(followee_id):
     if u is None:
         abort(400)
         return redirect(url_for('user', email=followee.email))
-    return make_response(jsonify(followee.to_dict()))
+    return respond(followee.to_dict())
 
 
 @app.route('/user/unfollow/<followee_id>', methods=['POST'])
+@query_budget(12)
 @jwt_required
 def unfollow(followee_id):
     follower = get_user_id(get_jwt_identity())
@@ -154,30 +399,135 @@ def unfollow(followee_id):
     if u is None:
         abort(400)
         return redirect(url_for('user', email=followee.email))
-    return make_response(jsonify(followee.to_dict()))
+    return respond(followee.to_dict())
 
 
 @app.route('/user/following', methods=['GET'])
+@query_budget(12)
 @jwt_required
 def get_followed():
     user_id = get_jwt_identity()
-    return make_response(jsonify(get_user_followed(user_id)))
+    fmt = stream_arg()
+    if fmt is not None:
+        return stream_response(stream_user_followed(user_id, fields_args()), fmt)
+    return page_response(get_user_followed(user_id, *page_args(), fields=fields_args()))
 
 
 @app.route('/user/followers', methods=['GET'])
+@query_budget(12)
 @jwt_required
 def get_followers():
     user_id = get_jwt_identity()
-    return make_response(jsonify(get_user_followers(user_id)))
+    fmt = stream_arg()
+    if fmt is not None:
+        return stream_response(stream_user_followers(user_id, fields_args()), fmt)
+    return page_response(get_user_followers(user_id, *page_args(), fields=fields_args()))
 
 
 @app.route('/user/login/refresh', methods=['GET'])
+@query_budget(4)
 @jwt_required
 def refresh_token():
-    if is_user_user_id(get_jwt_identity()):
-        user = get_user_id(get_jwt_identity())
-        blacklist_token(get_raw_jwt()['jti'])
-        new_token = create_token(user.email)
-        return make_response(jsonify(new_token))
-    else:
+    user = get_user_id(get_jwt_identity())
+    if user is None:
         abort(400)  # Only happens if a tokens identity is not a user.id.
+    revoke_token(get_raw_jwt())
+    return respond(create_user_token(user))
+
+
+# CLI commands
+
+
+@app.cli.command('timeline-backfill')
+@click.option('--email', default=None, help='Only rebuild the timeline of this user.')
+def timeline_backfill_command(email):
+    """ Rebuilds materialized home timelines from the followers table"""
+    init_db()
+    user_id = None
+    if email is not None:
+        user_id = get_user_email(email).user_id
+    backfill_timeline(user_id)
+    click.echo('Timeline rebuilt for %s' % (email or 'all users'))
+
+
+@app.cli.command('timeline-check')
+@click.option('--repair', is_flag=True, help='Rebuild the timeline of every inconsistent user.')
+def timeline_check_command(repair):
+    """ Reports users whose materialized timeline has drifted from the followers table"""
+    init_db()
+    inconsistent = 0
+    for user_id in [x for (x,) in db.session.query(User.user_id)]:
+        missing, extra = check_timeline(user_id)
+        if missing or extra:
+            inconsistent += 1
+            click.echo('%s: %d missing, %d extra' % (user_id, len(missing), len(extra)))
+            if repair:
+                backfill_timeline(user_id)
+    click.echo('%d inconsistent timelines' % inconsistent)
+
+
+@app.cli.command('search-reindex')
+def search_reindex_command():
+    """ Creates and rebuilds the username search index"""
+    init_db()
+    reindex_user_search()
+    click.echo('Search index rebuilt')
+
+
+@app.cli.command('counters-reconcile')
+def counters_reconcile_command():
+    """ Recounts the like and comment counters of posts that have drifted"""
+    init_db()
+    click.echo('Corrected %d posts' % reconcile_post_counters())
+
+
+@app.cli.command('bulk-import')
+@click.argument('kind', type=click.Choice(sorted(IMPORTERS)))
+@click.argument('file', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'fmt', type=click.Choice(['ndjson', 'csv']), default=None,
+              help='Defaults to csv for .csv files and ndjson otherwise.')
+@click.option('--batch-size', default=1000, help='Rows per transaction.')
+def bulk_import_command(kind, file, fmt, batch_size):
+    """ Imports users, posts or follows from an NDJSON or CSV file"""
+    init_db()
+    fmt = fmt or ('csv' if str(getattr(file, 'name', '')).endswith('.csv') else 'ndjson')
+    try:
+        count = IMPORTERS[kind](read_rows(file, fmt), batch_size=batch_size)
+    except BadRow as e:
+        raise click.ClickException(str(e))
+    click.echo('Imported %d %s' % (count, kind), err=True)
+
+
+@app.cli.command('bulk-export')
+@click.argument('kind', type=click.Choice(sorted(IMPORTERS)))
+@click.argument('file', type=click.File('w', encoding='utf-8'), default='-')
+@click.option('--format', 'fmt', type=click.Choice(['ndjson', 'csv']), default=None,
+              help='Defaults to csv for .csv files and ndjson otherwise.')
+@click.option('--batch-size', default=1000, help='Rows fetched from the database at a time.')
+def bulk_export_command(kind, file, fmt, batch_size):
+    """ Exports users, posts or follows as NDJSON or CSV, to stdout unless a file is given"""
+    init_db()
+    fmt = fmt or ('csv' if str(getattr(file, 'name', '')).endswith('.csv') else 'ndjson')
+    write_rows(export_rows(kind, batch_size), file, fmt, kind)
+
+
+@app.cli.command('rollups-rebuild')
+def rollups_rebuild_command():
+    """ Recomputes the consumption rollups behind the leaderboards from all posts"""
+    init_db()
+    rebuild_rollups()
+    click.echo('Rollups rebuilt')
+
+
+@app.cli.command('users-purge')
+def users_purge_command():
+    """ Finishes user deletions that were interrupted, e.g. by a restart during a background deletion"""
+    init_db()
+    click.echo('Purged %d users' % len(purge_deleted_users()))
+
+
+@app.cli.command('blacklist-prune')
+def blacklist_prune_command():
+    """ Deletes expired tokens from the blacklist"""
+    init_db()
+    click.echo('Pruned %d expired tokens' % prune_blacklist())
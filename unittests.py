@@ -1,11 +1,29 @@
+import gzip
 import json
 import os
+import sqlite3
 import tempfile
+import io
+import time
 import unittest
+from contextlib import contextmanager
 
+from sqlalchemy import event
+from werkzeug.contrib.fixers import ProxyFix
 
 from server import app
+import bulk
 import db_functions as data
+import bac
+import leaderboards
+import random
+import asyncio
+from aiohttp.test_utils import TestClient, TestServer
+import async_server
+import profiling
+import encoding
+import passwords
+from datetime import datetime, timedelta
 
 
 def test_init_db():
@@ -16,11 +34,31 @@ def test_init_db():
     data.db.session.commit()
 
 
+@contextmanager
+def count_queries():
+    """ Counts the statements sent to the database inside the with block"""
+    queries = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+
+    engine = data.db.get_engine(app)
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield queries
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
 class ServerTests(unittest.TestCase):
 
     def setUp(self):
         self.db_fd, app.config['DATABASE'] = tempfile.mkstemp()
         app.config['TESTING'] = True
+        app.config['QUERY_PROFILING'] = True
+        data._login_failures = data.MemoryBackend()
+        data.token_versions.clear()
+        data.follower_graph.clear()
         self.app = app.test_client()
         with app.app_context():
             data.db.init_app(app)
@@ -40,6 +78,9 @@ class ServerTests(unittest.TestCase):
         rv_data = json.loads(rv.data)
         assert rv.status_code == 200
         assert data.is_user_username(rv_data["username"])
+        # callers that pass the password itself still work
+        user = data.User('0000000000000001', 'stina', 'ABCdef123', 60, 'female', 'stina@student.liu.se', None, None)
+        assert passwords.verify_password(user.password_hash, 'ABCdef123')
 
     def test_create_user_bad_password(self):
         payload = {'username': 'klas', 'password': '123', 'email': 'klas@student.liu.se', 'weight': 80,
@@ -356,6 +397,999 @@ class ServerTests(unittest.TestCase):
         assert 'bertil' in search_res
         assert rv.status_code == 200
 
+    def test_timeline_fan_out(self):
+        bertil = data.get_user_id('UL4WE4Q4OSVOYOA1')
+        klas = data.create_user(username="klas", password="ABCdef123", email="klas@student.liu.se", weight=80,
+                                gender='male')
+        old_post = data.create_post('Gränges', 33, 5.3, bertil.user_id)
+        data.follow_user(klas, bertil)
+        new_post = data.create_post('Mariestads', 50, 5.3, bertil.user_id)
+        assert [x.post_id for x in klas.followed_posts()] == [new_post.post_id, old_post.post_id]
+        assert data.check_timeline(klas.user_id) == (set(), set())
+
+        data.unfollow_user(klas, bertil)
+        assert klas.followed_posts().all() == []
+        assert [x.post_id for x in bertil.followed_posts()] == [new_post.post_id, old_post.post_id]
+
+    def test_timeline_fan_out_on_read(self):
+        app.config['TIMELINE_FANOUT_LIMIT'] = 1
+        try:
+            bertil = data.get_user_id('UL4WE4Q4OSVOYOA1')
+            klas = data.create_user(username="klas", password="ABCdef123", email="klas@student.liu.se", weight=80,
+                                    gender='male')
+            data.follow_user(klas, bertil)
+            first_post = data.create_post('Gränges', 33, 5.3, bertil.user_id)
+            assert data.get_user_id(bertil.user_id).fanout_on_read
+            second_post = data.create_post('Mariestads', 50, 5.3, bertil.user_id)
+            assert [x.post_id for x in klas.followed_posts()] == [second_post.post_id, first_post.post_id]
+            # the row of first_post is left over from before the switch, it does not make the timeline inconsistent
+            assert data.check_timeline(klas.user_id) == (set(), set())
+
+            data.backfill_timeline()
+            assert data.check_timeline(klas.user_id) == (set(), set())
+            assert [x.post_id for x in klas.followed_posts()] == [second_post.post_id, first_post.post_id]
+        finally:
+            app.config['TIMELINE_FANOUT_LIMIT'] = 1000
+
+    def test_get_post_comments_paginated(self):
+        payload = {'email': 'bananer@student.liu.se', 'password': 'ABCdef123'}
+        headers = {'Content-Type': 'application/json'}
+        rv = self.app.post('/user/login', json=payload, headers=headers)
+        token = json.loads(rv.data)
+        headers = {'Authorization': 'Bearer ' + token['token'], 'Content-Type': 'application/json'}
+        assert rv.status_code == 200
+
+        post_id = data.create_post('Gränges', 33, 5.3, 'UL4WE4Q4OSVOYOA1').post_id
+        for i in range(5):
+            data.create_comment('Skål %d' % i, 'UL4WE4Q4OSVOYOA1', post_id)
+
+        comments = []
+        rv = self.app.get('/post/' + post_id + '/comment?limit=2', headers=headers)
+        while True:
+            rv_data = json.loads(rv.data)
+            assert rv.status_code == 200
+            assert len(rv_data) <= 2
+            comments += [x['body'] for x in rv_data]
+            if 'X-Next-Cursor' not in rv.headers:
+                break
+            rv = self.app.get('/post/' + post_id + '/comment?limit=2&cursor=' + rv.headers['X-Next-Cursor'],
+                              headers=headers)
+        assert comments == ['Skål %d' % i for i in reversed(range(5))]
+
+        rv = self.app.get('/post/' + post_id + '/comment?cursor=bananer', headers=headers)
+        assert rv.status_code == 400
+
+    def test_get_user_posts_paginated(self):
+        post_ids = [data.create_post('Gränges', 33, 5.3, 'UL4WE4Q4OSVOYOA1').post_id for _ in range(3)]
+        page = data.get_user_posts('UL4WE4Q4OSVOYOA1', 'followed_posts', limit=2)
+        assert [x['post_id'] for x in page] == post_ids[:0:-1]
+        page = data.get_user_posts('UL4WE4Q4OSVOYOA1', 'followed_posts', page.next_cursor, limit=2)
+        assert [x['post_id'] for x in page] == post_ids[:1]
+        assert page.next_cursor is None
+
+    def test_user_to_dict_query_count(self):
+        bertil = data.get_user_id('UL4WE4Q4OSVOYOA1')
+        fans = [data.create_user(username='fan%d' % i, password='ABCdef123', email='fan%d@student.liu.se' % i,
+                                 weight=70, gender='female') for i in range(3)]
+
+        def seed_posts(n):
+            for _ in range(n):
+                post = data.create_post('Gränges', 33, 5.3, bertil.user_id)
+                for fan in fans:
+                    fan.like_post(post)
+                    bertil.like_post(post)
+            data.db.session.commit()
+
+        seed_posts(2)
+        with count_queries() as queries:
+            bertil.to_dict()
+        few_posts = len(queries)
+
+        seed_posts(10)
+        with count_queries() as queries:
+            profile = bertil.to_dict()
+        assert len(queries) == few_posts
+        assert len(profile['posts']) == 12
+        assert sorted(profile['posts'][0]['likes']) == ['bertil', 'fan0', 'fan1', 'fan2']
+
+    def test_user_sparse_fields(self):
+        payload = {'email': 'bananer@student.liu.se', 'password': 'ABCdef123'}
+        headers = {'Content-Type': 'application/json'}
+        rv = self.app.post('/user/login', json=payload, headers=headers)
+        token = json.loads(rv.data)
+        headers = {'Authorization': 'Bearer ' + token['token'], 'Content-Type': 'application/json'}
+        assert rv.status_code == 200
+
+        data.create_post('Gränges', 33, 5.3, 'UL4WE4Q4OSVOYOA1')
+        with count_queries() as queries:
+            rv = self.app.get('/user/bananer@student.liu.se?fields=username,avatar', headers=headers)
+        rv_data = json.loads(rv.data)
+        assert rv.status_code == 200
+        assert rv_data == {'username': 'bertil', 'avatar': data.get_user_username('bertil').avatar()}
+        assert not [x for x in queries if 'post' in x.lower()]
+
+        rv = self.app.get('/user/bananer@student.liu.se?include=posts', headers=headers)
+        rv_data = json.loads(rv.data)
+        assert rv.status_code == 200
+        assert set(rv_data) == set(data.USER_HEADER_FIELDS) | {'posts'}
+        assert len(rv_data['posts']) == 1
+
+        rv = self.app.get('/user/bananer@student.liu.se?fields=password_hash', headers=headers)
+        assert rv.status_code == 400
+
+    def test_user_followed_cursor(self):
+        bertil = data.get_user_id('UL4WE4Q4OSVOYOA1')
+        names = ['klas', 'stina', 'olle']
+        for name in names:
+            data.follow_user(bertil, data.create_user(username=name, password="ABCdef123",
+                                                      email=name + "@student.liu.se", weight=80, gender='male'))
+        rv = self.app.post('/user/login', json={'email': 'bananer@student.liu.se', 'password': 'ABCdef123'})
+        headers = {'Authorization': 'Bearer ' + rv.get_json()['token']}
+        page_size, follower_graph = app.config['PAGE_SIZE'], app.config['FOLLOWER_GRAPH']
+        app.config['PAGE_SIZE'] = 2
+        try:
+            for graph in [False, True]:
+                app.config['FOLLOWER_GRAPH'] = graph
+                profile = self.app.get('/user/bananer@student.liu.se?fields=followed', headers=headers).get_json()
+                assert len(profile['followed']) == 2 and profile['followed_cursor'] is not None
+                rv = self.app.get('/user/bananer@student.liu.se/followed?fields=username&cursor='
+                                  + profile['followed_cursor'], headers=headers)
+                rest = [x['username'] for x in rv.get_json()]
+                assert sorted(profile['followed'] + rest) == sorted(names)
+                assert rv.headers.get('X-Next-Cursor') is None
+        finally:
+            app.config['PAGE_SIZE'], app.config['FOLLOWER_GRAPH'] = page_size, follower_graph
+        profile = self.app.get('/user/bananer@student.liu.se?fields=followed', headers=headers).get_json()
+        assert len(profile['followed']) == 3 and profile['followed_cursor'] is None
+
+    def test_blacklist_cache(self):
+        payload = {'email': 'bananer@student.liu.se', 'password': 'ABCdef123'}
+        headers = {'Content-Type': 'application/json'}
+        rv = self.app.post('/user/login', json=payload, headers=headers)
+        token = json.loads(rv.data)
+        headers = {'Authorization': 'Bearer ' + token['token'], 'Content-Type': 'application/json'}
+        assert rv.status_code == 200
+
+        rv = self.app.get('/user/bananer@student.liu.se?fields=username', headers=headers)
+        assert rv.status_code == 200
+        with count_queries() as queries:
+            rv = self.app.get('/user/bananer@student.liu.se?fields=username', headers=headers)
+        assert rv.status_code == 200
+        assert not [x for x in queries if 'blacklist' in x.lower()]
+
+        rv = self.app.post('/user/logout', headers=headers)
+        assert rv.status_code == 200
+        rv = self.app.get('/user/bananer@student.liu.se?fields=username', headers=headers)
+        assert rv.status_code == 401
+
+    def test_blacklist_shared_cache(self):
+        app.config['CACHE_URL'] = 'memory://'
+        try:
+            data.blacklist_token('other-worker', time.time() + 60)
+            data.db.session.query(data.Blacklist).delete()
+            data.db.session.commit()
+            assert data.is_token_blacklisted('other-worker')
+        finally:
+            app.config['CACHE_URL'] = None
+
+    def test_prune_blacklist(self):
+        data.blacklist_token('expired', time.time() - 60)
+        data.blacklist_token('valid', time.time() + 60)
+        assert data.prune_blacklist() == 1
+        assert not data.is_token_blacklisted('expired')
+        assert data.is_token_blacklisted('valid')
+
+    def test_search_user_ranking(self):
+        for username in ['albert', 'bert', 'ber', 'Bernadotte']:
+            data.create_user(username=username, password='ABCdef123', email=username + '@student.liu.se', weight=70,
+                             gender='female')
+        # with the trigram index and with the LIKE that SQLite older than 3.34 falls back to
+        for trigram in [data.sqlite_trigram, False]:
+            data.sqlite_trigram, sqlite_trigram = trigram, data.sqlite_trigram
+            try:
+                result = data.db_search_user('ber')
+                assert [x['username'] for x in result] == ['ber', 'bert', 'bertil', 'Bernadotte', 'albert']
+                assert set(result[0]) == set(data.SEARCH_FIELDS)
+                assert [x['username'] for x in data.db_search_user('ber', limit=2)] == ['ber', 'bert']
+                assert [x['username'] for x in data.db_search_user('be')] == ['ber', 'bert', 'bertil', 'Bernadotte']
+                assert [x['username'] for x in data.db_search_user('BE')] == ['ber', 'bert', 'bertil', 'Bernadotte']
+                assert data.db_search_user('ber%') == []
+            finally:
+                data.sqlite_trigram = sqlite_trigram
+
+    def test_like_state(self):
+        bertil = data.get_user_id('UL4WE4Q4OSVOYOA1')
+        klas = data.create_user(username="klas", password="ABCdef123", email="klas@student.liu.se", weight=80,
+                                gender='male')
+        posts = [data.create_post('Gränges', 33, 5.3, bertil.user_id) for _ in range(3)]
+        klas.like_post(posts[0])
+        klas.like_post(posts[0])
+        klas.like_post(posts[2])
+        data.db.session.commit()
+        assert klas.has_liked_post(posts[0])
+        assert not klas.has_liked_post(posts[1])
+        assert data.liked_post_ids(klas.user_id, [x.post_id for x in posts]) == {posts[0].post_id, posts[2].post_id}
+
+        klas.unlike_post(posts[0])
+        data.db.session.commit()
+        assert not klas.has_liked_post(posts[0])
+
+        page = data.get_user_posts(bertil.user_id, 'posts', viewer_id=klas.user_id)
+        assert [x['liked'] for x in page] == [True, False, False]
+        assert not klas.is_following(bertil)
+        data.follow_user(klas, bertil)
+        assert klas.is_following(bertil)
+        assert data.followed_user_ids(klas.user_id, [bertil.user_id, 'nobody']) == {bertil.user_id}
+
+    def test_post_counters(self):
+        post = data.create_post('Gränges', 33, 5.3, 'UL4WE4Q4OSVOYOA1')
+        fans = [data.create_user(username='fan%d' % i, password='ABCdef123', email='fan%d@student.liu.se' % i,
+                                 weight=70, gender='female') for i in range(3)]
+        for fan in fans:
+            fan.like_post(post)
+            fan.like_post(post)
+        fans[0].unlike_post(post)
+        fans[0].unlike_post(post)
+        data.create_comment('Skål', fans[1].user_id, post.post_id)
+        data.db.session.commit()
+        post_dict = post.to_dict(likers_limit=1)
+        assert post_dict['like_count'] == 2
+        assert post_dict['comment_count'] == 1
+        assert post_dict['likes'] == ['fan1']
+        assert sorted(post.to_dict()['likes']) == ['fan1', 'fan2']
+
+        data.Post.query.update({data.Post.like_count: 7})
+        data.db.session.commit()
+        data.post_responses.clear()
+        assert data.get_post_response(post.post_id)[2]['like_count'] == 7
+        assert data.reconcile_post_counters() == 1
+        # the cached response with the wrong count is dropped
+        assert data.get_post_response(post.post_id)[2]['like_count'] == 2
+        assert data.reconcile_post_counters() == 0
+        assert data.get_post(post.post_id).like_count == 2
+
+    def test_generate_id(self):
+        with count_queries() as queries:
+            ids = [data.generate_id(data.is_post_id) for _ in range(1000)]
+        assert queries == []
+        assert all(len(x) == 16 for x in ids)
+        assert len(set(ids)) == len(ids)
+        assert [x[:9] for x in ids] == sorted(x[:9] for x in ids)
+
+        app.config['ID_GENERATOR'] = 'random'
+        try:
+            with count_queries() as queries:
+                random_id = data.generate_id(data.is_post_id)
+            assert len(random_id) == 16
+            assert len(queries) == 1
+        finally:
+            app.config['ID_GENERATOR'] = 'time'
+
+    def test_bulk_import_export(self):
+        users = io.StringIO('\n'.join(json.dumps(x) for x in [
+            {'user_id': 'klas000000000000', 'username': 'klas', 'password': 'ABCdef123', 'weight': 80, 'gender': 'male',
+             'email': 'klas@student.liu.se'},
+            {'username': 'stina', 'password_hash': data.get_user_id('UL4WE4Q4OSVOYOA1').password_hash,
+             'weight': 60, 'gender': 'female', 'email': 'stina@student.liu.se'}]))
+        assert bulk.import_users(bulk.read_rows(users, 'ndjson'), batch_size=1) == 2
+        assert data.check_password('stina@student.liu.se', 'ABCdef123')
+        assert data.check_password('klas@student.liu.se', 'ABCdef123')
+
+        follows = io.StringIO('follower_id,followed_id\nklas000000000000,UL4WE4Q4OSVOYOA1\n')
+        assert bulk.import_follows(bulk.read_rows(follows, 'csv')) == 1
+        posts = io.StringIO('post_id,timestamp,drink_name,volume,alcohol_percentage,author_id\n'
+                            'post000000000001,2019-03-01T20:00:00,Gränges,33,5.3,UL4WE4Q4OSVOYOA1\n'
+                            ',,Mariestads,50,5.3,UL4WE4Q4OSVOYOA1\n')
+        assert bulk.import_posts(bulk.read_rows(posts, 'csv')) == 2
+        klas = data.get_user_username('klas')
+        assert [x.drink_name for x in klas.followed_posts()] == ['Mariestads', 'Gränges']
+        assert data.check_timeline(klas.user_id) == (set(), set())
+
+        exported = io.StringIO()
+        bulk.write_rows(bulk.export_rows('posts', batch_size=1), exported, 'csv', 'posts')
+        exported.seek(0)
+        rows = {x['post_id']: x for x in bulk.read_rows(exported, 'csv')}
+        assert len(rows) == 2
+        assert rows['post000000000001']['timestamp'] == '2019-03-01T20:00:00'
+        assert rows['post000000000001']['volume'] == '33.0'
+
+        result = app.test_cli_runner().invoke(args=['bulk-export', 'follows'])
+        assert result.exit_code == 0
+        assert len(result.output.splitlines()) == 4
+
+        bad = [{'username': 'olle', 'password': 'ABCdef123', 'weight': 80, 'gender': 'male',
+                'email': 'olle@student.liu.se'},
+               {'username': 'nisse', 'weight': 80, 'gender': 'male', 'email': 'nisse@student.liu.se'}]
+        with self.assertRaisesRegex(bulk.BadRow, 'users row 2: neither password nor password_hash'):
+            bulk.import_users(bad, batch_size=1)
+        with self.assertRaisesRegex(bulk.BadRow, 'posts row 1: '):
+            bulk.import_posts([{'volume': 'a lot', 'alcohol_percentage': 5.3, 'author_id': 'UL4WE4Q4OSVOYOA1'}])
+
+    def test_bac_after_drinks(self):
+        def naive(hours, increments):
+            levels, level, previous = [], 0, None
+            for t, d in zip(hours, increments):
+                if previous is not None:
+                    level = max(0, level - bac.ELIMINATION_RATE * (t - previous))
+                level += d
+                levels.append(level)
+                previous = t
+            return levels
+
+        groups, hours, increments = [], [], []
+        for user in range(20):
+            t = 0
+            for _ in range(random.randint(1, 10)):
+                t += random.expovariate(1)
+                groups.append(user)
+                hours.append(t)
+                increments.append(random.uniform(0.1, 0.5))
+        levels = bac.bac_after_drinks(hours, increments, groups)
+        for user in range(20):
+            mine = [i for i, x in enumerate(groups) if x == user]
+            expected = naive([hours[i] for i in mine], [increments[i] for i in mine])
+            assert max(abs(levels[i] - x) for i, x in zip(mine, expected)) < 1e-9
+
+    def test_user_bac(self):
+        payload = {'email': 'bananer@student.liu.se', 'password': 'ABCdef123'}
+        headers = {'Content-Type': 'application/json'}
+        rv = self.app.post('/user/login', json=payload, headers=headers)
+        token = json.loads(rv.data)
+        headers = {'Authorization': 'Bearer ' + token['token'], 'Content-Type': 'application/json'}
+        assert rv.status_code == 200
+
+        start = datetime(2019, 3, 1, 20)
+        for i in range(2):
+            post = data.create_post('Gränges', 33, 5.3, 'UL4WE4Q4OSVOYOA1')
+            post.timestamp = start + timedelta(hours=i)
+        data.db.session.commit()
+        one_drink = 33 * 10 * 0.053 * bac.ALCOHOL_DENSITY / (60 * bac.WIDMARK_FACTORS['male'])
+
+        rv = self.app.get('/user/UL4WE4Q4OSVOYOA1/bac?at=2019-03-01T21:00:00', headers=headers)
+        rv_data = json.loads(rv.data)
+        assert rv.status_code == 200
+        assert abs(rv_data['bac'] - (2 * one_drink - bac.ELIMINATION_RATE)) < 1e-9
+
+        rv = self.app.get('/user/UL4WE4Q4OSVOYOA1/bac/series?start=2019-03-01T19:00:00&end=2019-03-02T08:00:00'
+                          '&step=60', headers=headers)
+        rv_data = json.loads(rv.data)
+        assert rv.status_code == 200
+        assert len(rv_data) == 14
+        assert rv_data[0]['bac'] == 0
+        assert abs(rv_data[2]['bac'] - (2 * one_drink - bac.ELIMINATION_RATE)) < 1e-9
+        assert rv_data[-1]['bac'] == 0
+
+        rv = self.app.get('/user/UL4WE4Q4OSVOYOA1/bac?at=igår', headers=headers)
+        assert rv.status_code == 400
+
+    def test_bac_incremental_update(self):
+        bertil = data.get_user_id('UL4WE4Q4OSVOYOA1')
+        data.create_post('Gränges', 33, 5.3, bertil.user_id)
+        assert bac.estimate_bac(bertil) > 0
+        assert bac.bac_states.get(bertil.user_id) is not None
+        data.create_post('Mariestads', 50, 5.3, bertil.user_id)
+        cached = bac.estimate_bac(bertil)
+        bac.bac_states.delete(bertil.user_id)
+        assert abs(cached - bac.estimate_bac(bertil)) < 1e-6
+
+    def test_leaderboards(self):
+        bertil = data.get_user_id('UL4WE4Q4OSVOYOA1')
+        klas = data.create_user(username="klas", password="ABCdef123", email="klas@student.liu.se", weight=80,
+                                gender='male')
+        stina = data.create_user(username="stina", password="ABCdef123", email="stina@student.liu.se", weight=60,
+                                 gender='female')
+        data.follow_user(klas, bertil)
+        # fixed times, well inside their hour, day and week
+        at = datetime(2019, 3, 6, 12, 30)
+        drinks = 2 * [(bertil.user_id, 'Gränges', 33)] + [(klas.user_id, 'Gränges', 33)] + 3 * [
+            (stina.user_id, 'Mariestads', 50)]
+        bulk.import_posts([{'timestamp': at - timedelta(minutes=i), 'drink_name': drink_name, 'volume': volume,
+                            'alcohol_percentage': 5.3, 'author_id': author_id}
+                           for i, (author_id, drink_name, volume) in enumerate(drinks)])
+        can = leaderboards.drink_units(33, 5.3)
+
+        board = leaderboards.leaderboard('week', at)
+        assert [x['username'] for x in board] == ['stina', 'bertil', 'klas']
+        assert abs(board[1]['units'] - 2 * can) < 1e-9
+        board = leaderboards.leaderboard('day', at, follower_id=klas.user_id)
+        assert [(x['rank'], x['username']) for x in board] == [(1, 'bertil'), (2, 'klas')]
+
+        incremental = data.db.session.execute(data.consumption.select().order_by(
+            data.consumption.c.user_id, data.consumption.c.period)).fetchall()
+        leaderboards.rebuild_rollups(batch_size=2)
+        rebuilt = data.db.session.execute(data.consumption.select().order_by(
+            data.consumption.c.user_id, data.consumption.c.period)).fetchall()
+        assert [x[:3] for x in rebuilt] == [x[:3] for x in incremental]
+        assert all(abs(x[3] - y[3]) < 1e-9 for x, y in zip(rebuilt, incremental))
+
+        payload = {'email': 'bananer@student.liu.se', 'password': 'ABCdef123'}
+        headers = {'Content-Type': 'application/json'}
+        rv = self.app.post('/user/login', json=payload, headers=headers)
+        token = json.loads(rv.data)
+        headers = {'Authorization': 'Bearer ' + token['token'], 'Content-Type': 'application/json'}
+        rv = self.app.get('/leaderboard/hour/following?at=' + at.isoformat(), headers=headers)
+        assert [x['username'] for x in json.loads(rv.data)] == ['bertil']
+        rv = self.app.get('/leaderboard/week?limit=1&at=2019-03-01T20:00:00', headers=headers)
+        assert json.loads(rv.data) == []
+
+    def test_async_server(self):
+        rv = self.app.post('/user/login', json={'email': 'bananer@student.liu.se', 'password': 'ABCdef123'})
+        headers = {'Authorization': 'Bearer ' + json.loads(rv.data)['token']}
+        bertil = data.get_user_id('UL4WE4Q4OSVOYOA1')
+        klas = data.create_user(username="klas", password="ABCdef123", email="klas@student.liu.se", weight=80,
+                                gender='male')
+        data.follow_user(klas, bertil)
+        data.follow_user(bertil, klas)
+        posts = [data.create_post('Gränges', 33, 5.3, author) for author in [bertil.user_id, klas.user_id] * 2]
+        klas.like_post(posts[0])
+        for i in range(3):
+            data.create_comment('Skål %d' % i, klas.user_id, posts[0].post_id)
+        data.db.session.commit()
+        paths = ['/user/bananer@student.liu.se', '/user/klas@student.liu.se?include=followed_posts',
+                 '/post/' + posts[0].post_id, '/post/' + posts[0].post_id + '/comment?limit=2',
+                 '/user/followers', '/user/following?fields=username']
+
+        async def fetch_all():
+            async with TestClient(TestServer(async_server.create_app())) as client:
+                ret = []
+                for path in paths:
+                    rv = await client.get(path, headers=headers)
+                    ret.append((rv.status, await rv.json(), rv.headers.get('X-Next-Cursor')))
+                rv = await client.get(paths[0])
+                ret.append((rv.status, None, None))
+                return ret
+
+        responses = asyncio.get_event_loop().run_until_complete(fetch_all())
+        for path, (status, body, cursor) in zip(paths, responses):
+            rv = self.app.get(path, headers=headers)
+            assert status == rv.status_code == 200
+            assert body == json.loads(rv.data)
+            assert cursor == rv.headers.get('X-Next-Cursor')
+        assert responses[-1][0] == 401
+
+    def test_pool_stats(self):
+        assert self.app.get('/internal/stats').status_code == 404
+        app.config['STATS_TOKEN'] = 'secret'
+        try:
+            assert self.app.get('/internal/stats', headers={'X-Stats-Token': 'wrong'}).status_code == 404
+            checkouts = data.pool_stats.checkouts
+            data.get_user_id('UL4WE4Q4OSVOYOA1')
+            data.db.session.commit()
+            rv = self.app.get('/internal/stats', headers={'X-Stats-Token': 'secret'})
+            assert rv.status_code == 200
+            stats = json.loads(rv.data)['pool']
+            assert stats['checkouts'] > checkouts
+            assert stats['pool'].startswith('Instrumented')
+        finally:
+            app.config['STATS_TOKEN'] = None
+
+    def test_query_profiling(self):
+        post = data.create_post('Gränges', 33, 5.3, 'UL4WE4Q4OSVOYOA1')
+        rv = self.app.get('/post/' + post.post_id)
+        assert rv.headers['Server-Timing'].startswith('db;dur=')
+        assert rv.headers['Server-Timing'].endswith(' queries"')
+
+        view = app.view_functions['get_post']
+        view.query_budget, slow_query_ms = 0, app.config['SLOW_QUERY_MS']
+        app.config['SLOW_QUERY_MS'] = 0
+        data.post_responses.clear()
+        try:
+            with self.assertLogs('profiling') as logs, self.assertRaises(profiling.QueryBudgetExceeded):
+                self.app.get('/post/' + post.post_id)
+            assert 'GET get_post' in logs.output[0]
+        finally:
+            view.query_budget = 3
+            app.config['SLOW_QUERY_MS'] = slow_query_ms
+
+    def test_post_etag(self):
+        post_id = data.create_post('Gränges', 33, 5.3, 'UL4WE4Q4OSVOYOA1').post_id
+        rv = self.app.get('/post/' + post_id)
+        etag = rv.headers['ETag']
+        assert rv.status_code == 200 and rv.headers['Last-Modified']
+        with count_queries() as queries:
+            rv = self.app.get('/post/' + post_id, headers={'If-None-Match': etag})
+        assert rv.status_code == 304
+        assert queries == []
+
+        klas = data.create_user(username="klas", password="ABCdef123", email="klas@student.liu.se", weight=80,
+                                gender='male')
+        klas.like_post(data.get_post(post_id))
+        data.db.session.commit()
+        rv = self.app.get('/post/' + post_id, headers={'If-None-Match': etag})
+        assert rv.status_code == 200
+        assert json.loads(rv.data)['likes'] == ['klas']
+        assert rv.headers['ETag'] != etag
+        etag = rv.headers['ETag']
+
+        data.create_comment('Skål', data.get_user_username('klas').user_id, post_id)
+        rv = self.app.get('/post/' + post_id, headers={'If-None-Match': etag})
+        assert rv.status_code == 200
+        assert json.loads(rv.data)['comment_count'] == 1
+        assert self.app.get('/post/nosuchpost').status_code == 404
+
+        # only the default shape is cached, whatever likers values are asked for
+        for likers in range(5):
+            assert self.app.get('/post/%s?likers=%d' % (post_id, likers)).get_json()['likes'] == ['klas'][:likers]
+        assert data.post_responses.get(post_id)[1][2]['likes'] == ['klas']
+        assert self.app.get('/post/%s?likers=-1' % post_id).status_code == 400
+        etag = self.app.get('/post/' + post_id).headers['ETag']
+        rv = self.app.get('/post/%s?likers=0' % post_id, headers={'If-None-Match': etag})
+        assert rv.status_code == 200 and rv.get_json()['likes'] == []
+
+        # compressed bodies have tags of their own
+        app.config['COMPRESS_MIN_SIZE'], min_size = 0, app.config['COMPRESS_MIN_SIZE']
+        try:
+            etag = self.app.get('/post/' + post_id).headers['ETag']
+            rv = self.app.get('/post/' + post_id, headers={'Accept-Encoding': 'gzip'})
+            assert rv.headers['Content-Encoding'] == 'gzip' and rv.headers['ETag'] == etag[:-1] + '-gzip"'
+            gzip_etag = rv.headers['ETag']
+            rv = self.app.get('/post/' + post_id, headers={'Accept-Encoding': 'gzip', 'If-None-Match': gzip_etag})
+            assert rv.status_code == 304 and rv.data == b''
+            rv = self.app.get('/post/' + post_id, headers={'If-None-Match': gzip_etag})
+            assert rv.status_code == 200 and rv.headers['ETag'] == etag
+        finally:
+            app.config['COMPRESS_MIN_SIZE'] = min_size
+        rv = self.app.get('/post/' + post_id, headers={'Accept': 'application/msgpack', 'If-None-Match': etag})
+        assert rv.status_code == 200 and rv.mimetype == 'application/msgpack' and rv.headers['ETag'] != etag
+        rv = self.app.get('/post/' + post_id, headers={'Accept': 'application/msgpack',
+                                                       'If-None-Match': rv.headers['ETag']})
+        assert rv.status_code == 304
+
+    def test_login_throttle(self):
+        def login(email, password, addr='127.0.0.1'):
+            return self.app.post('/user/login', json={'email': email, 'password': password},
+                                 environ_base={'REMOTE_ADDR': addr}).status_code
+
+        data.create_user(username="klas", password="ABCdef123", email="klas@student.liu.se", weight=80,
+                         gender='male')
+        for _ in range(app.config['LOGIN_MAX_ACCOUNT_FAILURES']):
+            assert login('bananer@student.liu.se', 'wrong') == 400
+        assert login('bananer@student.liu.se', 'ABCdef123') == 429
+        assert login('klas@student.liu.se', 'ABCdef123') == 200
+        # the owner is not locked out by somebody else guessing
+        assert login('bananer@student.liu.se', 'ABCdef123', '10.0.0.3') == 200
+
+        app.config['LOGIN_MAX_IP_FAILURES'], max_ip_failures = 2, app.config['LOGIN_MAX_IP_FAILURES']
+        try:
+            assert login('nobody@student.liu.se', 'wrong', '10.0.0.1') == 400
+            assert login('klas@student.liu.se', 'wrong', '10.0.0.1') == 400
+            assert login('klas@student.liu.se', 'ABCdef123', '10.0.0.1') == 429
+            assert login('klas@student.liu.se', 'ABCdef123', '10.0.0.2') == 200
+
+            # behind the router every request comes from its address, clients are told apart by X-Forwarded-For
+            wsgi_app, app.wsgi_app = app.wsgi_app, ProxyFix(app.wsgi_app, num_proxies=1)
+            try:
+                def forwarded(password, client):
+                    return self.app.post('/user/login', json={'email': 'klas@student.liu.se', 'password': password},
+                                         environ_base={'REMOTE_ADDR': '10.1.0.1'},
+                                         headers={'X-Forwarded-For': client}).status_code
+                assert forwarded('wrong', '192.168.0.1') == 400
+                assert forwarded('wrong', 'spoofed, 192.168.0.1') == 400
+                assert forwarded('ABCdef123', '192.168.0.1') == 429
+                assert forwarded('ABCdef123', '192.168.0.2') == 200
+            finally:
+                app.wsgi_app = wsgi_app
+        finally:
+            app.config['LOGIN_MAX_IP_FAILURES'] = max_ip_failures
+
+    def test_token_revocation_modes(self):
+        def login():
+            rv = self.app.post('/user/login', json={'email': 'bananer@student.liu.se', 'password': 'ABCdef123'})
+            return {'Authorization': 'Bearer ' + json.loads(rv.data)['token']}
+
+        def authorized(headers):
+            return self.app.get('/user/following', headers=headers).status_code == 200
+
+        for mode in ['blacklist', 'version']:
+            app.config['TOKEN_REVOCATION'] = mode
+            try:
+                first, second, third = login(), login(), login()
+                assert self.app.post('/user/logout', headers=first).status_code == 200
+                assert not authorized(first)
+                assert authorized(second)
+                with count_queries() as queries:
+                    assert authorized(second)
+                # the token checks hit caches
+                assert not any('FROM blacklist' in x or x.startswith('SELECT user.token_version') for x in queries)
+                assert self.app.post('/user/logout/all', headers=second).status_code == 200
+                assert not authorized(second)
+                assert not authorized(third)
+                assert authorized(login())
+            finally:
+                app.config['TOKEN_REVOCATION'] = 'blacklist'
+
+        app.config['TOKEN_REVOCATION'], app.config['TOKEN_JTI_FILTER'] = 'version', False
+        try:
+            first, second = login(), login()
+            assert self.app.post('/user/logout', headers=first).status_code == 200
+            assert not authorized(first)
+            assert not authorized(second)
+        finally:
+            app.config['TOKEN_REVOCATION'], app.config['TOKEN_JTI_FILTER'] = 'blacklist', True
+
+    def test_remove_user_query_budget(self):
+        bertil_id = 'UL4WE4Q4OSVOYOA1'
+        klas = data.create_user(username="klas", password="ABCdef123", email="klas@student.liu.se", weight=80,
+                                gender='male')
+        klas_id = klas.user_id
+        data.follow_user(klas, data.get_user_id(bertil_id))
+        data.follow_user(data.get_user_id(bertil_id), klas)
+        for _ in range(11):
+            klas.like_post(data.create_post('Gränges', 33, 5.3, bertil_id))
+        data.db.session.commit()
+        for _ in range(10):
+            data.create_comment('Skål', klas_id, data.create_post('Gränges', 33, 5.3, bertil_id).post_id)
+        for _ in range(3):
+            data.create_post('Gränges', 33, 5.3, klas_id)
+        rows = data.count_user_rows(klas_id, 1000)
+        token = self.app.post('/user/login', json={'email': 'klas@student.liu.se', 'password': 'ABCdef123'}).get_json()
+        batch_size, threshold = app.config['DELETE_BATCH_SIZE'], app.config['DELETE_BACKGROUND_THRESHOLD']
+        app.config['DELETE_BATCH_SIZE'], app.config['DELETE_BACKGROUND_THRESHOLD'] = 4, rows
+        try:
+            rv = self.app.post('/user/delete', headers={'Authorization': 'Bearer ' + token['token']})
+        finally:
+            app.config['DELETE_BATCH_SIZE'], app.config['DELETE_BACKGROUND_THRESHOLD'] = batch_size, threshold
+        assert rv.status_code == 200
+        assert data.get_user_id(klas_id) is None
+
+    def test_bloom_filter(self):
+        jtis = data.BloomFilter(bits=1024, hashes=3)
+        for i in range(50):
+            jtis.add('jti%d' % i)
+        assert all('jti%d' % i in jtis for i in range(50))
+        assert sum('other%d' % i in jtis for i in range(1000)) < 100
+
+    def test_follower_graph_page(self):
+        graph = data.FollowerGraph()
+        # interned in another order than they sort in
+        follower_ids = ['u%02d' % ((i * 7) % 20) for i in range(20)]
+        graph.set('star', [], follower_ids)
+        graph.add_edge('u20', 'star')
+        graph.remove_edge('u07', 'star')
+        expected = sorted(set(follower_ids + ['u20']) - {'u07'}, reverse=True)
+        pages, before = [], None
+        while True:
+            page = graph.page('star', 'followers', before, 3)
+            if not page:
+                break
+            pages, before = pages + page, page[-1]
+        assert pages == expected
+        assert graph.count('star', 'followers') == 20
+        graph.set('u20', ['star'], [])
+        assert graph.follows('u20', 'star') and not graph.follows('u20', 'u07')
+
+    def test_purge_user(self):
+        bertil = data.get_user_id('UL4WE4Q4OSVOYOA1')
+        klas = data.create_user(username="klas", password="ABCdef123", email="klas@student.liu.se", weight=80,
+                                gender='male')
+        klas_id, bertil_id = klas.user_id, bertil.user_id
+        data.follow_user(klas, bertil)
+        data.follow_user(bertil, klas)
+        kept = data.create_post('Gränges', 33, 5.3, bertil_id).post_id
+        gone = [data.create_post('Gränges', 33, 5.3, klas_id).post_id for _ in range(3)]
+        klas.like_post(data.get_post(kept))
+        bertil.like_post(data.get_post(gone[0]))
+        data.db.session.commit()
+        data.create_comment('Skål', klas_id, kept)
+        data.create_comment('Skål', klas_id, kept)
+        data.create_comment('Skål', bertil_id, gone[0])
+        app.config['DELETE_BATCH_SIZE'] = 2
+        try:
+            assert data.remove_user(data.get_user_id(klas_id), background=False)
+        finally:
+            app.config['DELETE_BATCH_SIZE'] = 500
+        assert data.get_user_id(klas_id) is None
+        post = data.get_post(kept)
+        assert (post.like_count, post.comment_count) == (0, 0)
+        assert data.Post.query.filter(data.Post.post_id.in_(gone)).count() == 0
+        assert data.Comment.query.count() == 0
+        assert data.db.session.query(data.liked_posts).count() == 0
+        assert data.db.session.query(data.timeline).filter(data.timeline.c.post_id.in_(gone)).count() == 0
+        assert data.db.session.query(data.followers).filter(
+            data.db.or_(data.followers.c.follower_id == klas_id, data.followers.c.followed_id == klas_id)).count() == 0
+        assert data.reconcile_post_counters() == 0
+
+        stina = data.create_user(username="stina", password="ABCdef123", email="stina@student.liu.se", weight=60,
+                                 gender='female')
+        stina_id = stina.user_id
+        stina_post = data.create_post('Gränges', 33, 5.3, stina_id).post_id
+        assert not data.remove_user(stina, background=True)
+        # hidden while the purge runs
+        bertil = data.get_user_id(bertil_id)
+        assert data.get_user_id(stina_id) is None and data.get_user_username('stina') is None
+        assert data.get_post(stina_post) is None
+        assert 'stina' not in [x['username'] for x in data.db_search_user('stina')]
+        for _ in range(100):
+            if not data.is_user_id(stina_id):
+                break
+            data.db.session.rollback()
+            time.sleep(0.05)
+        assert not data.is_user_id(stina_id)
+        assert data.purge_deleted_users() == []
+
+        # rows added by requests in flight after their loop went by are swept before the user row goes
+        olle = data.create_user(username="olle", password="ABCdef123", email="olle@student.liu.se", weight=80,
+                                gender='male')
+        olle_id = olle.user_id
+        data.follow_user(olle, data.get_user_id(bertil_id))
+        record_follow_change = data.record_follow_change
+
+        def late_writes(*edge):
+            data.record_follow_change = record_follow_change
+            data.User.query.get(olle_id).like_post(data.Post.query.get(kept))
+            data.create_comment('Skål', olle_id, kept)
+            record_follow_change(*edge)
+
+        data.record_follow_change = late_writes
+        try:
+            assert data.remove_user(data.get_user_id(olle_id), background=False)
+        finally:
+            data.record_follow_change = record_follow_change
+        assert data.db.session.query(data.liked_posts).filter_by(user_id=olle_id).count() == 0
+        assert data.Comment.query.filter_by(author_id=olle_id).count() == 0
+        assert data.reconcile_post_counters() == 0
+
+    def test_read_replica(self):
+        bertil_id = 'UL4WE4Q4OSVOYOA1'
+        klas_id = data.create_user(username="klas", password="ABCdef123", email="klas@student.liu.se", weight=80,
+                                   gender='male').user_id
+        fd, replica = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        # a snapshot of the primary stands in for a lagging replica
+        source = sqlite3.connect(data.db.engine.url.database)
+        target = sqlite3.connect(replica)
+        source.backup(target)
+        source.close()
+        target.close()
+        app.config['SQLALCHEMY_BINDS'] = {'replica0': 'sqlite:///' + replica}
+        app.config['REPLICA_BINDS'] = ['replica0']
+        try:
+            post_id = data.create_post('Gränges', 33, 5.3, bertil_id).post_id
+            data.db.session.remove()
+            assert data.get_user_posts(bertil_id, 'posts') == []
+            assert data.Post.query.get(post_id) is not None
+            data.db.session.remove()
+
+            headers = {}
+            for email in ['bananer@student.liu.se', 'klas@student.liu.se']:
+                rv = self.app.post('/user/login', json={'email': email, 'password': 'ABCdef123'})
+                headers[email] = {'Authorization': 'Bearer ' + rv.get_json()['token']}
+
+            def posts(email):
+                rv = self.app.get('/user/bananer@student.liu.se/posts', headers=headers[email])
+                return [x['post_id'] for x in rv.get_json()]
+
+            assert posts('bananer@student.liu.se') == []
+            # the author reads their own writes, everyone else the replica until it has caught up
+            rv = self.app.post('/post', headers=headers['bananer@student.liu.se'],
+                               json={'drink_name': 'Gränges', 'volume': 33, 'alcohol_percentage': 5.3})
+            assert sorted(posts('bananer@student.liu.se')) == sorted([post_id, rv.get_json()['post_id']])
+            assert posts('klas@student.liu.se') == []
+            assert not data.is_sticky_writer(klas_id)
+        finally:
+            data.db.get_engine(app, 'replica0').dispose()
+            app.config['SQLALCHEMY_BINDS'] = {}
+            app.config['REPLICA_BINDS'] = []
+            data.sticky_writers.clear()
+            os.unlink(replica)
+
+    def test_post_batch(self):
+        bertil_id = 'UL4WE4Q4OSVOYOA1'
+        klas = data.create_user(username="klas", password="ABCdef123", email="klas@student.liu.se", weight=80,
+                                gender='male')
+        klas_id = klas.user_id
+        data.follow_user(klas, data.get_user_id(bertil_id))
+        rv = self.app.post('/user/login', json={'email': 'bananer@student.liu.se', 'password': 'ABCdef123'})
+        headers = {'Authorization': 'Bearer ' + rv.get_json()['token']}
+
+        def batch(n):
+            drinks = [{'drink_name': 'Gränges', 'volume': 33, 'alcohol_percentage': 5.3 + i} for i in range(n)]
+            return self.app.post('/posts/batch', headers=headers, json={'posts': drinks})
+
+        assert batch(1).status_code == 200
+        queries = batch(2).headers['Server-Timing']
+        rv = batch(10)
+        assert rv.status_code == 200
+        # the number of queries does not grow with the size of the batch
+        assert rv.headers['Server-Timing'].split('desc=')[1] == queries.split('desc=')[1]
+        posts = rv.get_json()
+        assert [x['alcohol_percentage'] for x in posts] == [5.3 + i for i in range(10)]
+        assert all(x['author'] == 'bertil' for x in posts)
+        timeline = data.get_user_posts(klas_id, 'followed_posts', limit=20)
+        assert {x['post_id'] for x in posts} <= {x['post_id'] for x in timeline}
+        assert data.Post.query.filter_by(author_id=bertil_id).count() == 13
+
+        assert batch(0).status_code == 400
+        assert batch(app.config['POST_BATCH_SIZE'] + 1).status_code == 400
+        for body in [{'posts': [{'drink_name': 'Gränges'}]}, [{'drink_name': 'Gränges'}], {'posts': ['Gränges']},
+                     {'posts': [{'drink_name': 'Gränges', 'volume': '33', 'alcohol_percentage': 5.3}]},
+                     {'posts': [{'drink_name': 'Gränges', 'volume': 33, 'alcohol_percentage': None}]},
+                     {'posts': [{'drink_name': 'Gränges', 'volume': True, 'alcohol_percentage': 5.3}]},
+                     {'posts': [{'drink_name': ['Gränges'], 'volume': 33, 'alcohol_percentage': 5.3}]},
+                     {'posts': [{'drink_name': 'G' * 33, 'volume': 33, 'alcohol_percentage': 5.3}]}]:
+            assert self.app.post('/posts/batch', headers=headers, json=body).status_code == 400
+        assert data.Post.query.filter_by(author_id=bertil_id).count() == 13
+
+        app.config['ID_GENERATOR'] = 'random'
+        try:
+            assert len(set(data.generate_ids(20, data.Post.post_id))) == 20
+        finally:
+            app.config['ID_GENERATOR'] = 'time'
+
+    def test_streamed_lists(self):
+        bertil = data.get_user_id('UL4WE4Q4OSVOYOA1')
+        for i in range(7):
+            follower = data.create_user(username="klas%d" % i, password="ABCdef123", email="klas%d@student.liu.se" % i,
+                                        weight=80, gender='male')
+            data.follow_user(follower, bertil)
+            data.follow_user(bertil, follower)
+        rv = self.app.post('/user/login', json={'email': 'bananer@student.liu.se', 'password': 'ABCdef123'})
+        headers = {'Authorization': 'Bearer ' + rv.get_json()['token']}
+        app.config['STREAM_BATCH_SIZE'] = 3
+        try:
+            for path in ['/user/followers?fields=user_id,username', '/user/following?fields=user_id,username',
+                         '/user/search/klas?fields=user_id,username']:
+                # search has no cursor, it returns the best matches
+                pages = self.app.get(path + ('&limit=200' if 'search' in path else '&limit=2'), headers=headers)
+                cursor, pages = pages.headers.get('X-Next-Cursor'), pages.get_json()
+                while cursor is not None:
+                    rv = self.app.get(path + '&limit=2&cursor=' + cursor, headers=headers)
+                    cursor, pages = rv.headers.get('X-Next-Cursor'), pages + rv.get_json()
+                assert len(pages) == 7
+                rv = self.app.get(path + '&stream=json', headers=headers)
+                assert rv.is_streamed and rv.mimetype == 'application/json'
+                assert rv.get_json() == pages
+                rv = self.app.get(path + '&stream=ndjson', headers=headers)
+                assert rv.mimetype == 'application/x-ndjson'
+                assert [json.loads(x) for x in rv.data.decode().splitlines()] == pages
+        finally:
+            app.config['STREAM_BATCH_SIZE'] = 100
+        # full users are serialized a batch at a time, not one by one
+        with count_queries() as queries:
+            assert len(self.app.get('/user/followers?stream=json', headers=headers).get_json()) == 7
+        assert len(queries) <= 8
+        assert self.app.get('/user/search/nobody?stream=json', headers=headers).get_json() == []
+        assert self.app.get('/user/followers?stream=xml', headers=headers).status_code == 400
+
+    def test_response_encoding(self):
+        for _ in range(20):
+            data.create_post('Gränges', 33, 5.3, 'UL4WE4Q4OSVOYOA1')
+        rv = self.app.post('/user/login', json={'email': 'bananer@student.liu.se', 'password': 'ABCdef123'})
+        headers = {'Authorization': 'Bearer ' + rv.get_json()['token']}
+        rv = self.app.get('/user/bananer@student.liu.se', headers=headers)
+        assert rv.mimetype == 'application/json' and 'Content-Encoding' not in rv.headers
+        profile = rv.get_json()
+        assert len(rv.data) > app.config['COMPRESS_MIN_SIZE']
+        try:
+            for backend in encoding.JSON_BACKENDS:
+                app.config['JSON_BACKEND'] = backend
+                assert json.loads(encoding.dumps_json(profile)) == profile
+        finally:
+            app.config['JSON_BACKEND'] = None
+
+        rv = self.app.get('/user/bananer@student.liu.se', headers=dict(headers, Accept='application/msgpack'))
+        assert rv.mimetype == 'application/msgpack'
+        assert encoding.msgpack.unpackb(rv.data, raw=False) == profile
+
+        for name, decompress in [('gzip', gzip.decompress), ('br', encoding.brotli.decompress)]:
+            rv = self.app.get('/user/bananer@student.liu.se', headers=dict(headers, **{'Accept-Encoding': name}))
+            assert rv.headers['Content-Encoding'] == name and 'Accept-Encoding' in rv.headers['Vary']
+            assert json.loads(decompress(rv.data)) == profile
+        # too small to be worth it
+        rv = self.app.get('/', headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in rv.headers and rv.get_json() == 'hello world'
+
+    def test_follower_graph(self):
+        app.config['FOLLOWER_GRAPH'], follower_graph = True, app.config['FOLLOWER_GRAPH']
+        try:
+            bertil_id = 'UL4WE4Q4OSVOYOA1'
+            ids = [bertil_id]
+            for name in ['klas', 'stina', 'olle']:
+                ids.append(data.create_user(username=name, password="ABCdef123", email=name + "@student.liu.se",
+                                            weight=80, gender='male').user_id)
+            bertil, klas_id, stina_id, olle_id = data.get_user_id(bertil_id), ids[1], ids[2], ids[3]
+            for user_id in ids[1:]:
+                data.follow_user(data.get_user_id(user_id), bertil)
+            data.follow_user(bertil, data.get_user_id(klas_id))
+            data.follower_graph.clear()
+            data.rebuild_follower_graph()
+            with count_queries() as queries:
+                assert data.is_following(klas_id, bertil_id) and not data.is_following(bertil_id, stina_id)
+                assert data.follow_count(bertil_id, 'followers') == 3 and data.follow_count(bertil_id, 'followed') == 1
+                assert data.mutual_follows(bertil_id) == [klas_id]
+            assert queries == []
+
+            data.unfollow_user(data.get_user_id(stina_id), data.get_user_id(bertil_id))
+            data.follow_user(data.get_user_id(bertil_id), data.get_user_id(olle_id))
+            data.get_user_id(stina_id).follow(data.get_user_id(olle_id))
+            data.db.session.rollback()
+            assert not data.is_following(stina_id, olle_id)
+            assert data.follow_count(bertil_id, 'followers') == 2
+            assert data.mutual_follows(bertil_id) == sorted([klas_id, olle_id])
+
+            pages, cursor = [], None
+            while True:
+                page = data.get_user_followers(bertil_id, cursor, 1, fields=['user_id'])
+                pages += [x['user_id'] for x in page]
+                cursor = page.next_cursor
+                if cursor is None:
+                    break
+            app.config['FOLLOWER_GRAPH'] = False
+            try:
+                assert pages == [x['user_id'] for x in data.get_user_followers(bertil_id, fields=['user_id'])]
+                assert data.mutual_follows(bertil_id) == sorted([klas_id, olle_id])
+            finally:
+                app.config['FOLLOWER_GRAPH'] = True
+
+            # a follow through another worker reaches this one through the shared cache
+            app.config['CACHE_URL'] = 'memory://'
+            try:
+                data.follow_count(stina_id, 'followed')
+                data.db.session.execute(data.followers.insert().values(follower_id=stina_id, followed_id=bertil_id))
+                data.db.session.commit()
+                assert not data.is_following(stina_id, bertil_id)
+                data.get_shared_cache().set('graph_version:' + stina_id, 'other')
+                assert data.is_following(stina_id, bertil_id)
+            finally:
+                app.config['CACHE_URL'] = None
+
+            # writes are decided by the database even when the graph has not caught up with it, as when another
+            # worker changed the edge without a shared cache
+            assert not data.is_following(olle_id, stina_id)
+            data.db.session.execute(data.followers.insert().values(follower_id=olle_id, followed_id=stina_id))
+            data.db.session.commit()
+            assert data.follow_user(data.get_user_id(olle_id), data.get_user_id(stina_id)) is None
+            assert data.unfollow_user(data.get_user_id(olle_id), data.get_user_id(stina_id)) is not None
+            assert data.unfollow_user(data.get_user_id(olle_id), data.get_user_id(stina_id)) is None
+            data.db.session.execute(data.followers.delete().where(data.followers.c.follower_id == klas_id))
+            data.db.session.commit()
+            assert data.follow_user(data.get_user_id(klas_id), data.get_user_id(bertil_id)) is not None
+            edges = data.db.session.query(data.followers).filter_by(follower_id=klas_id, followed_id=bertil_id)
+            assert edges.count() == 1
+        finally:
+            app.config['FOLLOWER_GRAPH'] = follower_graph
+
+    def test_user_list_query_count(self):
+        bertil_id = 'UL4WE4Q4OSVOYOA1'
+        bertil = data.get_user_id(bertil_id)
+        post_ids = [data.create_post('Gränges', 33, 5.3, bertil_id).post_id for _ in range(3)]
+        for i in range(12):
+            fan = data.create_user(username="fan%d" % i, password="ABCdef123", email="fan%d@student.liu.se" % i,
+                                   weight=80, gender='male')
+            data.follow_user(fan, bertil)
+            data.follow_user(bertil, fan)
+            data.create_post('Explorer', 50, 7.5, fan.user_id)
+            fan.like_post(data.get_post(post_ids[i % 3]))
+            data.create_comment('Skål', fan.user_id, post_ids[i % 3])
+        data.db.session.commit()
+        expected = [data.get_user_id(x['user_id']).to_dict()
+                    for x in data.get_user_followers(bertil_id, limit=50, fields=['user_id'])]
+        # cold follower graph, every entry has to be loaded
+        data.follower_graph.clear()
+        rv = self.app.post('/user/login', json={'email': 'bananer@student.liu.se', 'password': 'ABCdef123'})
+        headers = {'Authorization': 'Bearer ' + rv.get_json()['token']}
+        for path in ['/user/followers?limit=50', '/user/following?limit=50']:
+            rv = self.app.get(path, headers=headers)
+            assert rv.status_code == 200
+            assert rv.get_json() == expected
+        assert len(expected) == 12 and len(expected[0]['posts']) == 1 and expected[0]['followed'] == ['bertil']
+        assert len(expected[0]['followed_posts']) == 4
+
+    def test_hash_timeout(self):
+        free = passwords._slots._value
+        app.config['HASH_TIMEOUT'], timeout = 0.05, app.config['HASH_TIMEOUT']
+        try:
+            with self.assertRaises(passwords.HashingBusy):
+                passwords._run(time.sleep, 0.5)
+        finally:
+            app.config['HASH_TIMEOUT'] = timeout
+        # the hash that was given up on is dropped or keeps its slot until it is done, never longer
+        deadline = time.time() + 5
+        while passwords._slots._value < free and time.time() < deadline:
+            time.sleep(0.05)
+        assert passwords._slots._value == free
+        assert passwords.verify_password(passwords.hash_password('ABCdef123'), 'ABCdef123')
+
     def tearDown(self):
         os.close(self.db_fd)
         os.unlink(app.config['DATABASE'])